@@ -1,7 +1,6 @@
 """QuickForm 独立应用入口（配合 Nginx 反向代理时，Flask 仅提供 HTTP 内网服务，SSL 由 Nginx 终结）"""
 import os
 import time
-import threading
 from flask import Flask, redirect, url_for, request
 from flask_login import LoginManager, current_user
 from flask_bcrypt import Bcrypt
@@ -23,37 +22,35 @@ load_dotenv()
 RATE_LIMIT_WINDOW = 60          # 秒
 RATE_LIMIT_404_MAX = 30         # 窗口内 404 超过此次数则限流
 RATE_LIMIT_BAN_SECONDS = 120    # 触发限流后禁止该 IP 的时长（秒）
-_404_count = {}                 # ip -> (count, window_start)
-_404_lock = threading.Lock()
-_ban_until = {}                 # ip -> unix timestamp 解禁时间
+RATE_LIMIT_MAX_TRACKED_IPS = int(os.getenv('RATE_LIMIT_MAX_TRACKED_IPS', '200000'))  # 最多跟踪的 IP 数（内存上限）
+
+# 分片加锁 + 时间轮过期：每个请求的检查/计数为均摊 O(1)，不随被跟踪 IP 数增长
+# 共享状态后端（STATE_BACKEND=sqlite/redis）下多个 worker 共用计数与封禁
+from core.rate_limit import TimeWheelLimiter, SharedWindowLimiter
+from core.state import get_state_backend
+if get_state_backend().shared:
+    _404_limiter = SharedWindowLimiter(
+        get_state_backend(), RATE_LIMIT_WINDOW, RATE_LIMIT_404_MAX, RATE_LIMIT_BAN_SECONDS
+    )
+else:
+    _404_limiter = TimeWheelLimiter(
+        RATE_LIMIT_WINDOW, RATE_LIMIT_404_MAX, RATE_LIMIT_BAN_SECONDS,
+        max_entries=RATE_LIMIT_MAX_TRACKED_IPS
+    )
 
 
 def _get_client_ip():
     return request.headers.get('X-Forwarded-For', request.remote_addr or '') or 'unknown'
 
 
-def _clean_old_entries():
-    """清理过期的 404 记录和封禁信息
-
-    注意：调用方必须先获取 _404_lock 再调用本函数，
-    本函数内部不再重复加锁，以避免死锁。
-    """
-    now = time.time()
-    for ip in list(_404_count.keys()):
-        _, start = _404_count[ip]
-        if now - start > RATE_LIMIT_WINDOW:
-            del _404_count[ip]
-    for ip in list(_ban_until.keys()):
-        if _ban_until[ip] < now:
-            del _ban_until[ip]
-
-
 # 创建Flask应用
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your_secret_key_here')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
 # 由 Nginx 做 HTTPS 时，仍生成 https 链接（依赖 ProxyFix 传递 X-Forwarded-Proto）
 app.config['PREFERRED_URL_SCHEME'] = 'https'
+# 404 限流器登记到扩展表，供 /admin/metrics 读取运行指标
+app.extensions['quickform_404_limiter'] = _404_limiter
 
 # 邮件发送配置（用于邮箱验证码）
 app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.163.com')
@@ -154,11 +151,9 @@ def before_request_rate_limit():
         # 不因日志问题影响业务
         pass
 
-    with _404_lock:
-        _clean_old_entries()
-        if ip in _ban_until and _ban_until[ip] > now:
-            logger.warning("IP %s 命中 404 限流，返回 429", ip)
-            return 'Too Many Requests', 429
+    if _404_limiter.is_banned(ip, now):
+        logger.warning("IP %s 命中 404 限流，返回 429", ip)
+        return 'Too Many Requests', 429
 
 
 # ---------- 404 限流：请求后统计 404 ----------
@@ -168,19 +163,8 @@ def after_request_404_track(response):
         return response
     ip = _get_client_ip()
     now = time.time()
-    with _404_lock:
-        if ip not in _404_count:
-            _404_count[ip] = (0, now)
-        cnt, start = _404_count[ip]
-        if now - start > RATE_LIMIT_WINDOW:
-            _404_count[ip] = (1, now)
-            cnt = 1
-        else:
-            cnt += 1
-            _404_count[ip] = (cnt, start)
-        if cnt >= RATE_LIMIT_404_MAX:
-            _ban_until[ip] = now + RATE_LIMIT_BAN_SECONDS
-            logger.warning("404限流: IP %s 在 %ds 内 404 达 %d 次，已临时限制 %ds", ip, RATE_LIMIT_WINDOW, cnt, RATE_LIMIT_BAN_SECONDS)
+    if _404_limiter.hit(ip, now):
+        logger.warning("404限流: IP %s 在 %ds 内 404 达 %d 次，已临时限制 %ds", ip, RATE_LIMIT_WINDOW, RATE_LIMIT_404_MAX, RATE_LIMIT_BAN_SECONDS)
     return response
 
 
@@ -13,10 +13,10 @@ import threading
 import html
 import base64
 import uuid
-from urllib.parse import unquote_plus
-from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, make_response, send_file, send_from_directory, current_app
+from urllib.parse import unquote_plus, quote
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify, make_response, send_file, send_from_directory, current_app, Response, stream_with_context
 from sqlalchemy import create_engine, or_, text, func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, undefer_group
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask_bcrypt import Bcrypt
 from datetime import datetime
@@ -28,21 +28,40 @@ import matplotlib.pyplot as plt
 from dotenv import load_dotenv
 import logging
 from functools import wraps
-from collections import deque
-from typing import Deque
 import time
 import smtplib
 from email.mime.text import MIMEText
 from email.utils import formataddr
 
 # 导入分离的模块
-from .models import Base, User, Task, Submission, AIConfig, migrate_database, CertificationRequest, Post, PostReply, Organization, OrganizationMember, TaskShare, TaskLike
+from .models import Base, User, Task, Submission, AIConfig, migrate_database, CertificationRequest, Post, PostReply, Organization, OrganizationMember, TaskShare, TaskLike, RateLimitEvent, TaskFieldStat, AnalysisJob, AICacheEntry
 from services.file_service import save_uploaded_file, read_file_content, ALLOWED_EXTENSIONS, allowed_file, CERTIFICATION_ALLOWED_EXTENSIONS
-from services.ai_service import call_ai_model, generate_analysis_prompt, analyze_html_file
+from services.ai_service import call_ai_model, generate_analysis_prompt, analyze_html_file, configure_ai_cache
 from services.report_service import (
     save_analysis_report, generate_report_image, perform_analysis_with_custom_prompt,
-    analysis_progress, analysis_results, completed_reports, progress_lock, timeout
+    start_analysis_job, cancel_analysis_record, configure_analysis_jobs, configure_report_stream, get_analysis_progress
 )
+from services.submission_queue import (
+    SubmissionWriteQueue, SUBMIT_QUEUE_ENABLED, SUBMIT_QUEUE_ACK, SUBMIT_QUEUE_ACK_TIMEOUT, ACK_DURABLE, ACK_FAST
+)
+from services.submission_counter import bump_submission_count, refresh_submission_counts
+from services.task_cache import TaskLookupCache
+from services.rate_limit_events import RateLimitEventLog
+from services.export_service import iter_export, EXPORT_FORMATS
+from services.export_jobs import ExportJobManager
+from services.snapshot_service import SnapshotStore
+from services.ai_http import ai_http
+from services.ai_executor import AIJobExecutor, QueueFull
+from services.analysis_jobs import AnalysisJobStore
+from services.ai_cache import AIResponseCache
+from services.call_context import AI_TEST_DEADLINE, call_scope, call_stats
+from services.chunked_analysis import CHUNKED_ANALYSIS_MIN_ROWS
+from services.prompt_budget import estimate_tokens, prompt_token_budget
+from services.ai_usage import usage_stats
+from services.report_stream import ReportStreamHub
+from services.field_stats import FieldStatsUpdater, remove_field_stats, reset_field_stats, load_field_stats
+from .rate_limit import SlidingWindowLimiter, SharedSlidingWindowLimiter
+from .state import get_state_backend
 
 # 配置日志
 logging.basicConfig(
@@ -58,31 +77,27 @@ logger = logging.getLogger(__name__)
 # 加载环境变量
 load_dotenv()
 
-# 简单的邮箱验证码存储（开发环境用，生产建议换成 Redis）
-EMAIL_CODE_STORE = {}
+# 共享状态后端（STATE_BACKEND=memory|sqlite|redis）：邮箱验证码、提交限流、导出任务状态等
+# 多 worker 部署时需选 sqlite 或 redis，否则各进程看到的是各自的副本
+state_backend = get_state_backend()
 
 
 def set_email_code(email: str, code: str, ttl_seconds: int = 600):
-    """保存邮箱验证码"""
-    EMAIL_CODE_STORE[email] = {
-        'code': code,
-        'expires_at': time.time() + ttl_seconds
-    }
+    """保存邮箱验证码（过期由状态后端处理）"""
+    state_backend.set(f"email_code:{email}", code, ttl=ttl_seconds)
 
 
 def verify_email_code(email: str, code: str) -> bool:
     """校验邮箱验证码"""
-    data = EMAIL_CODE_STORE.get(email)
-    if not data:
-        return False
-    if time.time() > data['expires_at']:
-        EMAIL_CODE_STORE.pop(email, None)
-        return False
-    if data['code'] != code:
+    key = f"email_code:{email}"
+    try:
+        if state_backend.get(key) != code:
+            return False
+        # 一次性验证码，用完即删；并发校验时只有取到原值的一方成功
+        return state_backend.pop(key) == code
+    except Exception as e:
+        logger.error(f"读取邮箱验证码失败: {str(e)}")
         return False
-    # 一次性验证码，用完即删
-    EMAIL_CODE_STORE.pop(email, None)
-    return True
 
 
 def send_email_code(to_email: str, code: str):
@@ -188,10 +203,12 @@ def parse_urlencoded(raw_data):
 # 数据库配置（相对于QuickForm目录）
 # 默认从环境变量读取，但可以通过init_quickform的参数强制指定
 _database_type = None  # 将在init_quickform中设置
+_engines = []          # 本进程创建过的全部引擎（init_quickform 会替换导入时创建的引擎），fork 后逐个丢弃继承的连接
 
 def _init_database(database_type=None):
     """初始化数据库连接"""
     global DATABASE_URL, engine, SessionLocal
+    previous_engine = engine if _engines else None
     
     # 如果指定了数据库类型，使用指定的类型
     if database_type:
@@ -242,6 +259,7 @@ def _init_database(database_type=None):
                 pool_recycle=3600,   # 连接回收时间
                 echo=False
             )
+            _engines.append(engine)
             # 测试连接是否可用
             with engine.connect() as conn:
                 conn.execute(text("SELECT 1"))
@@ -256,14 +274,17 @@ def _init_database(database_type=None):
     if mysql_connection_failed or DATABASE_URL.startswith('sqlite'):
         # SQLite连接配置，启用外键约束
         def _fk_pragma_on_connect(dbapi_con, connection_record):
-            """在SQLite连接时启用外键约束"""
+            """在SQLite连接时启用外键约束；WAL 模式下多个 worker 进程的读写互不阻塞"""
             dbapi_con.execute('PRAGMA foreign_keys=ON')
+            dbapi_con.execute('PRAGMA journal_mode=WAL')
+            dbapi_con.execute('PRAGMA synchronous=NORMAL')
         
         engine = create_engine(
             DATABASE_URL, 
             connect_args={'check_same_thread': False},
             poolclass=None  # SQLite不需要连接池
         )
+        _engines.append(engine)
         # 注册事件监听器，确保每次连接都启用外键约束
         from sqlalchemy import event
         event.listen(engine, 'connect', _fk_pragma_on_connect)
@@ -271,6 +292,9 @@ def _init_database(database_type=None):
             logger.info("已回退到SQLite数据库")
     
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    if previous_engine is not None and previous_engine is not engine:
+        # 关闭旧引擎连接池中的连接（导入时 create_all 留下的），不再使用
+        previous_engine.dispose()
 
 # 初始化数据库（默认行为，向后兼容）
 _init_database()
@@ -299,6 +323,16 @@ quickform_bp = Blueprint(
 # 创建数据库表
 Base.metadata.create_all(engine)
 
+# 分析任务状态（analysis_job 表），报告生成进度与结果指针；
+# 在 start_background_workers 中按当前的 SessionLocal 创建（init_quickform 可能重建引擎，fork 后每个 worker 各建一份）
+analysis_job_store = None
+# 生成中的报告文本，经 /api/report_stream 以 SSE 推送给页面
+report_stream_hub = ReportStreamHub(state_backend)
+configure_report_stream(report_stream_hub)
+REPORT_STREAM_MAX_SECONDS = int(os.getenv('REPORT_STREAM_MAX_SECONDS', '600'))   # 单个 SSE 连接最长保持时间
+# AI 响应缓存（ai_cache_entry 表），相同提示词不重复调用模型；与 analysis_job_store 一样在 start_background_workers 中创建
+ai_response_cache = None
+
 # 权限检查装饰器
 def admin_required(f):
     """管理员权限检查装饰器"""
@@ -979,7 +1013,7 @@ def create_task():
             # 如果是HTML文件，在任务保存后自动在后台分析
             if task.file_path and task.file_path.lower().endswith(('.html', '.htm')):
                 try:
-                    analyze_html_file(task.id, current_user.id, task.file_path, SessionLocal, Task, AIConfig, read_file_content, call_ai_model)
+                    analyze_html_file(task.id, current_user.id, task.file_path, SessionLocal, Task, AIConfig, read_file_content, call_ai_model, executor=ai_executor)
                 except Exception as e:
                     logger.error(f"启动HTML文件分析失败: {str(e)}", exc_info=True)
             
@@ -1016,7 +1050,7 @@ def task_detail(task_id):
     """任务详情（公开任务支持未登录访问，但不显示分析/导出）"""
     db = SessionLocal()
     try:
-        task = db.get(Task, task_id)
+        task = db.get(Task, task_id, options=[undefer_group('html')])
         if not task:
             flash('任务不存在', 'danger')
             return redirect(url_for('quickform.index'))
@@ -1082,7 +1116,7 @@ def task_detail(task_id):
             .filter_by(task_id=task.id)
             .order_by(Submission.submitted_at.desc())
         )
-        total_submissions = submission_query.count()
+        total_submissions = task.submission_count or 0
         total_pages = max(math.ceil(total_submissions / per_page), 1) if total_submissions else 1
         if page > total_pages:
             page = total_pages
@@ -1133,6 +1167,12 @@ def task_detail(task_id):
         # 公开项目且当前用户非所有者/管理员等：仅展示任务名称、简介、网页（不展示数据与导出等）
         is_public_visitor = (task.sharing_type == 'public' and not can_analyze_export)
 
+        # 是否有仍在封禁期内的限流事件（详情由前端请求 rate_limit_events 接口获取）
+        has_rate_limit_events = can_analyze_export and db.query(RateLimitEvent.id).filter(
+            RateLimitEvent.task_id == task.id,
+            RateLimitEvent.expires_at > datetime.now()
+        ).first() is not None
+
         return render_template(
             'task_detail.html',
             task=task,
@@ -1145,7 +1185,8 @@ def task_detail(task_id):
             shared_users=shared_users,
             can_analyze_export=can_analyze_export,
             user_liked=user_liked,
-            is_public_visitor=is_public_visitor
+            is_public_visitor=is_public_visitor,
+            has_rate_limit_events=has_rate_limit_events
         )
     finally:
         db.close()
@@ -1156,7 +1197,7 @@ def edit_task(task_id):
     """编辑任务"""
     db = SessionLocal()
     try:
-        task = db.get(Task, task_id)
+        task = db.get(Task, task_id, options=[undefer_group('html')])
         if not task:
             flash('任务不存在', 'danger')
             return redirect(url_for('quickform.dashboard'))
@@ -1195,6 +1236,17 @@ def edit_task(task_id):
             
             task.title = title
             task.description = description
+
+            # 提交限流配置：留空表示使用全局默认值
+            for field, (low, high) in RATE_LIMIT_FIELD_RANGES.items():
+                raw = (request.form.get(field) or '').strip()
+                if not raw:
+                    setattr(task, field, None)
+                    continue
+                try:
+                    setattr(task, field, min(max(int(raw), low), high))
+                except ValueError:
+                    flash(f'限流配置格式不正确，已忽略: {raw}', 'warning')
             
             # 处理多文件上传（新功能）
             if html_files_data:
@@ -1303,7 +1355,7 @@ def edit_task(task_id):
                         
                         # 后台分析（不影响上传成功）
                         try:
-                            analyze_html_file(task.id, current_user.id, filepath, SessionLocal, Task, AIConfig, read_file_content, call_ai_model)
+                            analyze_html_file(task.id, current_user.id, filepath, SessionLocal, Task, AIConfig, read_file_content, call_ai_model, executor=ai_executor)
                         except Exception as e:
                             logger.error(f"启动HTML文件分析失败(编辑): {str(e)}", exc_info=True)
                 except Exception as e:
@@ -1342,7 +1394,7 @@ def edit_task(task_id):
                         
                         # 后台分析（不影响上传成功）
                         try:
-                            analyze_html_file(task.id, current_user.id, filepath, SessionLocal, Task, AIConfig, read_file_content, call_ai_model)
+                            analyze_html_file(task.id, current_user.id, filepath, SessionLocal, Task, AIConfig, read_file_content, call_ai_model, executor=ai_executor)
                         except Exception as e:
                             logger.error(f"启动HTML文件分析失败(编辑): {str(e)}", exc_info=True)
             if remove_file:
@@ -1364,6 +1416,7 @@ def edit_task(task_id):
                 task.sharing_type = 'organization' if task.organization_id else 'private'
             
             db.commit()
+            task_lookup_cache.invalidate(task.task_id)
             
             flash('任务更新成功', 'success')
             return redirect(url_for('quickform.task_detail', task_id=task.id))
@@ -1390,7 +1443,14 @@ def edit_task(task_id):
                 'saved_name': os.path.basename(task.file_path)
             }]
         
-        return render_template('edit_task.html', task=task, saved_filename=saved_filename, html_files=html_files)
+        return render_template(
+            'edit_task.html', task=task, saved_filename=saved_filename, html_files=html_files,
+            rate_limit_defaults={
+                'rate_limit_window': SUBMIT_RATE_LIMIT_WINDOW,
+                'rate_limit_threshold': SUBMIT_RATE_LIMIT_THRESHOLD,
+                'rate_limit_blacklist_seconds': SUBMIT_BLACKLIST_DURATION,
+            }
+        )
     finally:
         db.close()
 
@@ -1449,6 +1509,7 @@ def set_task_visibility(task_id):
             message = '项目已设置为仅自己或组织内部可见。'
 
         db.commit()
+        task_lookup_cache.invalidate(task.task_id)
         if message:
             flash(message, 'success')
         return redirect(url_for('quickform.task_detail', task_id=task.id))
@@ -1469,12 +1530,12 @@ def delete_task(task_id):
             flash('无权删除此任务', 'danger')
             return redirect(url_for('quickform.dashboard'))
         
-        # 显式删除所有相关的提交数据
-        submissions = db.query(Submission).filter_by(task_id=task.id).all()
-        submission_count = len(submissions)
-        
-        for submission in submissions:
-            db.delete(submission)
+        # 显式删除所有相关的提交数据（批量删除，不逐条加载）
+        submission_count = (
+            db.query(Submission)
+            .filter_by(task_id=task.id)
+            .delete(synchronize_session=False)
+        )
         
         # 删除任务文件（如果存在）
         if task.file_path and os.path.exists(task.file_path):
@@ -1484,9 +1545,21 @@ def delete_task(task_id):
             except Exception as e:
                 logger.warning(f"删除任务文件失败: {task.file_path}, 错误: {str(e)}")
         
+        db.query(RateLimitEvent).filter_by(task_id=task.id).delete(synchronize_session=False)
+        db.query(TaskFieldStat).filter_by(task_id=task.id).delete(synchronize_session=False)
+        db.query(AnalysisJob).filter_by(task_id=task.id).delete(synchronize_session=False)
+
         # 删除任务
+        public_task_id = task.task_id
         db.delete(task)
         db.commit()
+        task_lookup_cache.invalidate(public_task_id)
+        if export_job_manager is not None:
+            export_job_manager.purge_task(task_id)
+        if snapshot_store is not None:
+            snapshot_store.purge_task(task_id)
+        if ai_executor is not None:
+            ai_executor.cancel(('report', task_id))
         
         if submission_count > 0:
             flash(f'任务已删除，同时删除了 {submission_count} 条提交数据', 'success')
@@ -1548,8 +1621,72 @@ def api_send_email_code():
 SUBMIT_RATE_LIMIT_WINDOW = 10  # seconds
 SUBMIT_RATE_LIMIT_THRESHOLD = 50
 SUBMIT_BLACKLIST_DURATION = 300  # seconds
+# 任务可配置的限流字段及取值范围
+RATE_LIMIT_FIELD_RANGES = {
+    'rate_limit_window': (1, 3600),
+    'rate_limit_threshold': (1, 100000),
+    'rate_limit_blacklist_seconds': (1, 86400),
+}
+SUBMIT_RATE_LIMIT_MAX_TRACKED = int(os.getenv('SUBMIT_RATE_LIMIT_MAX_TRACKED', '100000'))  # 最多跟踪的 (任务, IP) 数
+
+# 提交限流：按 (任务, IP) 计数，任务可单独配置窗口/阈值/封禁时长
+# 共享状态后端（sqlite/redis）下各 worker 共用计数，否则用进程内结构
+if state_backend.shared:
+    rate_limit_cache = SharedSlidingWindowLimiter(state_backend)
+else:
+    rate_limit_cache = SlidingWindowLimiter(max_entries=SUBMIT_RATE_LIMIT_MAX_TRACKED)
+task_lookup_cache = TaskLookupCache()
+rate_limit_event_log = None  # 限流事件批量写入器，在 init_quickform 中创建
+
+# 提交写入队列（SUBMIT_QUEUE_ENABLED=true 时在 init_quickform 中创建）
+submission_queue = None
 
-rate_limit_cache = {}
+# 后台导出任务（在 start_background_workers 中创建），文件缓存在 uploads/exports/
+export_job_manager = None
+EXPORT_FOLDER = os.path.join(UPLOAD_FOLDER, 'exports')
+
+# 提交数据列式快照（SNAPSHOT_ENABLED=true 且安装了 pyarrow 时生效），在 start_background_workers 中创建
+snapshot_store = None
+SNAPSHOT_FOLDER = os.path.join(UPLOAD_FOLDER, 'snapshots')
+
+# AI 任务执行器（报告生成、HTML 分析），在 start_background_workers 中创建
+ai_executor = None
+
+# 字段统计后台合并（提交后登记任务，定时把新提交合并进 task_field_stat），在 start_background_workers 中创建
+field_stats_updater = None
+
+
+def _submit_ack_mode():
+    """客户端通过 ?ack=fast|durable 或 X-QuickForm-Ack 请求头选择确认模式"""
+    mode = (request.args.get('ack') or request.headers.get('X-QuickForm-Ack') or SUBMIT_QUEUE_ACK).lower()
+    return mode if mode in (ACK_DURABLE, ACK_FAST) else ACK_DURABLE
+
+
+# /all 接口：每次从游标取出的行数、分页模式下单页最大条数
+SUBMISSION_STREAM_YIELD_PER = 500
+SUBMISSION_PAGE_MAX_LIMIT = 5000
+
+
+def _submission_to_dict(raw, submitted_at):
+    """把一条提交记录转换为接口返回的字典（兼容双重编码和无法解析的数据）"""
+    submitted_text = submitted_at.strftime('%Y-%m-%d %H:%M:%S') if submitted_at else ''
+    try:
+        # 尝试解析JSON数据
+        data = json.loads(raw)
+        # 如果解析后是字符串，可能是双重编码，再解析一次
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except:
+                pass
+        data['submitted_at'] = submitted_text
+        return data
+    except (json.JSONDecodeError, TypeError):
+        # 如果解析失败，返回原始数据作为raw_data
+        return {
+            'submitted_at': submitted_text,
+            'raw_data': raw
+        }
 
 
 @quickform_bp.route('/api/<string:task_id>', methods=['GET', 'POST', 'OPTIONS'])
@@ -1565,7 +1702,7 @@ def submit_form(task_id):
         
     db = SessionLocal()
     try:
-        task = db.query(Task).filter_by(task_id=task_id).first()
+        task = task_lookup_cache.get(db, Task, task_id)
         if not task:
             response = jsonify({'error': '任务不存在', 'task_id': task_id, 'message': f'未找到ID为 {task_id} 的任务'})
             response.headers['Access-Control-Allow-Origin'] = '*'
@@ -1577,27 +1714,9 @@ def submit_form(task_id):
         # GET方法：返回任务数据统计（只返回最新的3条）
         if request.method == 'GET':
             # 只获取最新的3条数据
-            submissions = db.query(Submission).filter_by(task_id=task.id).order_by(Submission.submitted_at.desc()).limit(3).all()
-            total_count = db.query(Submission).filter_by(task_id=task.id).count()
-            data_list = []
-            for sub in submissions:
-                try:
-                    # 尝试解析JSON数据
-                    data = json.loads(sub.data)
-                    # 如果解析后是字符串，可能是双重编码，再解析一次
-                    if isinstance(data, str):
-                        try:
-                            data = json.loads(data)
-                        except:
-                            pass
-                    data['submitted_at'] = sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S')
-                    data_list.append(data)
-                except (json.JSONDecodeError, TypeError):
-                    # 如果解析失败，返回原始数据作为raw_data
-                    data_list.append({
-                        'submitted_at': sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S'),
-                        'raw_data': sub.data
-                    })
+            submissions = db.query(Submission).filter_by(task_id=task.id).order_by(Submission.id.desc()).limit(3).all()
+            total_count = db.query(Task.submission_count).filter(Task.id == task.id).scalar() or 0
+            data_list = [_submission_to_dict(sub.data, sub.submitted_at) for sub in submissions]
             
             # 构建/all路由的完整URL
             base_url = request.url.rstrip('/')
@@ -1616,18 +1735,16 @@ def submit_form(task_id):
         
         # POST方法：提交数据
         client_ip = request.headers.get('X-Forwarded-For', request.remote_addr)
-        now_ts = datetime.utcnow().timestamp()
+        now_ts = time.time()
 
-        ip_info = rate_limit_cache.setdefault(client_ip, {
-            'events': deque(),
-            'blacklist_until': 0,
-            'blocked_tasks': {}
-        })
+        limit_key = (task.id, client_ip)
+        limit_window, limit_threshold, blacklist_seconds = _task_rate_limit_config(task)
 
         # 检查黑名单
-        if ip_info['blacklist_until'] and now_ts < ip_info['blacklist_until']:
+        blacklist_until = rate_limit_cache.ban_until(limit_key, now_ts)
+        if blacklist_until:
             logger.warning(f"IP {client_ip} 正在黑名单中，拒绝 task_id={task_id} 的提交")
-            return _rate_limit_response(task_id, client_ip, now_ts, db)
+            return _rate_limit_response(task, client_ip, now_ts, blacklist_until, limit_window)
         
         # 获取提交的数据
         try:
@@ -1644,24 +1761,51 @@ def submit_form(task_id):
             return response, 400
         
         # 速率限制处理
-        events: Deque = ip_info['events']
-        while events and now_ts - events[0] > SUBMIT_RATE_LIMIT_WINDOW:
-            events.popleft()
-        events.append(now_ts)
-
-        if len(events) > SUBMIT_RATE_LIMIT_THRESHOLD:
-            ip_info['blacklist_until'] = now_ts + SUBMIT_BLACKLIST_DURATION
-            ip_info['blocked_tasks'][task.id] = now_ts
+        banned, recent_count, blacklist_until = rate_limit_cache.hit(
+            limit_key, limit_window, limit_threshold, blacklist_seconds, now_ts
+        )
+        if banned:
             logger.warning(
-                f"IP {client_ip} 在 {SUBMIT_RATE_LIMIT_WINDOW}s 内提交 {len(events)} 次，已加入黑名单 {SUBMIT_BLACKLIST_DURATION}s"
+                f"IP {client_ip} 在 {limit_window}s 内提交约 {recent_count:.0f} 次，已加入黑名单 {blacklist_seconds}s"
             )
-            return _rate_limit_response(task_id, client_ip, now_ts, db)
+            return _rate_limit_response(task, client_ip, now_ts, blacklist_until, limit_window)
         
+        data_text = json.dumps(form_data, ensure_ascii=False)
+
+        # 写入队列模式：入队后由后台线程批量落库
+        if submission_queue is not None and submission_queue.running:
+            ack_mode = _submit_ack_mode()
+            item = submission_queue.submit(task.id, data_text, wait=(ack_mode == ACK_DURABLE))
+            if item is not None:
+                # 等待批次提交前先归还连接，避免读事务挡住刷写线程（SQLite 写锁）
+                db.close()
+                status_code = 200
+                payload = {'message': '提交成功', 'status': 'success'}
+                if ack_mode == ACK_FAST:
+                    payload['queued'] = True
+                elif not item.done.wait(SUBMIT_QUEUE_ACK_TIMEOUT):
+                    # 已入队但未在等待时间内提交，数据仍会写入
+                    payload['queued'] = True
+                    status_code = 202
+                elif item.error is not None:
+                    payload = {'error': '保存失败', 'message': str(item.error)}
+                    status_code = 500
+                response = jsonify(payload)
+                response.headers['Access-Control-Allow-Origin'] = '*'
+                response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+                response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+                return response, status_code
+            logger.warning(f"提交写入队列已满，task_id={task_id} 回退为同步写入")
+
         # 将数据转换为JSON字符串存储
         try:
-            submission = Submission(task_id=task.id, data=json.dumps(form_data, ensure_ascii=False))
+            submitted_at = datetime.now()
+            submission = Submission(task_id=task.id, data=data_text, submitted_at=submitted_at)
             db.add(submission)
+            bump_submission_count(db, Task, task.id, 1, submitted_at)
             db.commit()
+            if field_stats_updater is not None:
+                field_stats_updater.mark(task.id)
         except Exception as e:
             db.rollback()
             logger.error(f"保存提交数据失败: {str(e)}")
@@ -1687,22 +1831,22 @@ def submit_form(task_id):
         db.close()
 
 
-def _rate_limit_response(task_id, client_ip, ts, db):
-    if db:
-        task = db.query(Task).filter_by(task_id=task_id).first()
-        if task:
-            notice = f"IP {client_ip} 在 {SUBMIT_RATE_LIMIT_WINDOW}s 内多次提交，已暂时封禁 {SUBMIT_BLACKLIST_DURATION // 60} 分钟"
-            log_entry = f"[{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}] {notice}"
-            existing = task.rate_limit_log or ''
-            if existing:
-                task.rate_limit_log = existing + '\n' + log_entry
-            else:
-                task.rate_limit_log = log_entry
-            try:
-                db.commit()
-            except Exception as e:
-                db.rollback()
-                logger.error(f"记录限流日志失败: {str(e)}")
+def _task_rate_limit_config(task):
+    """任务的提交限流配置 (窗口秒数, 阈值, 封禁秒数)，未配置的项使用全局默认值"""
+    return (
+        task.rate_limit_window or SUBMIT_RATE_LIMIT_WINDOW,
+        task.rate_limit_threshold or SUBMIT_RATE_LIMIT_THRESHOLD,
+        task.rate_limit_blacklist_seconds or SUBMIT_BLACKLIST_DURATION,
+    )
+
+
+def _rate_limit_response(task, client_ip, ts, blacklist_until, window_seconds=SUBMIT_RATE_LIMIT_WINDOW):
+    if task and rate_limit_event_log is not None:
+        # 只登记到内存，由后台线程批量写入 rate_limit_event 表
+        started_ts = time.time()
+        rate_limit_event_log.record(
+            task.id, client_ip, started_ts, started_ts + max(blacklist_until - ts, 0), window_seconds
+        )
  
     response = jsonify({'error': 'rate_limit', 'message': '提交过于频繁，请稍后再试'})
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -1712,7 +1856,12 @@ def _rate_limit_response(task_id, client_ip, ts, db):
 
 @quickform_bp.route('/api/<string:task_id>/all', methods=['GET', 'OPTIONS'])
 def submit_form_all(task_id):
-    """获取任务的全部提交数据"""
+    """获取任务的全部提交数据（流式输出）
+
+    - 默认输出与原来相同结构的 JSON 对象，submissions 数组边查边写
+    - ?format=ndjson：每行一条提交数据
+    - ?after_id=&limit=：按提交ID倒序的游标分页，响应中的 next_after_id 即下一页的 after_id
+    """
     if request.method == 'OPTIONS':
         response = make_response()
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -1721,9 +1870,15 @@ def submit_form_all(task_id):
         response.headers['Content-Type'] = 'text/plain; charset=utf-8'
         return response
     
+    output_format = (request.args.get('format') or 'json').lower()
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, SUBMISSION_PAGE_MAX_LIMIT))
+
     db = SessionLocal()
     try:
-        task = db.query(Task).filter_by(task_id=task_id).first()
+        task = task_lookup_cache.get(db, Task, task_id)
         if not task:
             response = jsonify({'error': '任务不存在', 'task_id': task_id, 'message': f'未找到ID为 {task_id} 的任务'})
             response.headers['Access-Control-Allow-Origin'] = '*'
@@ -1732,40 +1887,23 @@ def submit_form_all(task_id):
             logger.warning(f"请求失败: 任务不存在 - task_id: {task_id}")
             return response, 404
         
-        # 返回全部数据
-        submissions = db.query(Submission).filter_by(task_id=task.id).order_by(Submission.submitted_at.desc()).all()
-        data_list = []
-        for sub in submissions:
-            try:
-                # 尝试解析JSON数据
-                data = json.loads(sub.data)
-                # 如果解析后是字符串，可能是双重编码，再解析一次
-                if isinstance(data, str):
-                    try:
-                        data = json.loads(data)
-                    except:
-                        pass
-                data['submitted_at'] = sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S')
-                data_list.append(data)
-            except (json.JSONDecodeError, TypeError):
-                # 如果解析失败，返回原始数据作为raw_data
-                data_list.append({
-                    'submitted_at': sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    'raw_data': sub.data
-                })
-        
-        total_count = len(data_list)
-        response = jsonify({
-            'note': f'当前共有 {total_count} 条数据',
-            'task_id': task.task_id,
-            'task_title': task.title,
-            'total_submissions': total_count,
-            'submissions': data_list
-        })
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        return response, 200
+        task_pk = task.id
+        public_task_id = task.task_id
+        task_title = task.title
+        total_count = db.query(Task.submission_count).filter(Task.id == task_pk).scalar() or 0
+
+        id_query = db.query(Submission.id).filter(Submission.task_id == task_pk)
+        if after_id is not None:
+            id_query = id_query.filter(Submission.id < after_id)
+
+        # 分页模式：先在索引上取出本页最后一条和下一条的ID，判断是否还有下一页
+        next_after_id = None
+        last_id = None
+        if limit is not None:
+            boundary = [row[0] for row in id_query.order_by(Submission.id.desc()).offset(limit - 1).limit(2).all()]
+            last_id = boundary[0] if boundary else None
+            if len(boundary) > 1:
+                next_after_id = boundary[0]
     except Exception as e:
         logger.error(f"API异常: {str(e)}", exc_info=True)
         response = jsonify({'error': '服务器错误', 'message': str(e)})
@@ -1776,6 +1914,66 @@ def submit_form_all(task_id):
     finally:
         db.close()
 
+    def iter_rows():
+        """在独立会话中用服务端游标逐批读取，只取需要的列"""
+        stream_db = SessionLocal()
+        try:
+            query = (
+                stream_db.query(Submission.id, Submission.data, Submission.submitted_at)
+                .filter(Submission.task_id == task_pk)
+            )
+            if after_id is not None:
+                query = query.filter(Submission.id < after_id)
+            if last_id is not None:
+                query = query.filter(Submission.id >= last_id)
+            query = query.order_by(Submission.id.desc())
+            if limit is not None:
+                query = query.limit(limit)
+            query = query.execution_options(stream_results=True, yield_per=SUBMISSION_STREAM_YIELD_PER)
+            for sub_id, raw, submitted_at in query:
+                yield _submission_to_dict(raw, submitted_at)
+        finally:
+            stream_db.close()
+
+    def generate_json():
+        head = {
+            'note': f'当前共有 {total_count} 条数据',
+            'task_id': public_task_id,
+            'task_title': task_title,
+            'total_submissions': total_count,
+        }
+        yield json.dumps(head, ensure_ascii=False)[:-1] + ', "submissions": ['
+        first = True
+        try:
+            for item in iter_rows():
+                yield ('' if first else ',') + json.dumps(item, ensure_ascii=False)
+                first = False
+        except Exception as e:
+            # 响应头已发出，只能记录日志并尽量输出合法的 JSON 结尾
+            logger.error(f"流式输出提交数据失败 - task_id: {task_id}: {str(e)}", exc_info=True)
+        tail = {'next_after_id': next_after_id} if limit is not None else {}
+        yield ']' + (', ' + json.dumps(tail)[1:-1] if tail else '') + '}'
+
+    def generate_ndjson():
+        try:
+            for item in iter_rows():
+                yield json.dumps(item, ensure_ascii=False) + '\n'
+        except Exception as e:
+            logger.error(f"流式输出提交数据失败 - task_id: {task_id}: {str(e)}", exc_info=True)
+
+    if output_format == 'ndjson':
+        response = Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    else:
+        response = Response(stream_with_context(generate_json()), mimetype='application/json')
+    response.headers['X-Total-Count'] = str(total_count)
+    if next_after_id is not None:
+        response.headers['X-Next-After-Id'] = str(next_after_id)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Total-Count, X-Next-After-Id'
+    return response, 200
+
 @quickform_bp.route('/api/tasks', methods=['GET'])
 def list_tasks():
     """返回最近的任务列表，便于获取 task_id 进行API测试"""
@@ -1805,10 +2003,91 @@ def list_tasks():
     finally:
         db.close()
 
+def _has_export_access(db, task):
+    """导出权限：管理员、任务所有者、组织成员、被共享者可以导出数据"""
+    if current_user.is_admin() or task.user_id == current_user.id:
+        return True
+    if task.organization_id:
+        # 检查是否是组织成员
+        return db.query(OrganizationMember).filter_by(
+            organization_id=task.organization_id,
+            user_id=current_user.id
+        ).first() is not None
+    # 检查是否被共享
+    return db.query(TaskShare).filter_by(
+        task_id=task.id,
+        user_id=current_user.id
+    ).first() is not None
+
+
+def _export_filename(title, extension):
+    return f"{title}_数据导出_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+
+def _export_headers(response, filename, extension):
+    response.headers['Content-Disposition'] = (
+        f"attachment; filename=\"export.{extension}\"; filename*=UTF-8''{quote(filename)}"
+    )
+    return response
+
+
+def _task_field_stats(task_pk):
+    """读取任务字段统计（未就绪时重建）；出错时返回 None，提示词改为逐条统计"""
+    try:
+        return load_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_pk)
+    except Exception as e:
+        logger.warning(f"读取字段统计失败，改为逐条统计 - Task ID: {task_pk}, 错误: {str(e)}")
+        return None
+
+
+@quickform_bp.route('/task/<int:task_id>/field_stats')
+@login_required
+def task_field_stats(task_id):
+    """任务字段统计（JSON，供图表使用）：每个字段的出现次数、数值汇总、布尔计数和常见值"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'success': False, 'message': '任务不存在'}), 404
+        if not _has_export_access(db, task):
+            return jsonify({'success': False, 'message': '无权访问此数据'}), 403
+    finally:
+        db.close()
+
+    field_stats = _task_field_stats(task_id)
+    if field_stats is None:
+        return jsonify({'success': False, 'message': '字段统计暂不可用'}), 500
+    fields = []
+    names = field_stats['fields'] if isinstance(field_stats['fields'], list) else []
+    # 先按第一条提交的字段顺序，其余字段按名称排在后面
+    names = names + sorted(name for name in field_stats['stats'] if name not in names)
+    for name in names:
+        stat = field_stats['stats'].get(name)
+        if not stat:
+            continue
+        numeric_count = stat['numeric_count']
+        mean = stat['numeric_sum'] / numeric_count if numeric_count else None
+        variance = max(stat['numeric_sumsq'] / numeric_count - mean * mean, 0.0) if numeric_count else None
+        fields.append({
+            'field': name,
+            'count': stat['count'],
+            'numeric_count': numeric_count,
+            'min': stat['numeric_min'],
+            'max': stat['numeric_max'],
+            'mean': mean,
+            'std': math.sqrt(variance) if variance is not None else None,
+            'true_count': stat['true_count'],
+            'false_count': stat['false_count'],
+            'text_count': stat['text_count'],
+            'top_values': [{'value': value, 'count': count} for value, count in stat['top_values'][:20]],
+        })
+    return jsonify({'success': True, 'fields': fields})
+
+
 @quickform_bp.route('/export/<int:task_id>')
 @login_required
 def export_data(task_id):
-    """导出数据"""
+    """导出数据（?format=xlsx|csv|ndjson，默认 xlsx）"""
     db = SessionLocal()
     try:
         task = db.get(Task, task_id)
@@ -1816,67 +2095,136 @@ def export_data(task_id):
             flash('任务不存在', 'danger')
             return redirect(url_for('quickform.dashboard'))
         
-        # 权限检查：管理员、任务所有者、组织成员、被共享者可以导出数据
-        has_access = False
-        if current_user.is_admin() or task.user_id == current_user.id:
-            has_access = True
-        elif task.organization_id:
-            # 检查是否是组织成员
-            is_org_member = db.query(OrganizationMember).filter_by(
-                organization_id=task.organization_id,
-                user_id=current_user.id
-            ).first() is not None
-            if is_org_member:
-                has_access = True
-        else:
-            # 检查是否被共享
-            is_shared = db.query(TaskShare).filter_by(
-                task_id=task.id,
-                user_id=current_user.id
-            ).first() is not None
-            if is_shared:
-                has_access = True
-        
-        if not has_access:
+        if not _has_export_access(db, task):
             flash('无权访问此数据', 'danger')
             return redirect(url_for('quickform.dashboard'))
         
-        submission = db.query(Submission).filter_by(task_id=task.id).all()
-        
-        if not submission:
+        export_format = (request.args.get('format') or 'xlsx').lower()
+        if export_format not in EXPORT_FORMATS:
+            flash(f'不支持的导出格式: {export_format}', 'danger')
+            return redirect(url_for('quickform.task_detail', task_id=task_id))
+
+        # 导出截止到当前最后一条提交：扫描列名和读取数据两次查询覆盖相同的提交，
+        # 期间新到的提交不会只出现在数据中而缺少对应的列
+        max_id = db.query(func.max(Submission.id)).filter(Submission.task_id == task.id).scalar()
+        if max_id is None:
             flash('没有可导出的数据', 'info')
             return redirect(url_for('quickform.task_detail', task_id=task_id))
-        
-        data_list = []
-        for sub in submission:
-            try:
-                data = json.loads(sub.data)
-                data['submitted_at'] = sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S')
-                data_list.append(data)
-            except:
-                data_list.append({
-                    'submitted_at': sub.submitted_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    'raw_data': sub.data
-                })
-        
-        df = pd.DataFrame(data_list)
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='提交数据')
-        output.seek(0)
-        
-        filename = f"{task.title}_数据导出_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        try:
-            return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        except TypeError:
-            return send_file(output, attachment_filename=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+        task_pk = task.id
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        filename = _export_filename(task.title, extension)
     except Exception as e:
         flash(f'导出数据时出错: {str(e)}', 'danger')
         return redirect(url_for('quickform.task_detail', task_id=task_id))
     finally:
         db.close()
 
+    # 数据没有变化时，直接返回后台导出已生成的文件
+    if export_job_manager is not None:
+        cached_path = export_job_manager.cached_artifact(task_pk, export_format)
+        if cached_path:
+            return _export_headers(send_file(cached_path, mimetype=mimetype, conditional=True), filename, extension)
+
+    # 流式输出：边从数据库（或列式快照）分批读取边生成文件，内存占用与数据量无关
+    def generate():
+        snapshot = None
+        try:
+            if snapshot_store is not None and export_format != 'ndjson':
+                snapshot = snapshot_store.reader(task_pk, max_id=max_id)
+            for chunk in iter_export(SessionLocal, Submission, task_pk, export_format, max_id=max_id, snapshot=snapshot):
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            # 响应头已发出，只能记录日志（客户端会收到不完整的文件）
+            logger.error(f"流式导出失败 - Task ID: {task_pk}, 格式: {export_format}, 错误: {str(e)}", exc_info=True)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    response = Response(stream_with_context(generate()), content_type=mimetype)
+    # 关闭 Nginx 代理缓冲，数据生成后立即发给客户端
+    response.headers['X-Accel-Buffering'] = 'no'
+    return _export_headers(response, filename, extension)
+
+
+@quickform_bp.route('/export/<int:task_id>/jobs', methods=['POST'])
+@login_required
+def export_job_create(task_id):
+    """创建后台导出任务（?format=xlsx|csv|ndjson）；数据未变化时直接返回已生成的文件"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'success': False, 'message': '任务不存在'}), 404
+        if not _has_export_access(db, task):
+            return jsonify({'success': False, 'message': '无权访问此数据'}), 403
+    finally:
+        db.close()
+
+    if export_job_manager is None:
+        return jsonify({'success': False, 'message': '后台导出未启用'}), 503
+    export_format = (request.args.get('format') or 'xlsx').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': f'不支持的导出格式: {export_format}'}), 400
+
+    try:
+        status = export_job_manager.request(task_id, export_format)
+    except Exception as e:
+        logger.error(f"创建导出任务失败 - Task ID: {task_id}, 错误: {str(e)}", exc_info=True)
+        return jsonify({'success': False, 'message': f'创建导出任务失败: {str(e)}'}), 500
+    if status.get('total') == 0:
+        return jsonify({'success': False, 'message': '没有可导出的数据'}), 400
+    return jsonify(dict(status, success=True,
+                        status_url=url_for('quickform.export_job_status', task_id=task_id, job_id=status['job_id']),
+                        download_url=url_for('quickform.export_job_download', task_id=task_id, job_id=status['job_id'])))
+
+
+@quickform_bp.route('/export/<int:task_id>/jobs/<job_id>')
+@login_required
+def export_job_status(task_id, job_id):
+    """查询后台导出任务进度"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'success': False, 'message': '任务不存在'}), 404
+        if not _has_export_access(db, task):
+            return jsonify({'success': False, 'message': '无权访问此数据'}), 403
+    finally:
+        db.close()
+
+    status = export_job_manager.status(task_id, job_id) if export_job_manager is not None else None
+    if status is None:
+        return jsonify({'success': False, 'message': '导出任务不存在或已过期'}), 404
+    return jsonify(dict(status, success=True))
+
+
+@quickform_bp.route('/export/<int:task_id>/jobs/<job_id>/download')
+@login_required
+def export_job_download(task_id, job_id):
+    """下载后台导出任务生成的文件"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            flash('任务不存在', 'danger')
+            return redirect(url_for('quickform.dashboard'))
+        if not _has_export_access(db, task):
+            flash('无权访问此数据', 'danger')
+            return redirect(url_for('quickform.dashboard'))
+        title = task.title
+    finally:
+        db.close()
+
+    path, export_format = export_job_manager.artifact_for(task_id, job_id) if export_job_manager is not None else (None, None)
+    if not path:
+        flash('导出文件不存在或已过期，请重新导出', 'warning')
+        return redirect(url_for('quickform.task_detail', task_id=task_id))
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return _export_headers(send_file(path, mimetype=mimetype, conditional=True),
+                           _export_filename(title, extension), extension)
+
 @quickform_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
@@ -2102,7 +2450,9 @@ def test_ai_api():
             test_prompt = '这是一次连通性测试，请简短回复“OK”。'
 
         try:
-            response_text = call_ai_model(test_prompt, ai_config)
+            # 测试连通性，不能返回缓存的结果；超过 AI_TEST_DEADLINE 秒直接返回失败，不占着请求线程
+            with call_scope(AI_TEST_DEADLINE):
+                response_text = call_ai_model(test_prompt, ai_config, use_cache=False)
         except Exception as e:
             logger.error(f"AI配置测试失败: {str(e)}")
             return jsonify({'success': False, 'message': str(e)}), 500
@@ -2128,7 +2478,7 @@ def smart_analyze(task_id):
     """智能分析"""
     db = SessionLocal()
     try:
-        task = db.get(Task, task_id)
+        task = db.get(Task, task_id, options=[undefer_group('report')])
         if not task:
             flash('任务不存在', 'danger')
             return redirect(url_for('quickform.dashboard'))
@@ -2164,6 +2514,8 @@ def smart_analyze(task_id):
             return render_template('smart_analyze.html', task=task, error="请先在配置页面设置AI模型和API密钥", ai_config=ai_config, now=datetime.now(), model_label=None)
         
         model_label = MODEL_LABELS.get(ai_config.selected_model, ai_config.selected_model)
+        # 生成提示词时按该服务商的 token 预算压缩样例（services.prompt_budget）
+        token_budget = prompt_token_budget(ai_config.selected_model)
         
         if ai_config.selected_model == 'chat_server':
             if not current_app.config.get('CHAT_SERVER_API_TOKEN'):
@@ -2191,8 +2543,7 @@ def smart_analyze(task_id):
                 return redirect(url_for('quickform.smart_analyze', task_id=task.id))
             
             # 生成报告的逻辑
-            # 获取提交数据并生成完整提示词
-            submission_for_prompt = db.query(Submission).filter_by(task_id=task_id).all()
+            # 生成完整提示词（只从数据库读取总数和样例行，见 services.sampling）
             file_content_for_prompt = None
             if task.file_path and os.path.exists(task.file_path):
                 file_content_for_prompt = read_file_content(task.file_path)
@@ -2205,30 +2556,38 @@ def smart_analyze(task_id):
             else:
                 # 使用用户模板（如果有）生成完整提示词
                 user_template = task.user_prompt_template if task.user_prompt_template else None
-                custom_prompt = generate_analysis_prompt(task, submission_for_prompt, file_content_for_prompt, SessionLocal, Submission, user_template=user_template)
+                custom_prompt = generate_analysis_prompt(task, None, file_content_for_prompt, SessionLocal, Submission, user_template=user_template, field_stats=_task_field_stats(task.id),
+                                                         token_budget=token_budget, provider=ai_config.selected_model)
             
             # 保存完整提示词（用于兼容旧代码）
             task.custom_prompt = custom_prompt
             db.commit()
             
+            # 勾选“强制重新生成”时不使用缓存的报告
+            force_regenerate = request.form.get('force_regenerate') == '1'
+            # 勾选“分批汇总全部数据”时先分块汇总全部提交（services.chunked_analysis）
+            chunked = request.form.get('chunked') == '1'
+            
             try:
-                # 后台线程执行，避免阻塞主请求线程
-                t = threading.Thread(target=perform_analysis_with_custom_prompt, args=(
+                # 交给 AI 任务执行器排队执行，避免阻塞主请求线程
+                start_analysis_job(
+                    ai_executor, ai_config.selected_model,
                     task_id, current_user.id, ai_config.id, custom_prompt,
                     SessionLocal, Task, Submission, AIConfig,
-                    read_file_content, call_ai_model, save_analysis_report
-                ), daemon=True)
-                t.start()
+                    read_file_content, call_ai_model, save_analysis_report,
+                    use_cache=not force_regenerate, chunked=chunked
+                )
                 # 跳转到本页并标记运行中，前端据此开始轮询
                 return redirect(url_for('quickform.smart_analyze', task_id=task.id, running=1))
+            except QueueFull as e:
+                return render_template('smart_analyze.html', task=task, error=str(e), ai_config=ai_config, now=datetime.now(), model_label=model_label)
             except Exception as e:
                 return render_template('smart_analyze.html', task=task, error=f'生成报告失败: {str(e)}', ai_config=ai_config, now=datetime.now(), model_label=model_label)
         
         # GET 或 POST 完成后，准备页面所需数据
         # 刷新task对象以获取最新的html_analysis和custom_prompt
         db.refresh(task)
-        submission = db.query(Submission).filter_by(task_id=task_id).all()
-        current_submission_count = len(submission)
+        current_submission_count = db.query(func.count(Submission.id)).filter(Submission.task_id == task_id).scalar() or 0
         file_content = None
         if task.file_path and os.path.exists(task.file_path):
             file_content = read_file_content(task.file_path)
@@ -2262,12 +2621,14 @@ def smart_analyze(task_id):
         # 使用用户模板（如果有）生成预览提示词
         user_template = task.user_prompt_template if task.user_prompt_template else None
         if should_regenerate_prompt:
-            preview_prompt = generate_analysis_prompt(task, submission, file_content, SessionLocal, Submission, user_template=user_template)
+            preview_prompt = generate_analysis_prompt(task, None, file_content, SessionLocal, Submission, user_template=user_template, field_stats=_task_field_stats(task.id),
+                                                      token_budget=token_budget, provider=ai_config.selected_model)
             # 更新保存的提示词（但不立即提交，让用户可以选择是否保存）
         else:
             # 如果数据条数没有变化，但用户模板可能已更新，使用用户模板重新生成
             if user_template:
-                preview_prompt = generate_analysis_prompt(task, submission, file_content, SessionLocal, Submission, user_template=user_template)
+                preview_prompt = generate_analysis_prompt(task, None, file_content, SessionLocal, Submission, user_template=user_template, field_stats=_task_field_stats(task.id),
+                                                          token_budget=token_budget, provider=ai_config.selected_model)
             else:
                 preview_prompt = task.custom_prompt
         
@@ -2277,8 +2638,7 @@ def smart_analyze(task_id):
         running_flag = request.args.get('running') == '1'
         should_redirect = False
         if running_flag:
-            with progress_lock:
-                prog = analysis_progress.get(task.id)
+            prog = get_analysis_progress(task.id)
             if prog and prog.get('status') == 'completed':
                 should_redirect = True
         if should_redirect:
@@ -2291,7 +2651,11 @@ def smart_analyze(task_id):
                              user_prompt_template=user_prompt_template,
                              ai_config=ai_config,
                              now=datetime.now(),
-                             model_label=model_label)
+                             model_label=model_label,
+                             submission_count=current_submission_count,
+                             chunked_default=current_submission_count >= CHUNKED_ANALYSIS_MIN_ROWS,
+                             prompt_tokens=estimate_tokens(preview_prompt, ai_config.selected_model),
+                             token_budget=token_budget)
     finally:
         db.close()
 
@@ -2301,7 +2665,7 @@ def download_report(task_id):
     """下载报告 - 图片格式（PNG）"""
     db = SessionLocal()
     try:
-        task = db.get(Task, task_id)
+        task = db.get(Task, task_id, options=[undefer_group('report')])
         if not task:
             flash('任务不存在', 'danger')
             return redirect(url_for('quickform.dashboard'))
@@ -2509,29 +2873,133 @@ def report_status(task_id):
         finally:
             db.close()
         
-        with progress_lock:
-            prog = analysis_progress.get(task_id)
-            if prog:
-                # 如果已完成且内存中有报告，直接返回报告
-                if prog.get('status') == 'completed':
-                    rep = analysis_results.get(task_id)
-                    return jsonify({'status': 'completed', 'report': rep or prog.get('report', '')}), 200
-                if prog.get('status') == 'error':
-                    return jsonify({'status': 'error', 'message': prog.get('message', '未知错误')}), 200
-                # 进行中
-                return jsonify({'status': 'in_progress', 'progress': prog.get('progress', 0), 'message': prog.get('message', '')}), 200
-        # 兜底：查数据库是否已有报告
+        prog = get_analysis_progress(task_id)
+        if prog and prog.get('status') != 'completed':
+            if prog.get('status') in ('error', 'cancelled'):
+                return jsonify({'status': prog['status'], 'message': prog.get('message', '未知错误')}), 200
+            # 进行中（排队时带 queue_position：前面还有几个任务）
+            result = {'status': 'in_progress', 'progress': prog.get('progress', 0), 'message': prog.get('message', '')}
+            if prog.get('queue_position') is not None:
+                result['queue_position'] = prog['queue_position']
+            return jsonify(result), 200
+        # 已完成（或没有分析记录）：报告正文在 task.analysis_report
         db = SessionLocal()
         try:
-            task = db.get(Task, task_id)
-            if task and task.analysis_report:
-                return jsonify({'status': 'completed', 'report': task.analysis_report}), 200
+            analysis_report = db.query(Task.analysis_report).filter(Task.id == task_id).scalar()
+            if analysis_report:
+                return jsonify({'status': 'completed', 'report': analysis_report}), 200
         finally:
             db.close()
         return jsonify({'status': 'not_started'}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@quickform_bp.route('/api/report_stream/<int:task_id>', methods=['GET'])
+@login_required
+def report_stream(task_id):
+    """以 Server-Sent Events 推送报告生成过程：
+    message 事件 {"delta": 新文本}（id 为已发送的字符数，断线重连时从 Last-Event-ID 继续）、
+    status 事件 {"progress", "message", "queue_position"}、
+    done 事件 {"status": completed / error / cancelled / not_started, "message"}
+
+    每个连接占用一个服务线程直到报告生成完（最长 REPORT_STREAM_MAX_SECONDS）；本进程的连接数达到上限时返回 503，
+    EventSource 不会重连，页面改为轮询 /api/report_status
+    """
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'status': 'error', 'message': '任务不存在'}), 404
+        if not _has_export_access(db, task):
+            return jsonify({'status': 'error', 'message': '无权访问此任务'}), 403
+    finally:
+        db.close()
+
+    try:
+        offset = max(0, int(request.headers.get('Last-Event-ID', '0')))
+    except ValueError:
+        offset = 0
+
+    def event(data, name=None, event_id=None):
+        lines = []
+        if name:
+            lines.append(f"event: {name}")
+        if event_id is not None:
+            lines.append(f"id: {event_id}")
+        lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+        return '\n'.join(lines) + '\n\n'
+
+    def generate():
+        sent = offset
+        last_status = None
+        last_output = time.monotonic()
+        deadline = last_output + REPORT_STREAM_MAX_SECONDS
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            prog = get_analysis_progress(task_id)
+            if prog is None:
+                yield event({'status': 'not_started'}, 'done')
+                return
+            text, _ = report_stream_hub.read(task_id, prog['id'], sent, timeout=1.0)
+            if text:
+                sent += len(text)
+                last_output = time.monotonic()
+                yield event({'delta': text}, event_id=sent)
+            if prog['status'] == 'in_progress':
+                status = (prog.get('progress'), prog.get('message'), prog.get('queue_position'))
+                if status != last_status:
+                    last_status = status
+                    last_output = time.monotonic()
+                    yield event({'progress': status[0], 'message': status[1], 'queue_position': status[2]}, 'status')
+                elif time.monotonic() - last_output > 15:
+                    # 心跳，避免代理因连接空闲而断开
+                    last_output = time.monotonic()
+                    yield ': keep-alive\n\n'
+                continue
+            # 分析已结束：发出剩余文本后结束
+            text, _ = report_stream_hub.read(task_id, prog['id'], sent, timeout=0)
+            if text:
+                sent += len(text)
+                yield event({'delta': text}, event_id=sent)
+            yield event({'status': prog['status'], 'message': prog.get('message', '')}, 'done')
+            return
+        yield event({'status': 'timeout'}, 'done')
+
+    if not report_stream_hub.acquire_reader():
+        logger.warning(f"SSE 连接数已达上限（{report_stream_hub.max_readers}），task={task_id} 改为轮询")
+        return jsonify({'status': 'busy', 'message': '实时输出连接已满，请稍候'}), 503
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    # 连接结束（包括客户端断开、生成器未开始执行）时释放名额
+    response.call_on_close(report_stream_hub.release_reader)
+    response.headers['Cache-Control'] = 'no-cache'
+    # 关闭 Nginx 代理缓冲，文本生成后立即发给客户端
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@quickform_bp.route('/api/report_cancel/<int:task_id>', methods=['POST'])
+@login_required
+def report_cancel(task_id):
+    """取消排队中或进行中的报告生成；进行中的调用在返回后丢弃结果"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'status': 'error', 'message': '任务不存在'}), 404
+        if not _has_export_access(db, task):
+            return jsonify({'status': 'error', 'message': '无权访问此任务'}), 403
+    finally:
+        db.close()
+
+    previous = ai_executor.cancel(('report', task_id)) if ai_executor is not None else None
+    # 排队中的任务已由执行器回调标记；进行中的任务立即标记，页面不必等模型返回。
+    # 任务在其他 worker 进程中时，该进程在开始调用前 / 返回后读取到记录已取消
+    marked = cancel_analysis_record(task_id)
+    if previous is None:
+        if not marked:
+            return jsonify({'status': 'error', 'message': '没有进行中的分析'}), 404
+        previous = 'remote'
+    return jsonify({'status': 'cancelled', 'previous': previous}), 200
+
 @quickform_bp.route('/admin')
 @admin_required
 def admin_panel():
@@ -2730,6 +3198,31 @@ def admin_panel():
         db.close()
 
 
+@quickform_bp.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    """运行指标（JSON）：提交队列、任务缓存、限流、共享状态后端、AI 连接池、进程线程数等"""
+    metrics = {
+        'submit_queue': submission_queue.stats() if submission_queue is not None else {'enabled': False},
+        'task_cache': task_lookup_cache.stats(),
+        'rate_limit_events': rate_limit_event_log.stats() if rate_limit_event_log is not None else {'enabled': False},
+        'submit_limiter': rate_limit_cache.stats(),
+        'state_backend': state_backend.stats(),
+        'limiter_404': current_app.extensions['quickform_404_limiter'].stats() if 'quickform_404_limiter' in current_app.extensions else {'enabled': False},
+        'export_jobs': export_job_manager.stats() if export_job_manager is not None else {'enabled': False},
+        'snapshots': snapshot_store.stats() if snapshot_store is not None else {'enabled': False},
+        'ai_http': ai_http.stats(),
+        'ai_executor': ai_executor.stats() if ai_executor is not None else {'enabled': False},
+        'analysis_jobs': analysis_job_store.stats() if analysis_job_store is not None else {'enabled': False},
+        'report_stream': report_stream_hub.stats(),
+        'ai_cache': ai_response_cache.stats() if ai_response_cache is not None else {'enabled': False},
+        'ai_calls': call_stats(),
+        'ai_usage': usage_stats(),
+        'field_stats': field_stats_updater.stats() if field_stats_updater is not None else {'enabled': False},
+    }
+    return jsonify(metrics)
+
+
 @quickform_bp.route('/admin/public_approve/<int:task_id>', methods=['POST'])
 @admin_required
 def admin_public_approve(task_id):
@@ -2881,6 +3374,8 @@ def admin_delete_user(user_id):
         try:
             db.delete(user)
             db.commit()
+            # 用户的任务随之删除，整体清空任务缓存
+            task_lookup_cache.clear()
             flash(f'已成功删除用户 {username} (ID: {user_id_val}) 及其所有相关数据', 'success')
             logger.info(f"管理员 {current_user.username} 删除了用户 {username} (ID: {user_id_val})")
         except Exception as e:
@@ -3516,6 +4011,53 @@ def admin_review_html_action(task_id):
     
     return redirect(url_for('quickform.admin_panel', tab='html-review'))
 
+@quickform_bp.route('/task/<int:task_id>/rate_limit_events', methods=['GET'])
+@login_required
+def task_rate_limit_events(task_id):
+    """任务当前仍在封禁期内的IP（按IP汇总，供任务详情页展示）"""
+    db = SessionLocal()
+    try:
+        task = db.get(Task, task_id)
+        if not task:
+            return jsonify({'success': False, 'message': '任务不存在'}), 404
+
+        # 权限检查：管理员、任务所有者、组织成员、被共享者
+        has_access = False
+        if current_user.is_admin() or task.user_id == current_user.id:
+            has_access = True
+        elif task.organization_id:
+            has_access = db.query(OrganizationMember).filter_by(
+                organization_id=task.organization_id,
+                user_id=current_user.id
+            ).first() is not None
+        else:
+            has_access = db.query(TaskShare).filter_by(
+                task_id=task.id,
+                user_id=current_user.id
+            ).first() is not None
+        if not has_access:
+            return jsonify({'success': False, 'message': '无权访问此任务'}), 403
+
+        now = datetime.now()
+        events = (
+            db.query(RateLimitEvent.ip, RateLimitEvent.created_at, RateLimitEvent.expires_at)
+            .filter(RateLimitEvent.task_id == task.id, RateLimitEvent.expires_at > now)
+            .order_by(RateLimitEvent.created_at)
+            .all()
+        )
+        blocks = {}
+        for ip, created_at, expires_at in events:
+            block = blocks.setdefault(ip, {'ip': ip, 'records': 0})
+            block['records'] += 1
+            block['blocked_at'] = created_at.strftime('%Y-%m-%d %H:%M:%S')
+            block['remaining_seconds'] = int((expires_at - now).total_seconds())
+        resp = jsonify({'success': True, 'blocks': list(blocks.values())})
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    finally:
+        db.close()
+
+
 @quickform_bp.route('/task/<int:task_id>/submission/remove', methods=['GET'])
 @login_required
 def remove_submission(task_id):
@@ -3552,7 +4094,11 @@ def remove_submission(task_id):
             )
             return make_response({'success': False, 'message': '提交不存在'}, 404)
         
+        removed_data = submission.data
         db.delete(submission)
+        db.flush()
+        refresh_submission_counts(db, Task, Submission, [task_id])
+        remove_field_stats(db, Task, Submission, TaskFieldStat, task_id, submission_id, removed_data)
         db.commit()
         logger.info(
             f"[remove_submission] success user={getattr(current_user, 'id', None)} task={task_id} submission={submission_id}"
@@ -3593,15 +4139,20 @@ def clear_all_submissions(task_id):
             )
             return make_response({'success': False, 'message': '无权访问此任务'}, 403)
         
-        submissions = db.query(Submission).filter_by(task_id=task_id).all()
-        count = len(submissions)
         logger.info(
-            f"[clear_all_submissions] deleting count={count} user={getattr(current_user, 'id', None)} task={task_id}"
+            f"[clear_all_submissions] deleting count={task.submission_count or 0} user={getattr(current_user, 'id', None)} task={task_id}"
         )
-        for submission in submissions:
-            db.delete(submission)
-        
+        count = (
+            db.query(Submission)
+            .filter_by(task_id=task_id)
+            .delete(synchronize_session=False)
+        )
+        task.submission_count = 0
+        task.last_submitted_at = None
+        reset_field_stats(db, Task, TaskFieldStat, task_id)
         db.commit()
+        if snapshot_store is not None:
+            snapshot_store.purge_task(task_id)
         logger.info(
             f"[clear_all_submissions] success user={getattr(current_user, 'id', None)} task={task_id} deleted={count}"
         )
@@ -3696,10 +4247,78 @@ def init_quickform(app, login_manager_instance=None, database_type=None):
         os.makedirs(os.path.join(UPLOAD_FOLDER, 'reports'))
     if not os.path.exists(CERTIFICATION_FOLDER):
         os.makedirs(CERTIFICATION_FOLDER)
-    
+
+    # 预加载 + fork 的部署方式（serve.py / gunicorn.conf.py）下，后台线程不在主进程启动，
+    # 由每个 worker 在 fork 之后调用 start_background_workers
+    if os.getenv('QUICKFORM_DEFER_BACKGROUND', 'false').lower() != 'true':
+        start_background_workers()
+
     logger.info("QuickForm Blueprint 初始化完成")
 
 
+def start_background_workers():
+    """创建分析任务记录和 AI 响应缓存，启动后台线程：字段统计合并、提交写入队列（可选）、限流事件写入、列式快照（可选）、导出任务、AI 任务执行器"""
+    global submission_queue, rate_limit_event_log, export_job_manager, snapshot_store, ai_executor, field_stats_updater
+    global analysis_job_store, ai_response_cache
+    if analysis_job_store is None:
+        analysis_job_store = AnalysisJobStore(SessionLocal, AnalysisJob)
+        configure_analysis_jobs(analysis_job_store)
+
+    if ai_response_cache is None:
+        ai_response_cache = AIResponseCache(SessionLocal, AICacheEntry)
+        configure_ai_cache(ai_response_cache)
+
+    if field_stats_updater is None:
+        field_stats_updater = FieldStatsUpdater(SessionLocal, Task, Submission, TaskFieldStat)
+        field_stats_updater.start()
+
+    if SUBMIT_QUEUE_ENABLED and submission_queue is None:
+        submission_queue = SubmissionWriteQueue(SessionLocal, Submission, Task, on_written=field_stats_updater.mark)
+        submission_queue.start()
+
+    if rate_limit_event_log is None:
+        rate_limit_event_log = RateLimitEventLog(SessionLocal, RateLimitEvent)
+        rate_limit_event_log.start()
+
+    if snapshot_store is None:
+        snapshot_store = SnapshotStore(SessionLocal, Task, Submission, SNAPSHOT_FOLDER, state_backend)
+        snapshot_store.start()
+
+    if export_job_manager is None:
+        export_job_manager = ExportJobManager(SessionLocal, Submission, EXPORT_FOLDER, state_backend,
+                                              snapshot_store=snapshot_store)
+
+    if ai_executor is None:
+        # 工作线程在第一个任务提交时创建
+        ai_executor = AIJobExecutor()
+
+
+def after_fork():
+    """worker 进程 fork 之后调用：丢弃从主进程继承的数据库连接，再启动本进程的后台线程"""
+    # close=False：不关闭父进程仍在使用的连接，只让本进程的连接池重新建立；
+    # 导入时创建、已被 init_quickform 替换的引擎也一并丢弃
+    for old_engine in _engines:
+        old_engine.dispose(close=False)
+    start_background_workers()
+
+
+def stop_background_workers(timeout=20):
+    """优雅退出：等待进行中的分析结束，写完提交队列和限流事件，中断未完成的导出"""
+    if ai_executor is not None:
+        ai_executor.stop(timeout)
+    ai_http.close()
+    if export_job_manager is not None:
+        export_job_manager.stop()
+    if snapshot_store is not None:
+        snapshot_store.stop()
+    if submission_queue is not None:
+        submission_queue.stop()
+    if rate_limit_event_log is not None:
+        rate_limit_event_log.stop()
+    if field_stats_updater is not None:
+        field_stats_updater.stop()
+
+
 # ==================== 组织管理路由 ====================
 
 @quickform_bp.route('/organization')
@@ -248,6 +248,9 @@ TRANSLATIONS = {
         
         # Task Detail页面
         'task_detail.export_data': '导出数据',
+        'task_detail.export_format': '选择导出格式',
+        'task_detail.export_preparing': '正在生成',
+        'task_detail.export_failed': '导出失败：',
         'task_detail.analyze': '数据分析',
         'task_detail.edit_task': '编辑任务',
         'task_detail.back_to_list': '返回列表',
@@ -495,6 +498,14 @@ TRANSLATIONS = {
         'smart_analyze.processing_tip': '分析过程不会超过两分钟，完成后会自动跳转至报告页面',
         'smart_analyze.waited': '已等待',
         'smart_analyze.seconds': '秒',
+        'smart_analyze.queued_tip': '排队中，前面还有 {n} 个分析任务',
+        'smart_analyze.cancel': '取消分析',
+        'smart_analyze.cancelled': '分析已取消',
+        'smart_analyze.force_regenerate': '强制重新生成（不使用缓存的报告）',
+        'smart_analyze.force_regenerate_hint': '提示词和模型都没有变化时会直接返回上次的结果；勾选后重新调用大模型。',
+        'smart_analyze.chunked': '分批汇总全部数据（数据量大时推荐）',
+        'smart_analyze.chunked_hint': '共 {n} 条提交。先把全部提交分批交给大模型汇总，再据此生成报告，耗时更长；没有变化的批次会直接复用上次的汇总。',
+        'smart_analyze.prompt_tokens': '提示词约 {n} tokens（预算 {budget}）。超出预算时会自动精简数据样例和 HTML 分析结果。',
         'smart_analyze.current_model': '当前使用',
         'smart_analyze.model_not_configured': '未配置',
         'smart_analyze.change_api_token': '修改API Token',
@@ -765,6 +776,9 @@ TRANSLATIONS = {
         
         # Task Detail頁面
         'task_detail.export_data': '導出數據',
+        'task_detail.export_format': '選擇導出格式',
+        'task_detail.export_preparing': '正在生成',
+        'task_detail.export_failed': '導出失敗：',
         'task_detail.analyze': '數據分析',
         'task_detail.edit_task': '編輯任務',
         'task_detail.back_to_list': '返回列表',
@@ -839,6 +853,14 @@ TRANSLATIONS = {
         'smart_analyze.processing_tip': '分析過程不會超過兩分鐘，完成後會自動跳轉至報告頁面',
         'smart_analyze.waited': '已等待',
         'smart_analyze.seconds': '秒',
+        'smart_analyze.queued_tip': '排隊中，前面還有 {n} 個分析任務',
+        'smart_analyze.cancel': '取消分析',
+        'smart_analyze.cancelled': '分析已取消',
+        'smart_analyze.force_regenerate': '強制重新生成（不使用快取的報告）',
+        'smart_analyze.force_regenerate_hint': '提示詞和模型都沒有變化時會直接返回上次的結果；勾選後重新調用大模型。',
+        'smart_analyze.chunked': '分批匯總全部資料（資料量大時推薦）',
+        'smart_analyze.chunked_hint': '共 {n} 條提交。先把全部提交分批交給大模型匯總，再據此生成報告，耗時更長；沒有變化的批次會直接複用上次的匯總。',
+        'smart_analyze.prompt_tokens': '提示詞約 {n} tokens（預算 {budget}）。超出預算時會自動精簡資料樣例和 HTML 分析結果。',
         'smart_analyze.current_model': '當前使用',
         'smart_analyze.model_not_configured': '未配置',
         'smart_analyze.change_api_token': '修改API Token',
@@ -1347,6 +1369,9 @@ TRANSLATIONS = {
         
         # Task Detail页面
         'task_detail.export_data': 'Export Data',
+        'task_detail.export_format': 'Choose export format',
+        'task_detail.export_preparing': 'Preparing',
+        'task_detail.export_failed': 'Export failed: ',
         'task_detail.analyze': 'Data Analysis',
         'task_detail.edit_task': 'Edit Task',
         'task_detail.back_to_list': 'Back to List',
@@ -1421,6 +1446,14 @@ TRANSLATIONS = {
         'smart_analyze.processing_tip': 'The analysis should take no more than 2 minutes. You will be redirected to the report page when it is ready.',
         'smart_analyze.waited': 'Waited',
         'smart_analyze.seconds': 'seconds',
+        'smart_analyze.queued_tip': 'Queued: {n} analysis job(s) ahead of yours',
+        'smart_analyze.cancel': 'Cancel analysis',
+        'smart_analyze.cancelled': 'The analysis was cancelled',
+        'smart_analyze.force_regenerate': 'Force regenerate (do not use the cached report)',
+        'smart_analyze.force_regenerate_hint': 'If the prompt and model are unchanged, the previous result is returned instantly; check this to call the model again.',
+        'smart_analyze.chunked': 'Summarize all submissions in batches (recommended for large tasks)',
+        'smart_analyze.chunked_hint': '{n} submissions. All submissions are first summarized batch by batch, then the report is written from those summaries. This takes longer; unchanged batches reuse their previous summaries.',
+        'smart_analyze.prompt_tokens': 'Prompt is about {n} tokens (budget {budget}). Data samples and the HTML analysis are condensed automatically when over budget.',
         'smart_analyze.current_model': 'Current model:',
         'smart_analyze.model_not_configured': 'Not configured',
         'smart_analyze.change_api_token': 'Update API Token',
@@ -1,12 +1,13 @@
 """数据库模型定义和迁移"""
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, inspect, text, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float, inspect, text, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 import secrets
 import string
+import re
 import logging
 
 logger = logging.getLogger(__name__)
@@ -61,6 +62,9 @@ class User(UserMixin, Base):
 
 
 class Task(Base):
+    # 大文本字段按组延迟加载（列表页和提交接口不读取），详情/分析/下载页面按需 undefer_group：
+    #   report  分析报告与提示词
+    #   html    HTML 文件分析结果与多文件列表
     __tablename__ = 'task'
     id = Column(Integer, primary_key=True)
     title = Column(String(200), nullable=False)
@@ -72,17 +76,16 @@ class Task(Base):
     file_name = Column(String(200))
     file_path = Column(String(500))
     task_id = Column(String(50), unique=True, default=lambda: secrets.token_urlsafe(8))
-    analysis_report = Column(Text)
+    analysis_report = deferred(Column(Text), group='report')
     report_file_path = Column(String(500))
     report_generated_at = Column(DateTime)
-    html_analysis = Column(Text)  # 存储HTML文件的AI分析结果
+    html_analysis = deferred(Column(Text), group='html')  # 存储HTML文件的AI分析结果
     html_approved = Column(Integer, default=0)  # HTML审核状态：0=待审核，1=已通过，-1=已拒绝
     html_approved_by = Column(Integer, ForeignKey('user.id'), nullable=True)  # 审核人ID
     html_approved_at = Column(DateTime, nullable=True)  # 审核时间
     html_review_note = Column(Text)
-    rate_limit_log = Column(Text)
-    custom_prompt = Column(Text)  # 用户自定义的分析提示词（已废弃，保留用于兼容）
-    user_prompt_template = Column(Text)  # 用户自定义的提示词模板（不包含数据部分）
+    custom_prompt = deferred(Column(Text), group='report')  # 用户自定义的分析提示词（已废弃，保留用于兼容）
+    user_prompt_template = deferred(Column(Text), group='report')  # 用户自定义的提示词模板（不包含数据部分）
     is_featured = Column(Boolean, default=False)  # 是否加精
     color_tag = Column(String(20), nullable=True)  # 任务卡片颜色标签（如 'blue', 'green'）
     # 协作功能字段
@@ -90,18 +93,32 @@ class Task(Base):
     sharing_type = Column(String(20), default='private')  # private私有/shared共享/organization组织/public公开
     public_approved = Column(Integer, default=0)  # 项目公开审核：0=待审核 1=已通过 -1=已拒绝，仅当 sharing_type=public 时生效
     like_count = Column(Integer, default=0)  # 点赞数（公开项目用）
+    # 提交计数（与 submission 表同事务维护，列表页直接读取）
+    submission_count = Column(Integer, default=0, nullable=False)
+    last_submitted_at = Column(DateTime, nullable=True)
+    # 提交限流（为空时使用全局默认值）
+    rate_limit_window = Column(Integer, nullable=True)  # 统计窗口（秒）
+    rate_limit_threshold = Column(Integer, nullable=True)  # 窗口内最多提交次数
+    rate_limit_blacklist_seconds = Column(Integer, nullable=True)  # 超限后封禁时长（秒）
+    # 字段统计（task_field_stat）是否与提交数据一致；升级前的旧任务为 False，读取时自动重建
+    field_stats_ready = Column(Boolean, default=True, nullable=False)
+    field_stats_order = deferred(Column(Text), group='stats')  # 第一条可解析提交的字段顺序（JSON 列表）
+    field_stats_through_id = Column(Integer, nullable=True)  # 字段统计已合并到的提交 id，之后的提交由后台合并
     # 多HTML文件支持
-    html_files = Column(Text)  # JSON格式存储多个HTML文件: [{"name": "file.html", "path": "/path/to/file.html"}, ...]
+    html_files = deferred(Column(Text), group='html')  # JSON格式存储多个HTML文件: [{"name": "file.html", "path": "/path/to/file.html"}, ...]
     approver = relationship('User', foreign_keys=[html_approved_by], backref='approved_tasks')
     organization = relationship('Organization', back_populates='tasks')
     shares = relationship('TaskShare', back_populates='task', cascade='all, delete-orphan')
     likes = relationship('TaskLike', back_populates='task', cascade='all, delete-orphan')
+    rate_limit_events = relationship('RateLimitEvent', back_populates='task', cascade='all, delete-orphan')
+    field_stats = relationship('TaskFieldStat', back_populates='task', cascade='all, delete-orphan')
+    analysis_jobs = relationship('AnalysisJob', back_populates='task', cascade='all, delete-orphan')
 
 
 class Submission(Base):
     __tablename__ = 'submission'
     id = Column(Integer, primary_key=True)
-    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'))  # 数据库层面级联删除
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'), index=True)  # 数据库层面级联删除
     task = relationship('Task', back_populates='submission')
     data = Column(Text, nullable=False)
     submitted_at = Column(DateTime, default=datetime.now)
@@ -204,6 +221,92 @@ class TaskShare(Base):
     user = relationship('User', foreign_keys=[user_id])
 
 
+class RateLimitEvent(Base):
+    """提交限流事件（替代原 task.rate_limit_log 文本字段，只追加、按任务限量保留）"""
+    __tablename__ = 'rate_limit_event'
+    __table_args__ = (Index('ix_rate_limit_event_task_expires', 'task_id', 'expires_at'),)
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'), nullable=False)
+    ip = Column(String(64), nullable=False)
+    created_at = Column(DateTime, default=datetime.now)  # 封禁开始时间
+    expires_at = Column(DateTime, nullable=False)  # 封禁结束时间
+    window_seconds = Column(Integer)  # 触发封禁的统计窗口（秒）
+
+    task = relationship('Task', back_populates='rate_limit_events')
+
+
+class TaskFieldStat(Base):
+    """任务字段统计（提交时增量维护，分析提示词按字段直接读取，见 services/field_stats.py）"""
+    __tablename__ = 'task_field_stat'
+    __table_args__ = (UniqueConstraint('task_id', 'field', name='uq_task_field_stat_task_field'),)
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'), nullable=False)
+    field = Column(String(255), nullable=False)
+    value_count = Column(Integer, default=0, nullable=False)  # 字段出现次数
+    numeric_count = Column(Integer, default=0, nullable=False)
+    numeric_sum = Column(Float, default=0.0, nullable=False)
+    numeric_sumsq = Column(Float, default=0.0, nullable=False)
+    numeric_min = Column(Text)  # JSON，保留原始类型
+    numeric_max = Column(Text)
+    true_count = Column(Integer, default=0, nullable=False)
+    false_count = Column(Integer, default=0, nullable=False)
+    text_count = Column(Integer, default=0, nullable=False)
+    top_values = Column(Text)  # 常见值计数（JSON，有界）
+    updated_at = Column(DateTime, default=datetime.now)
+
+    task = relationship('Task', back_populates='field_stats')
+
+
+class AnalysisJob(Base):
+    """AI 分析任务（报告生成）的状态记录，由执行分析的 worker 写入，见 services/analysis_jobs.py"""
+    __tablename__ = 'analysis_job'
+    __table_args__ = (
+        Index('ix_analysis_job_task_id', 'task_id', 'id'),
+        Index('ix_analysis_job_status_updated', 'status', 'updated_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=True)
+    status = Column(String(20), default='queued', nullable=False)  # queued / running / completed / error / cancelled
+    progress = Column(Integer, default=0, nullable=False)
+    message = Column(String(500))
+    queue_position = Column(Integer, nullable=True)  # 排队时前面还有几个任务
+    model = Column(String(50))
+    prompt_hash = Column(String(64))  # 提示词 sha256
+    token_budget = Column(Integer, nullable=True)  # 提示词 token 预算，见 services/prompt_budget.py
+    prompt_tokens = Column(Integer, nullable=True)  # 实际发送的提示词估算 token 数
+    provider_prompt_tokens = Column(Integer, nullable=True)  # 服务商返回的提示词 token 数（本次分析各次调用合计）
+    cached_tokens = Column(Integer, nullable=True)  # 其中命中服务商上下文缓存的 token 数，见 services/ai_usage.py
+    result_path = Column(String(500))  # 报告文件路径（报告正文保存在 task.analysis_report）
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.now)
+
+    task = relationship('Task', back_populates='analysis_jobs')
+
+
+class AICacheEntry(Base):
+    """AI 响应缓存：同一服务商、模型、温度和提示词直接返回上次的结果，见 services/ai_cache.py"""
+    __tablename__ = 'ai_cache_entry'
+    __table_args__ = (
+        Index('ix_ai_cache_entry_last_used', 'last_used_at'),
+        Index('ix_ai_cache_entry_expires', 'expires_at'),
+    )
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), unique=True, nullable=False)  # sha256(服务商, 模型, 温度, 提示词哈希)
+    provider = Column(String(50), nullable=False)
+    model = Column(String(100))
+    temperature = Column(Float, nullable=True)
+    prompt_hash = Column(String(64), nullable=False)
+    response = Column(Text, nullable=False)
+    size = Column(Integer, default=0, nullable=False)  # 响应字节数，用于按总大小淘汰
+    hit_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    last_used_at = Column(DateTime, default=datetime.now)
+    expires_at = Column(DateTime, nullable=False)
+
+
 class TaskLike(Base):
     """公开任务点赞（仅对 sharing_type=public 的任务）"""
     __tablename__ = 'task_like'
@@ -217,6 +320,27 @@ class TaskLike(Base):
     user = relationship('User', foreign_keys=[user_id])
 
 
+_RATE_LIMIT_LOG_LINE = re.compile(r'\[([^\]]+)\]\s*IP\s+(\S+)\s+在\s+(\d+)s\s+内多次提交，已暂时封禁\s+(\d+)\s+分钟')
+
+
+def _parse_rate_limit_log(log_text, keep=200):
+    """解析旧 rate_limit_log 文本，返回最近 keep 条 (ip, 开始时间, 结束时间, 窗口秒数)"""
+    events = []
+    for line in (log_text or '').splitlines()[-keep:]:
+        match = _RATE_LIMIT_LOG_LINE.search(line)
+        if not match:
+            continue
+        try:
+            # 旧日志使用 UTC 时间，转换为本地时间与其他字段保持一致
+            started = datetime.strptime(match.group(1).strip(), '%Y-%m-%d %H:%M:%S')
+            started = started.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+        except ValueError:
+            continue
+        ban_seconds = int(match.group(4)) * 60
+        events.append((match.group(2), started, datetime.fromtimestamp(started.timestamp() + ban_seconds), int(match.group(3))))
+    return events
+
+
 def migrate_database(engine):
     """数据库迁移函数"""
     try:
@@ -327,13 +451,6 @@ def migrate_database(engine):
                 except Exception as e:
                     logger.warning(f"添加html_review_note失败（可能已存在）: {str(e)}")
 
-            if task_cols and 'rate_limit_log' not in task_cols:
-                try:
-                    conn.execute(text("ALTER TABLE task ADD COLUMN rate_limit_log TEXT"))
-                    logger.info("成功为task添加rate_limit_log字段")
-                except Exception as e:
-                    logger.warning(f"添加rate_limit_log失败（可能已存在）: {str(e)}")
-            
             if task_cols and 'custom_prompt' not in task_cols:
                 try:
                     conn.execute(text("ALTER TABLE task ADD COLUMN custom_prompt TEXT"))
@@ -410,6 +527,37 @@ def migrate_database(engine):
                 except Exception as e:
                     logger.warning(f"创建task_share表失败: {str(e)}")
             
+            # 创建限流事件表，并把旧的 rate_limit_log 文本迁移过来
+            if 'rate_limit_event' not in inspector.get_table_names():
+                try:
+                    RateLimitEvent.__table__.create(bind=conn)
+                    logger.info("成功创建rate_limit_event表")
+                except Exception as e:
+                    logger.warning(f"创建rate_limit_event表失败: {str(e)}")
+            if task_cols and 'rate_limit_log' in task_cols:
+                try:
+                    rows = conn.execute(text(
+                        "SELECT id, rate_limit_log FROM task WHERE rate_limit_log IS NOT NULL AND rate_limit_log <> ''"
+                    )).fetchall()
+                    migrated = 0
+                    for task_pk, log_text in rows:
+                        events = _parse_rate_limit_log(log_text)
+                        if events:
+                            conn.execute(RateLimitEvent.__table__.insert(), [
+                                {'task_id': task_pk, 'ip': ip, 'created_at': started, 'expires_at': expires, 'window_seconds': window}
+                                for ip, started, expires, window in events
+                            ])
+                            migrated += len(events)
+                    conn.execute(text("UPDATE task SET rate_limit_log = NULL"))
+                    logger.info(f"已将rate_limit_log迁移到rate_limit_event表: {migrated} 条")
+                except Exception as e:
+                    logger.warning(f"迁移rate_limit_log失败: {str(e)}")
+                try:
+                    conn.execute(text("ALTER TABLE task DROP COLUMN rate_limit_log"))
+                    logger.info("已删除task.rate_limit_log字段")
+                except Exception as e:
+                    logger.warning(f"删除rate_limit_log字段失败（数据已清空，可忽略）: {str(e)}")
+
             # 创建任务点赞表
             if 'task_like' not in inspector.get_table_names():
                 try:
@@ -456,5 +604,100 @@ def migrate_database(engine):
                     logger.info("成功为task添加public_approved字段")
                 except Exception as e:
                     logger.warning(f"添加public_approved失败（可能已存在）: {str(e)}")
+
+            # task 新增提交计数字段，并按现有提交数据回填
+            if task_cols and 'submission_count' not in task_cols:
+                try:
+                    conn.execute(text("ALTER TABLE task ADD COLUMN submission_count INTEGER NOT NULL DEFAULT 0"))
+                    conn.execute(text(
+                        "UPDATE task SET submission_count = "
+                        "(SELECT COUNT(*) FROM submission WHERE submission.task_id = task.id)"
+                    ))
+                    logger.info("成功为task添加submission_count字段并回填")
+                except Exception as e:
+                    logger.warning(f"添加submission_count失败（可能已存在）: {str(e)}")
+
+            if task_cols and 'last_submitted_at' not in task_cols:
+                try:
+                    conn.execute(text("ALTER TABLE task ADD COLUMN last_submitted_at DATETIME"))
+                    conn.execute(text(
+                        "UPDATE task SET last_submitted_at = "
+                        "(SELECT MAX(submitted_at) FROM submission WHERE submission.task_id = task.id)"
+                    ))
+                    logger.info("成功为task添加last_submitted_at字段并回填")
+                except Exception as e:
+                    logger.warning(f"添加last_submitted_at失败（可能已存在）: {str(e)}")
+
+            # task 新增按任务配置的提交限流字段
+            for col_name in ('rate_limit_window', 'rate_limit_threshold', 'rate_limit_blacklist_seconds'):
+                if task_cols and col_name not in task_cols:
+                    try:
+                        conn.execute(text(f"ALTER TABLE task ADD COLUMN {col_name} INTEGER"))
+                        logger.info(f"成功为task添加{col_name}字段")
+                    except Exception as e:
+                        logger.warning(f"添加{col_name}失败（可能已存在）: {str(e)}")
+
+            # 字段统计表；旧任务标记为未就绪，首次读取（或 scripts/rebuild_field_stats.py）时重建
+            if 'task_field_stat' not in inspector.get_table_names():
+                try:
+                    TaskFieldStat.__table__.create(bind=conn)
+                    logger.info("成功创建task_field_stat表")
+                except Exception as e:
+                    logger.warning(f"创建task_field_stat表失败: {str(e)}")
+            if task_cols and 'field_stats_ready' not in task_cols:
+                try:
+                    conn.execute(text("ALTER TABLE task ADD COLUMN field_stats_ready BOOLEAN DEFAULT 0 NOT NULL"))
+                    logger.info("成功为task添加field_stats_ready字段")
+                except Exception as e:
+                    logger.warning(f"添加field_stats_ready失败（可能已存在）: {str(e)}")
+            if task_cols and 'field_stats_order' not in task_cols:
+                try:
+                    conn.execute(text("ALTER TABLE task ADD COLUMN field_stats_order TEXT"))
+                    logger.info("成功为task添加field_stats_order字段")
+                except Exception as e:
+                    logger.warning(f"添加field_stats_order失败（可能已存在）: {str(e)}")
+            if task_cols and 'field_stats_through_id' not in task_cols:
+                # 统计改为按提交 id 水位合并，常见值记录第一次出现的提交 id；已有统计全部标记重建
+                try:
+                    conn.execute(text("ALTER TABLE task ADD COLUMN field_stats_through_id INTEGER"))
+                    conn.execute(text("UPDATE task SET field_stats_ready = 0"))
+                    logger.info("成功为task添加field_stats_through_id字段")
+                except Exception as e:
+                    logger.warning(f"添加field_stats_through_id失败（可能已存在）: {str(e)}")
+
+            # 分析任务状态表
+            if 'analysis_job' not in inspector.get_table_names():
+                try:
+                    AnalysisJob.__table__.create(bind=conn)
+                    logger.info("成功创建analysis_job表")
+                except Exception as e:
+                    logger.warning(f"创建analysis_job表失败: {str(e)}")
+            else:
+                analysis_job_cols = {col['name'] for col in inspector.get_columns('analysis_job')}
+                for col_name in ('token_budget', 'prompt_tokens', 'provider_prompt_tokens', 'cached_tokens'):
+                    if col_name not in analysis_job_cols:
+                        try:
+                            conn.execute(text(f"ALTER TABLE analysis_job ADD COLUMN {col_name} INTEGER"))
+                            logger.info(f"成功为analysis_job添加{col_name}字段")
+                        except Exception as e:
+                            logger.warning(f"添加{col_name}失败（可能已存在）: {str(e)}")
+
+            # AI 响应缓存表
+            if 'ai_cache_entry' not in inspector.get_table_names():
+                try:
+                    AICacheEntry.__table__.create(bind=conn)
+                    logger.info("成功创建ai_cache_entry表")
+                except Exception as e:
+                    logger.warning(f"创建ai_cache_entry表失败: {str(e)}")
+
+            # submission.task_id 索引（按任务查询/游标分页依赖此索引；MySQL 外键已自带索引时跳过）
+            if 'submission' in inspector.get_table_names():
+                submission_indexes = inspector.get_indexes('submission')
+                if not any(idx.get('column_names', [None])[0] == 'task_id' for idx in submission_indexes):
+                    try:
+                        conn.execute(text("CREATE INDEX ix_submission_task_id ON submission (task_id)"))
+                        logger.info("成功为submission表添加task_id索引")
+                    except Exception as e:
+                        logger.warning(f"添加submission.task_id索引失败（可能已存在）: {str(e)}")
     except Exception as e:
         logger.error(f"数据库迁移失败: {str(e)}")
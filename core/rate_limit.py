@@ -0,0 +1,434 @@
+"""进程内限流结构 - 分片 + 时间轮过期
+
+原实现在每个请求里持有全局锁遍历所有 IP 清理过期记录，被扫描时每个正常请求
+都要付出 O(IP 数) 的代价。这里改为：
+- 按 key 哈希分成若干分片，每个分片独立加锁
+- 每条记录按过期时间挂到时间轮的槽位上，时间推进时只处理到期槽位（均摊 O(1)）
+- 每个分片有条数上限，超出时淘汰最久未访问的记录，内存有硬上限
+
+TimeWheelLimiter 用于全局 404 限流；SlidingWindowLimiter 用于表单提交限流（按任务配置）。
+多进程部署时改用 SharedWindowLimiter / SharedSlidingWindowLimiter，计数保存在共享状态后端
+（core/state.py），接口与进程内版本一致。
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('count', 'window_start', 'ban_until', 'slot_tick')
+
+    def __init__(self, now):
+        self.count = 0
+        self.window_start = now
+        self.ban_until = 0.0
+        self.slot_tick = None
+
+
+class _Shard:
+    """一个分片：记录表（按访问顺序）+ 时间轮"""
+    __slots__ = ('lock', 'entries', 'wheel', 'cursor')
+
+    def __init__(self, wheel_size, now_tick):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.wheel = [[] for _ in range(wheel_size)]
+        self.cursor = now_tick
+
+
+class TimeWheelLimiter:
+    """固定窗口计数 + 临时封禁
+
+    同一 key 在 window 秒内 hit 达到 max_hits 次后封禁 ban_seconds 秒。
+    is_banned / hit 均为均摊 O(1)，不会遍历全部 key。
+    """
+
+    def __init__(self, window, max_hits, ban_seconds, max_entries=100000, shards=16, tick=1.0):
+        self.window = float(window)
+        self.max_hits = int(max_hits)
+        self.ban_seconds = float(ban_seconds)
+        self.tick = float(tick)
+        # 槽位数覆盖最长存活时间，超出部分到期时重新挂入
+        self.wheel_size = int(max(self.window, self.ban_seconds) / self.tick) + 2
+        self.shard_count = max(1, int(shards))
+        self.max_per_shard = max(1, int(max_entries) // self.shard_count)
+        now_tick = self._tick_of(time.time())
+        self._shards = [_Shard(self.wheel_size, now_tick) for _ in range(self.shard_count)]
+        self._stats_lock = threading.Lock()
+        self._evicted = 0
+        self._expired = 0
+        self._bans = 0
+
+    # ---------- 内部 ----------
+    def _tick_of(self, ts):
+        return int(ts / self.tick)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self.shard_count]
+
+    def _expires_at(self, entry):
+        return max(entry.window_start + self.window, entry.ban_until)
+
+    def _schedule(self, shard, key, entry):
+        """按过期时间挂到时间轮；超出一圈的挂到最远槽位，到期时再重新挂"""
+        tick = self._tick_of(self._expires_at(entry)) + 1
+        tick = min(tick, shard.cursor + self.wheel_size - 1)
+        if entry.slot_tick == tick:
+            return
+        entry.slot_tick = tick
+        shard.wheel[tick % self.wheel_size].append(key)
+
+    def _advance(self, shard, now):
+        """推进时间轮到当前时刻，清理到期槽位中的记录（调用方持有分片锁）"""
+        now_tick = self._tick_of(now)
+        if now_tick <= shard.cursor:
+            return
+        # 长时间空闲时最多转一圈即可覆盖所有槽位
+        start = max(shard.cursor + 1, now_tick - self.wheel_size + 1)
+        expired = 0
+        for tick in range(start, now_tick + 1):
+            slot = shard.wheel[tick % self.wheel_size]
+            if not slot:
+                continue
+            shard.wheel[tick % self.wheel_size] = []
+            for key in slot:
+                entry = shard.entries.get(key)
+                # 记录已被淘汰或已重新挂到其他槽位
+                if entry is None or entry.slot_tick != tick:
+                    continue
+                if self._expires_at(entry) <= now:
+                    del shard.entries[key]
+                    expired += 1
+                else:
+                    entry.slot_tick = None
+                    shard.cursor = tick
+                    self._schedule(shard, key, entry)
+        shard.cursor = now_tick
+        if expired:
+            with self._stats_lock:
+                self._expired += expired
+
+    # ---------- 对外接口 ----------
+    def is_banned(self, key, now=None):
+        """key 当前是否处于封禁期"""
+        now = time.time() if now is None else now
+        shard = self._shard(key)
+        with shard.lock:
+            self._advance(shard, now)
+            entry = shard.entries.get(key)
+            return entry is not None and entry.ban_until > now
+
+    def ban_remaining(self, key, now=None):
+        """剩余封禁秒数（未封禁返回 0）"""
+        now = time.time() if now is None else now
+        shard = self._shard(key)
+        with shard.lock:
+            self._advance(shard, now)
+            entry = shard.entries.get(key)
+            if entry is None or entry.ban_until <= now:
+                return 0.0
+            return entry.ban_until - now
+
+    def hit(self, key, now=None):
+        """记录一次命中，返回本次是否触发封禁"""
+        now = time.time() if now is None else now
+        shard = self._shard(key)
+        evicted = 0
+        with shard.lock:
+            self._advance(shard, now)
+            entry = shard.entries.get(key)
+            if entry is None:
+                while len(shard.entries) >= self.max_per_shard:
+                    shard.entries.popitem(last=False)
+                    evicted += 1
+                entry = _Entry(now)
+                shard.entries[key] = entry
+            else:
+                shard.entries.move_to_end(key)
+            if now - entry.window_start > self.window:
+                entry.window_start = now
+                entry.count = 0
+            entry.count += 1
+            banned = entry.count >= self.max_hits and entry.ban_until <= now
+            if banned:
+                entry.ban_until = now + self.ban_seconds
+            self._schedule(shard, key, entry)
+        if evicted or banned:
+            with self._stats_lock:
+                self._evicted += evicted
+                self._bans += int(banned)
+        return banned
+
+    def purge_expired(self, now=None):
+        """推进所有分片的时间轮（后台定期调用或测试用），返回剩余记录数"""
+        now = time.time() if now is None else now
+        for shard in self._shards:
+            with shard.lock:
+                self._advance(shard, now)
+        return len(self)
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'tracked': len(self),
+                'capacity': self.max_per_shard * self.shard_count,
+                'shards': self.shard_count,
+                'bans': self._bans,
+                'expired': self._expired,
+                'evicted': self._evicted,
+            }
+
+
+class _WindowEntry:
+    __slots__ = ('window_start', 'count', 'prev_count', 'ban_until', 'last_seen', 'window')
+
+    def __init__(self, now, window):
+        self.window_start = now
+        self.count = 0
+        self.prev_count = 0
+        self.ban_until = 0.0
+        self.last_seen = now
+        self.window = window
+
+
+class SlidingWindowLimiter:
+    """滑动窗口计数 + 黑名单，按 LRU 限制记录条数
+
+    用当前窗口与上一窗口的计数按时间加权估算最近 window 秒内的请求数，
+    每个 key 只保存几个数字（不保存时间戳队列），检查为 O(1)。
+    window / threshold / ban_seconds 在每次调用时传入，便于按任务配置。
+    """
+
+    def __init__(self, max_entries=100000, shards=16):
+        self.shard_count = max(1, int(shards))
+        self.max_per_shard = max(1, int(max_entries) // self.shard_count)
+        self._shards = [(threading.Lock(), OrderedDict()) for _ in range(self.shard_count)]
+        self._stats_lock = threading.Lock()
+        self._evicted = 0
+        self._expired = 0
+        self._bans = 0
+        self._rejected = 0
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self.shard_count]
+
+    @staticmethod
+    def _is_stale(entry, now):
+        return entry.ban_until <= now and now - entry.last_seen > 2 * entry.window
+
+    def _evict_stale_head(self, entries, now, limit=2):
+        """顺带检查最久未访问的几条，已无意义的直接移除（调用方持有分片锁）"""
+        removed = 0
+        for _ in range(limit):
+            if not entries:
+                break
+            key, entry = next(iter(entries.items()))
+            if not self._is_stale(entry, now):
+                break
+            del entries[key]
+            removed += 1
+        return removed
+
+    def ban_until(self, key, now=None):
+        """返回 key 的封禁结束时间戳；未封禁返回 0"""
+        now = time.time() if now is None else now
+        lock, entries = self._shard(key)
+        with lock:
+            entry = entries.get(key)
+            if entry is not None and entry.ban_until > now:
+                with self._stats_lock:
+                    self._rejected += 1
+                return entry.ban_until
+        return 0.0
+
+    def hit(self, key, window, threshold, ban_seconds, now=None):
+        """记录一次请求，返回 (是否因本次触发封禁, 估算的窗口内请求数, 封禁结束时间戳)"""
+        now = time.time() if now is None else now
+        window = float(window)
+        lock, entries = self._shard(key)
+        evicted = 0
+        with lock:
+            expired = self._evict_stale_head(entries, now)
+            entry = entries.get(key)
+            if entry is None:
+                while len(entries) >= self.max_per_shard:
+                    entries.popitem(last=False)
+                    evicted += 1
+                entry = _WindowEntry(now, window)
+                entries[key] = entry
+            else:
+                entries.move_to_end(key)
+            entry.window = window
+            entry.last_seen = now
+            # 滚动窗口：跨过一个窗口时当前计数变为上一窗口，跨过两个以上则清零
+            elapsed = now - entry.window_start
+            if elapsed >= window:
+                periods = int(elapsed // window)
+                entry.prev_count = entry.count if periods == 1 else 0
+                entry.count = 0
+                entry.window_start += periods * window
+                elapsed = now - entry.window_start
+            entry.count += 1
+            estimated = entry.prev_count * (1 - elapsed / window) + entry.count
+            banned = estimated > threshold and entry.ban_until <= now
+            if banned:
+                entry.ban_until = now + ban_seconds
+            ban_until = entry.ban_until
+        if evicted or expired or banned:
+            with self._stats_lock:
+                self._evicted += evicted
+                self._expired += expired
+                self._bans += int(banned)
+        return banned, estimated, ban_until
+
+    def __len__(self):
+        return sum(len(entries) for _, entries in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'tracked': len(self),
+                'capacity': self.max_per_shard * self.shard_count,
+                'bans': self._bans,
+                'rejected': self._rejected,
+                'expired': self._expired,
+                'evicted': self._evicted,
+            }
+
+
+def _state_key(prefix, key):
+    if isinstance(key, tuple):
+        key = ':'.join(str(k) for k in key)
+    return f"{prefix}:{key}"
+
+
+class SharedWindowLimiter:
+    """TimeWheelLimiter 的共享状态版本（固定窗口计数 + 临时封禁）
+
+    计数键在第一次命中时创建并带 window 过期时间，封禁键带 ban_seconds 过期时间，
+    过期清理交给后端。后端不可用时放行（只记日志），不因限流影响正常访问。
+    """
+
+    def __init__(self, backend, window, max_hits, ban_seconds, prefix='rl404'):
+        self.backend = backend
+        self.window = float(window)
+        self.max_hits = int(max_hits)
+        self.ban_seconds = float(ban_seconds)
+        self.prefix = prefix
+        self._stats_lock = threading.Lock()
+        self._bans = 0
+        self._errors = 0
+
+    def _error(self, e):
+        with self._stats_lock:
+            self._errors += 1
+        logger.warning(f"共享限流后端不可用，本次放行: {str(e)}")
+
+    def ban_remaining(self, key, now=None):
+        now = time.time() if now is None else now
+        try:
+            until = self.backend.get(_state_key(self.prefix + ':ban', key))
+        except Exception as e:
+            self._error(e)
+            return 0.0
+        return max(0.0, (until or 0) - now)
+
+    def is_banned(self, key, now=None):
+        return self.ban_remaining(key, now) > 0
+
+    def hit(self, key, now=None):
+        """记录一次命中，返回本次是否触发封禁"""
+        now = time.time() if now is None else now
+        try:
+            count = self.backend.incr(_state_key(self.prefix, key), 1, ttl=self.window)
+            if count < self.max_hits:
+                return False
+            banned = self.backend.add(_state_key(self.prefix + ':ban', key), now + self.ban_seconds, ttl=self.ban_seconds)
+        except Exception as e:
+            self._error(e)
+            return False
+        if banned:
+            with self._stats_lock:
+                self._bans += 1
+        return banned
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'backend': self.backend.name,
+                'bans': self._bans,
+                'errors': self._errors,
+            }
+
+
+class SharedSlidingWindowLimiter:
+    """SlidingWindowLimiter 的共享状态版本
+
+    按窗口序号（now // window）分桶计数，用当前桶与上一桶按时间加权估算最近 window 秒内的请求数；
+    每个桶保留两个窗口长度后由后端自动过期。后端不可用时放行。
+    """
+
+    def __init__(self, backend, prefix='rlsubmit'):
+        self.backend = backend
+        self.prefix = prefix
+        self._stats_lock = threading.Lock()
+        self._bans = 0
+        self._rejected = 0
+        self._errors = 0
+
+    def _error(self, e):
+        with self._stats_lock:
+            self._errors += 1
+        logger.warning(f"共享限流后端不可用，本次放行: {str(e)}")
+
+    def ban_until(self, key, now=None):
+        """返回 key 的封禁结束时间戳；未封禁返回 0"""
+        now = time.time() if now is None else now
+        try:
+            until = self.backend.get(_state_key(self.prefix + ':ban', key))
+        except Exception as e:
+            self._error(e)
+            return 0.0
+        if until and until > now:
+            with self._stats_lock:
+                self._rejected += 1
+            return until
+        return 0.0
+
+    def hit(self, key, window, threshold, ban_seconds, now=None):
+        """记录一次请求，返回 (是否因本次触发封禁, 估算的窗口内请求数, 封禁结束时间戳)"""
+        now = time.time() if now is None else now
+        window = float(window)
+        base = _state_key(self.prefix, key)
+        index = int(now // window)
+        try:
+            count = self.backend.incr(f"{base}:{index}", 1, ttl=2 * window)
+            prev_count = self.backend.get(f"{base}:{index - 1}") or 0
+            estimated = prev_count * (1 - (now - index * window) / window) + count
+            if estimated <= threshold:
+                return False, estimated, 0.0
+            ban_key = _state_key(self.prefix + ':ban', key)
+            banned = self.backend.add(ban_key, now + ban_seconds, ttl=ban_seconds)
+            ban_until = now + ban_seconds if banned else (self.backend.get(ban_key) or 0.0)
+        except Exception as e:
+            self._error(e)
+            return False, 0.0, 0.0
+        if banned:
+            with self._stats_lock:
+                self._bans += 1
+        return banned, estimated, ban_until
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'backend': self.backend.name,
+                'bans': self._bans,
+                'rejected': self._rejected,
+                'errors': self._errors,
+            }
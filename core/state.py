@@ -0,0 +1,608 @@
+"""共享状态后端 - 多进程/多实例部署时共用的轻量键值存储
+
+限流计数、邮箱验证码、AI 分析进度等原先都放在模块级 dict 里，只在单进程内有效；
+多 worker 部署时各进程看到的是不同的副本。这里提供统一接口：
+
+    get(key) / set(key, value, ttl) / add(key, value, ttl) / delete(key)
+    pop(key) / incr(key, amount, ttl) / stats()
+
+值需可 JSON 序列化；ttl 为秒（None 表示不过期）。
+
+- MemoryStateBackend：进程内（默认，单进程部署）
+- SQLiteStateBackend：本机多进程共用一个 SQLite 文件（WAL 模式）
+- RedisStateBackend：RESP 协议直连 Redis（或兼容服务），无需安装 redis 库
+
+通过环境变量 STATE_BACKEND=memory|sqlite|redis 选择。
+"""
+import os
+import json
+import time
+import heapq
+import queue
+import socket
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+logger = logging.getLogger(__name__)
+
+QUICKFORM_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()                                    # memory / sqlite / redis
+STATE_SQLITE_PATH = os.getenv('STATE_SQLITE_PATH', os.path.join(QUICKFORM_DIR, 'quickform_state.db'))
+STATE_REDIS_URL = os.getenv('STATE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+STATE_KEY_PREFIX = os.getenv('STATE_KEY_PREFIX', 'qf:')                                         # 多个应用共用 Redis 时区分
+STATE_MEMORY_MAX_KEYS = int(os.getenv('STATE_MEMORY_MAX_KEYS', '200000'))                       # 进程内最多保存的键数
+
+
+class StateBackendError(Exception):
+    """共享状态后端不可用（连接失败、协议错误等）"""
+
+
+class StateBackend:
+    """共享状态后端接口"""
+
+    name = 'base'
+    shared = False  # 是否在多个进程之间共享
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """键不存在（或已过期）时才写入，返回是否写入成功"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def pop(self, key):
+        """原子地读取并删除，返回原值（不存在返回 None）"""
+        raise NotImplementedError
+
+    def incr(self, key, amount=1, ttl=None):
+        """原子自增并返回新值；键不存在时从 0 开始，ttl 只在创建时设置"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend': self.name, 'shared': self.shared}
+
+    def close(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """进程内实现：dict + 过期时间小根堆，超出上限时先清过期再按写入顺序淘汰"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self, max_keys=STATE_MEMORY_MAX_KEYS):
+        self.max_keys = max(1, int(max_keys))
+        self._data = {}   # key -> (value, expires_at 或 None)
+        self._heap = []   # (expires_at, key)
+        self._lock = threading.Lock()
+        self._expired = 0
+        self._evicted = 0
+
+    def _alive(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            self._expired += 1
+            return None
+        return entry
+
+    def _purge(self, now, limit=64):
+        """清理堆顶已到期的键（调用方持有锁）"""
+        heap = self._heap
+        while heap and limit > 0 and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            limit -= 1
+            entry = self._data.get(key)
+            # 键已被覆盖为新的过期时间时跳过
+            if entry is not None and entry[1] == expires_at:
+                del self._data[key]
+                self._expired += 1
+
+    def _store(self, key, value, ttl, now):
+        expires_at = now + ttl if ttl else None
+        self._data.pop(key, None)
+        self._data[key] = (value, expires_at)
+        if expires_at is not None:
+            heapq.heappush(self._heap, (expires_at, key))
+        if len(self._data) > self.max_keys:
+            self._purge(now, limit=len(self._heap))
+            while len(self._data) > self.max_keys:
+                self._data.pop(next(iter(self._data)))
+                self._evicted += 1
+        # 堆里积累了大量已被覆盖的旧条目时重建
+        if len(self._heap) > 2 * self.max_keys:
+            self._heap = [(e[1], k) for k, e in self._data.items() if e[1] is not None]
+            heapq.heapify(self._heap)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            entry = self._alive(key, now)
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            self._store(key, value, ttl, now)
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            if self._alive(key, now) is not None:
+                return False
+            self._store(key, value, ttl, now)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._alive(key, now)
+            if entry is None:
+                return None
+            del self._data[key]
+            return entry[0]
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            entry = self._alive(key, now)
+            if entry is None:
+                self._store(key, amount, ttl, now)
+                return amount
+            value = int(entry[0]) + amount
+            self._data[key] = (value, entry[1])
+            return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.name,
+                'shared': self.shared,
+                'keys': len(self._data),
+                'capacity': self.max_keys,
+                'expired': self._expired,
+                'evicted': self._evicted,
+            }
+
+
+class SQLiteStateBackend(StateBackend):
+    """本机多进程共用的 SQLite 文件实现
+
+    每个线程一个连接（fork 后自动重连）。get / set / delete 是自动提交的单条语句；
+    先读后写的 add / pop / incr 在 BEGIN IMMEDIATE 事务中先 SELECT 再写入（开始时取得写锁，进程间不会交错），
+    不依赖 RETURNING（3.35+）、UPSERT（3.24+）等较新的 SQLite 语法。WAL 模式下读写互不阻塞。
+    """
+
+    name = 'sqlite'
+    shared = True
+
+    SWEEP_EVERY = 1000  # 每写入多少次清理一次过期键
+
+    def __init__(self, path=STATE_SQLITE_PATH, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._errors = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_kv_expires_at ON kv (expires_at)')
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                         isolation_level=None, check_same_thread=False)
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    def _execute(self, sql, params=()):
+        try:
+            return self._conn().execute(sql, params)
+        except sqlite3.Error as e:
+            self._fail(e)
+
+    def _fail(self, error):
+        with self._lock:
+            self._errors += 1
+        raise StateBackendError(f"SQLite 状态后端操作失败: {str(error)}") from error
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE 事务：开始时取得写锁，事务内的读和写不会与其他进程交错"""
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            self._fail(e)
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            if isinstance(e, sqlite3.Error):
+                self._fail(e)
+            raise
+
+    @staticmethod
+    def _read(conn, key):
+        """(值文本, 过期时间)，不存在时返回 None（不判断是否过期）"""
+        return conn.execute('SELECT value, expires_at FROM kv WHERE key = ?', (key,)).fetchone()
+
+    def _after_write(self, now):
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % self.SWEEP_EVERY == 0
+        if sweep:
+            self._execute('DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+
+    def get(self, key):
+        row = self._execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self._execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None)
+        )
+        self._after_write(now)
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            row = self._read(conn, key)
+            # 已过期的键视为不存在
+            if row is not None and (row[1] is None or row[1] > now):
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None)
+            )
+        self._after_write(now)
+        return True
+
+    def delete(self, key):
+        self._execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def pop(self, key):
+        with self._transaction() as conn:
+            row = self._read(conn, key)
+            if row is None:
+                return None
+            conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+        if row[1] is not None and row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._transaction() as conn:
+            row = self._read(conn, key)
+            if row is None or (row[1] is not None and row[1] <= now):
+                # 不存在或已过期：计数和过期时间一起重置
+                value = amount
+                conn.execute(
+                    'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(value), now + ttl if ttl else None)
+                )
+            else:
+                value = int(json.loads(row[0])) + amount
+                conn.execute('UPDATE kv SET value = ? WHERE key = ?', (json.dumps(value), key))
+        self._after_write(now)
+        return value
+
+    def stats(self):
+        try:
+            keys = self._execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+        except StateBackendError:
+            keys = None
+        with self._lock:
+            return {
+                'backend': self.name,
+                'shared': self.shared,
+                'path': self.path,
+                'keys': keys,
+                'writes': self._writes,
+                'errors': self._errors,
+            }
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def _replayable(command):
+    """重复执行结果不变的命令：连接出错后可以放心重发"""
+    name = str(command[0]).upper()
+    if name == 'SET':
+        return 'NX' not in command
+    return name in ('GET', 'DEL', 'PING')
+
+
+class _RespConnection:
+    """一条 RESP2 协议连接（只实现本模块用到的回复类型）"""
+
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+        self.timeout = timeout
+        self.pid = os.getpid()
+
+    @staticmethod
+    def encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def send(self, *commands):
+        self.sock.sendall(b''.join(self.encode(c) for c in commands))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('连接已被服务端关闭')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise StateBackendError(f"Redis 错误: {rest.decode('utf-8', 'replace')}")
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read() for _ in range(length)]
+        raise StateBackendError(f"无法解析的 Redis 回复: {line[:50]!r}")
+
+    def alive(self):
+        """空闲连接是否仍可用：不阻塞地窥探一个字节，服务端关闭连接时读到 EOF
+
+        空闲连接上本不该有未读数据，读到数据说明回复已经错位，同样不能再用。
+        """
+        try:
+            self.sock.setblocking(False)
+            try:
+                self.sock.recv(1, socket.MSG_PEEK)
+            finally:
+                self.sock.settimeout(self.timeout)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RedisStateBackend(StateBackend):
+    """Redis 实现：直接使用 RESP 协议，带简单连接池
+
+    需要原子性的组合操作（pop、带过期时间的 incr）用 MULTI/EXEC 事务一次发送，
+    只依赖 Redis 2.6 起就有的命令，兼容各种 Redis 协议服务。
+    """
+
+    name = 'redis'
+    shared = True
+
+    def __init__(self, url=STATE_REDIS_URL, prefix=STATE_KEY_PREFIX, timeout=2.0, max_connections=32):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        path = (parsed.path or '').strip('/')
+        self.db = int(path) if path.isdigit() else 0
+        self.prefix = prefix
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=max(1, max_connections))
+        self._lock = threading.Lock()
+        self._commands = 0
+        self._errors = 0
+        self._reconnects = 0
+
+    def _connect(self):
+        conn = _RespConnection(self.host, self.port, self.timeout)
+        try:
+            if self.password:
+                auth = ('AUTH', self.username, self.password) if self.username else ('AUTH', self.password)
+                conn.send(auth)
+                conn.read()
+            if self.db:
+                conn.send(('SELECT', self.db))
+                conn.read()
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            self._reconnects += 1
+        return conn
+
+    def _acquire(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            # fork 出来的子进程不能复用父进程的连接；服务端已关闭的空闲连接在发送前丢掉，
+            # 避免不可重发的命令发到死连接上才失败
+            if conn.pid == os.getpid() and conn.alive():
+                return conn
+            conn.close()
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _call(self, *commands):
+        """发送一组命令并按顺序读取回复
+
+        网络错误时只在两种情况下重连重试一次：命令还没有发出（取连接、建立连接时出错），
+        或整组命令都可以重复执行（见 _replayable）。INCRBY、SET NX、MULTI 里的 GET+DEL
+        发出后可能已经在服务端执行，重发会重复计数、误判键已存在或丢掉取出的值，
+        这时直接报错交给调用方处理。
+        """
+        replayable = all(_replayable(c) for c in commands)
+        for attempt in range(2):
+            conn = None
+            sent = False
+            try:
+                conn = self._acquire()
+                sent = True
+                conn.send(*commands)
+                replies = [conn.read() for _ in commands]
+                self._release(conn)
+                with self._lock:
+                    self._commands += len(commands)
+                return replies
+            except StateBackendError:
+                # 服务端返回的错误：单条命令时连接仍然可用，多条命令时后面的回复还没读完
+                if conn is not None:
+                    if len(commands) == 1:
+                        self._release(conn)
+                    else:
+                        conn.close()
+                with self._lock:
+                    self._errors += 1
+                raise
+            except (OSError, ConnectionError, ValueError) as e:
+                if conn is not None:
+                    conn.close()
+                if attempt or (sent and not replayable):
+                    with self._lock:
+                        self._errors += 1
+                    raise StateBackendError(f"Redis 连接失败: {str(e)}") from e
+
+    def _key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _ttl_args(ttl):
+        return ('PX', int(ttl * 1000)) if ttl else ()
+
+    def get(self, key):
+        value = self._call(('GET', self._key(key)))[0]
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self._call(('SET', self._key(key), json.dumps(value, ensure_ascii=False)) + self._ttl_args(ttl))
+
+    def add(self, key, value, ttl=None):
+        reply = self._call(('SET', self._key(key), json.dumps(value, ensure_ascii=False), 'NX') + self._ttl_args(ttl))[0]
+        return reply == 'OK'
+
+    def delete(self, key):
+        self._call(('DEL', self._key(key)))
+
+    def pop(self, key):
+        k = self._key(key)
+        replies = self._call(('MULTI',), ('GET', k), ('DEL', k), ('EXEC',))
+        value = replies[-1][0] if replies[-1] else None
+        return None if value is None else json.loads(value)
+
+    def incr(self, key, amount=1, ttl=None):
+        k = self._key(key)
+        if not ttl:
+            return int(self._call(('INCRBY', k, amount))[0])
+        # SET NX 在键不存在时连同过期时间一起创建，INCRBY 不会改变已有的过期时间
+        replies = self._call(('MULTI',), ('SET', k, 0, 'NX') + self._ttl_args(ttl), ('INCRBY', k, amount), ('EXEC',))
+        return int(replies[-1][1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.name,
+                'shared': self.shared,
+                'server': f"{self.host}:{self.port}/{self.db}",
+                'pooled_connections': self._pool.qsize(),
+                'connects': self._reconnects,
+                'commands': self._commands,
+                'errors': self._errors,
+            }
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def create_state_backend(kind=None):
+    """按类型创建后端；未知类型回退到进程内实现"""
+    kind = (kind or STATE_BACKEND).lower()
+    if kind == 'sqlite':
+        return SQLiteStateBackend()
+    if kind == 'redis':
+        return RedisStateBackend()
+    if kind != 'memory':
+        logger.warning(f"未知的 STATE_BACKEND={kind}，使用进程内存储")
+    return MemoryStateBackend()
+
+
+_state_backend = None
+_state_backend_lock = threading.Lock()
+
+
+def get_state_backend():
+    """进程内共用的状态后端实例（按 STATE_BACKEND 创建一次）"""
+    global _state_backend
+    if _state_backend is None:
+        with _state_backend_lock:
+            if _state_backend is None:
+                _state_backend = create_state_backend()
+                logger.info(f"共享状态后端: {_state_backend.name}")
+    return _state_backend
@@ -2,21 +2,15 @@
 import os
 import json
 import requests
-import threading
 import logging
 import traceback
 import uuid
 from datetime import datetime
-from functools import wraps
 
 logger = logging.getLogger(__name__)
 
 # 全局变量（仅HTML格式）
 ALLOWED_EXTENSIONS = {'html', 'htm'}
-analysis_progress = {}
-analysis_results = {}
-completed_reports = set()
-progress_lock = threading.Lock()
 
 
 def allowed_file(filename):
@@ -269,42 +263,8 @@ def save_analysis_report(task_id, report_content, SessionLocal, upload_folder):
             task.report_generated_at = datetime.now()
             db.commit()
             
-            with progress_lock:
-                completed_reports.add(task_id)
-            
             logger.info(f"任务 {task_id} 的分析报告已保存")
     except Exception as e:
         logger.error(f"保存分析报告失败: {str(e)}")
     finally:
         db.close()
-
-
-def timeout(seconds, error_message="函数执行超时"):
-    """超时装饰器"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            result = [None]
-            exception = [None]
-            
-            def target():
-                try:
-                    result[0] = func(*args, **kwargs)
-                except Exception as e:
-                    exception[0] = e
-            
-            thread = threading.Thread(target=target)
-            thread.daemon = True
-            thread.start()
-            thread.join(seconds)
-            
-            if thread.is_alive():
-                raise TimeoutError(error_message)
-            elif exception[0]:
-                raise exception[0]
-            else:
-                return result[0]
-        
-        return wrapper
-    return decorator
-
@@ -0,0 +1,39 @@
+"""gunicorn 配置：gunicorn -c gunicorn.conf.py app:app（或 python serve.py）
+
+- 预加载应用：模板、模型、pandas 等在主进程导入一次，fork 后各 worker 共享内存页
+- fork 之后每个 worker 丢弃继承的数据库连接，并启动自己的后台线程（提交队列、限流事件写入）
+- 退出时等待进行中的分析任务、写完提交队列，再结束 worker
+参数见 serve.py 顶部的环境变量说明。
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from serve import SERVE_HOST, SERVE_PORT, SERVE_THREADS, SERVE_GRACEFUL_TIMEOUT, default_workers
+
+# 后台线程不能跨 fork 存活，主进程中不启动，由 post_fork 在每个 worker 中启动
+os.environ['QUICKFORM_DEFER_BACKGROUND'] = 'true'
+
+bind = f"{SERVE_HOST}:{SERVE_PORT}"
+workers = default_workers()
+threads = SERVE_THREADS
+worker_class = 'gthread'
+preload_app = True
+graceful_timeout = SERVE_GRACEFUL_TIMEOUT
+timeout = 180          # AI 分析等慢请求（与 chat_server 模型的超时一致）
+keepalive = 5
+accesslog = None
+errorlog = '-'
+loglevel = 'info'
+
+
+def post_fork(server, worker):
+    from core.blueprint import after_fork
+    after_fork()
+
+
+def worker_exit(server, worker):
+    from core.blueprint import stop_background_workers
+    # 留出几秒给 gunicorn 自己收尾，避免被强制结束
+    stop_background_workers(timeout=max(1, SERVE_GRACEFUL_TIMEOUT - 5))
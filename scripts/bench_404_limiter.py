@@ -0,0 +1,125 @@
+"""
+404 限流器微基准：对比旧实现（全局锁 + 每次请求遍历清理）与时间轮实现
+在已跟踪 N 个 IP（默认 10 万）时，单个正常请求的检查开销。
+
+使用方法：
+    python scripts/bench_404_limiter.py
+    python scripts/bench_404_limiter.py 100000 20000    # 跟踪IP数 请求次数
+"""
+import os
+import sys
+import time
+import threading
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from core.rate_limit import TimeWheelLimiter
+
+WINDOW = 60
+MAX_HITS = 30
+BAN_SECONDS = 120
+
+
+class LegacyLimiter:
+    """旧实现：dict + 全局锁，每次检查前遍历清理"""
+
+    def __init__(self):
+        self.count = {}
+        self.ban_until = {}
+        self.lock = threading.Lock()
+
+    def _clean(self, now):
+        for ip in list(self.count.keys()):
+            _, start = self.count[ip]
+            if now - start > WINDOW:
+                del self.count[ip]
+        for ip in list(self.ban_until.keys()):
+            if self.ban_until[ip] < now:
+                del self.ban_until[ip]
+
+    def is_banned(self, ip, now):
+        with self.lock:
+            self._clean(now)
+            return ip in self.ban_until and self.ban_until[ip] > now
+
+    def hit(self, ip, now):
+        with self.lock:
+            cnt, start = self.count.get(ip, (0, now))
+            if now - start > WINDOW:
+                cnt, start = 0, now
+            cnt += 1
+            self.count[ip] = (cnt, start)
+            if cnt >= MAX_HITS:
+                self.ban_until[ip] = now + BAN_SECONDS
+                return True
+            return False
+
+
+def populate(limiter, n_ips, now):
+    for i in range(n_ips):
+        ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+        limiter.hit(ip, now)
+        # 每 10 个 IP 有一个被封禁
+        if i % 10 == 0:
+            for _ in range(MAX_HITS):
+                limiter.hit(ip, now)
+
+
+def bench(limiter, requests, now):
+    """模拟正常请求：每次先检查封禁，偶尔记一次 404"""
+    started = time.perf_counter()
+    for i in range(requests):
+        ip = f"192.168.{(i >> 8) & 255}.{i & 255}"
+        limiter.is_banned(ip, now)
+        if i % 20 == 0:
+            limiter.hit(ip, now)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def bench_threads(limiter, requests, now, threads=8):
+    """多线程并发检查的总吞吐（次/秒）"""
+    per_thread = requests // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            ip = f"172.{offset}.{(i >> 8) & 255}.{i & 255}"
+            limiter.is_banned(ip, now)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def main():
+    n_ips = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    now = time.time()
+
+    print("=" * 60)
+    print(f"404 限流器微基准：跟踪 {n_ips} 个IP")
+    print("=" * 60)
+
+    wheel = TimeWheelLimiter(WINDOW, MAX_HITS, BAN_SECONDS, max_entries=max(n_ips * 2, 1000))
+    t0 = time.perf_counter()
+    populate(wheel, n_ips, now)
+    print(f"\n【时间轮】写入 {n_ips} 个IP 用时 {time.perf_counter() - t0:.2f}s，当前跟踪 {len(wheel)} 个")
+    print(f"  单请求开销: {bench(wheel, requests, now + 1):.2f} µs")
+    print(f"  8 线程检查吞吐: {bench_threads(wheel, requests, now + 1):,.0f} 次/秒")
+    # 全部过期后推进一次，确认内存被回收
+    remaining = wheel.purge_expired(now + BAN_SECONDS + 5)
+    print(f"  过期推进后剩余: {remaining}（stats={wheel.stats()}）")
+
+    legacy = LegacyLimiter()
+    populate(legacy, n_ips, now)
+    # 旧实现每次请求都要遍历全部记录，请求数取少一些
+    legacy_requests = max(20, min(requests, 200))
+    print(f"\n【旧实现】单请求开销: {bench(legacy, legacy_requests, now + 1):.2f} µs（{legacy_requests} 次取平均）")
+
+
+if __name__ == '__main__':
+    main()
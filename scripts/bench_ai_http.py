@@ -0,0 +1,121 @@
+"""
+AI 接口连接复用基准：本地 HTTPS 模拟服务商（OpenAI 兼容响应），
+对比裸 requests.post（每次新建 TCP + TLS 连接）与 services.ai_http 的长连接会话。
+需要 openssl 命令生成临时自签名证书。
+
+使用方法：
+    python scripts/bench_ai_http.py                    # 100 次调用
+    python scripts/bench_ai_http.py 200 --handshake-ms 150   # 每个新连接额外模拟 150ms 网络握手
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import requests
+
+RESPONSE = json.dumps({'choices': [{'message': {'content': '分析完成'}}]}).encode('utf-8')
+
+
+class MockProvider(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # 支持 keep-alive
+    disable_nagle_algorithm = True   # 响应头和正文分两次发送，避免 Nagle + 延迟确认带来的 40ms 等待
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    handshake_delay = 0.0
+    connections = 0
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        MockServer.connections += 1
+        if self.handshake_delay:
+            # 模拟公网 TCP + TLS 握手的往返延迟
+            time.sleep(self.handshake_delay)
+        return sock, addr
+
+
+def make_cert(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+         '-addext', 'subjectAltName=DNS:localhost', '-keyout', key, '-out', cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def main():
+    args = sys.argv[1:]
+    calls = int(next((a for a in args if a.isdigit()), '100'))
+    handshake_ms = float(args[args.index('--handshake-ms') + 1]) if '--handshake-ms' in args else 0.0
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cert, key = make_cert(tmpdir)
+        server = MockServer(('localhost', 0), MockProvider)
+        server.handshake_delay = handshake_ms / 1000
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        url = f'https://localhost:{server.server_address[1]}/v1/chat/completions'
+        os.environ['AI_URL_DEEPSEEK'] = url
+        os.environ['REQUESTS_CA_BUNDLE'] = cert
+
+        from services.ai_service import call_ai_model
+        from services.ai_http import ai_http
+        ai_config = SimpleNamespace(selected_model='deepseek', deepseek_api_key='bench')
+        payload = {'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': '测试'}]}
+
+        print(f"{calls} 次调用，模拟握手延迟 {handshake_ms:.0f}ms，HTTP/2: {ai_http.use_http2}")
+
+        MockServer.connections = 0
+        started = time.perf_counter()
+        for _ in range(calls):
+            response = requests.post(url, headers={'Authorization': 'Bearer bench'}, json=payload, timeout=(10, 60))
+            response.raise_for_status()
+        bare = time.perf_counter() - started
+        bare_connections = MockServer.connections
+
+        MockServer.connections = 0
+        started = time.perf_counter()
+        for _ in range(calls):
+            call_ai_model('测试', ai_config)
+        pooled = time.perf_counter() - started
+        pooled_connections = MockServer.connections
+
+        print(f"  裸 requests.post : {bare * 1000 / calls:7.2f} ms/次，新建连接 {bare_connections}")
+        print(f"  连接池会话       : {pooled * 1000 / calls:7.2f} ms/次，新建连接 {pooled_connections}"
+              f"（{bare / max(pooled, 1e-9):.1f}x）")
+        ai_http.close()
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+AI 调用超时 / 取消风暴基准：本地慢速模拟服务商（收到请求后迟迟不响应），
+对比旧的 timeout 装饰器（另开线程等待，超时后不再等待）与 services.call_context 的时限 / 取消，
+统计调用结束后进程内残留的线程和套接字。模拟服务商在子进程中运行，线程数只统计本进程。
+
+使用方法：
+    python scripts/bench_ai_timeouts.py                          # 50 个并发调用，时限 1 秒，服务商 30 秒后才响应
+    python scripts/bench_ai_timeouts.py 200 --deadline 2 --delay 60
+"""
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+import subprocess
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+import requests
+
+logging.disable(logging.ERROR)  # 每次超时 / 取消都会记录一条错误日志，基准中不输出
+
+RESPONSE = json.dumps({'choices': [{'message': {'content': '分析完成'}}]}).encode('utf-8')
+
+
+class SlowProvider(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 30.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(delay):
+    """子进程：启动模拟服务商，把端口写到标准输出"""
+    SlowProvider.delay = delay
+    ThreadingHTTPServer.request_queue_size = 1024  # 默认监听队列只有 5，并发连接会排队重试 SYN
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowProvider)
+    server.daemon_threads = True
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+def legacy_timeout(seconds, error_message="函数执行超时"):
+    """原 services/report_service.py 中的 timeout 装饰器（仅用于对比）"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = [None]
+            exception = [None]
+
+            def target():
+                try:
+                    result[0] = func(*args, **kwargs)
+                except Exception as e:
+                    exception[0] = e
+
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            thread.join(seconds)
+
+            if thread.is_alive():
+                raise TimeoutError(error_message)
+            elif exception[0]:
+                raise exception[0]
+            else:
+                return result[0]
+
+        return wrapper
+    return decorator
+
+
+def open_sockets():
+    """本进程打开的套接字数（仅 Linux）"""
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            count += os.readlink(f'/proc/self/fd/{fd}').startswith('socket:')
+        except OSError:
+            pass
+    return count
+
+
+def storm(calls, target):
+    """并发发起 calls 次调用，返回 (耗时, 失败数)"""
+    errors = [0]
+    lock = threading.Lock()
+
+    def run():
+        try:
+            target()
+        except Exception:
+            with lock:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=run) for _ in range(calls)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, errors[0]
+
+
+def snapshot():
+    return threading.active_count(), open_sockets()
+
+
+def report(label, elapsed, errors, baseline):
+    """输出一轮结果；baseline 为本轮开始前的 snapshot()"""
+    time.sleep(0.2)  # 让刚关闭的连接完成回收
+    threads, sockets = snapshot()
+    print(f"  {label}: 耗时 {elapsed:6.2f}s，失败 {errors}，残留线程 {threads - baseline[0]}"
+          + (f"，残留套接字 {sockets - baseline[1]}" if sockets is not None else ''))
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--serve':
+        serve(float(args[1]))
+        return
+    calls = int(next((a for a in args if a.isdigit()), '50'))
+    deadline = float(args[args.index('--deadline') + 1]) if '--deadline' in args else 1.0
+    delay = float(args[args.index('--delay') + 1]) if '--delay' in args else 30.0
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(delay)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline())
+        url = f'http://127.0.0.1:{port}/v1/chat/completions'
+        os.environ['AI_URL_DEEPSEEK'] = url
+        os.environ.setdefault('AI_HTTP_POOL_SIZE', str(calls))
+        os.environ['AI_HTTP2'] = 'false'
+
+        from services.ai_service import call_ai_model
+        from services.ai_http import ai_http
+        from services.ai_executor import AIJobExecutor
+        from services.call_context import call_scope, call_stats
+        ai_config = SimpleNamespace(selected_model='deepseek', deepseek_api_key='bench')
+        payload = {'model': 'deepseek-chat', 'messages': [{'role': 'user', 'content': '测试'}]}
+
+        print(f"{calls} 个并发调用，时限 {deadline:g}s，模拟服务商 {delay:g}s 后才响应")
+        baseline = snapshot()
+
+        # 1. 旧做法：timeout 装饰器 + 裸 requests.post（自身读取超时 120 秒）
+        @legacy_timeout(deadline)
+        def legacy_call():
+            return requests.post(url, headers={'Authorization': 'Bearer bench'}, json=payload, timeout=(10, 120))
+
+        elapsed, errors = storm(calls, legacy_call)
+        report('timeout 装饰器 ', elapsed, errors, baseline)
+
+        # 2. call_scope：HTTP 读取超时取剩余时限，超时后连接随即关闭
+        baseline = snapshot()
+
+        def scoped_call():
+            with call_scope(deadline):
+                call_ai_model('测试', ai_config)
+
+        elapsed, errors = storm(calls, scoped_call)
+        report('call_scope 时限', elapsed, errors, baseline)
+
+        # 3. 取消：任务在执行器中等待响应，全部取消后关闭连接（时限足够长，不会先超时）
+        baseline = snapshot()
+        executor = AIJobExecutor(workers=calls, provider_concurrency=calls, max_per_user=calls)
+
+        def job_func(job):
+            with call_scope(delay * 2, job):
+                call_ai_model('测试', ai_config)
+
+        jobs = [executor.submit(('bench', i), i, 'deepseek', job_func) for i in range(calls)]
+        while sum(1 for job in jobs if job.status == 'running') < calls:
+            time.sleep(0.05)
+        time.sleep(0.2)  # 确保请求已发出、都在等待响应
+        started = time.perf_counter()
+        for i in range(calls):
+            executor.cancel(('bench', i))
+        while any(job.status == 'running' for job in jobs):
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        executor.stop(5)
+        report('取消运行中任务 ', elapsed, sum(1 for job in jobs if job.status != 'cancelled'), baseline)
+        print(f"  ai_calls 指标: {call_stats()}")
+        ai_http.close()
+    finally:
+        server.kill()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
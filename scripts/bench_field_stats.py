@@ -0,0 +1,245 @@
+"""
+字段统计微基准：对比 generate_analysis_prompt 原来的逐条统计（类型判断 + Counter）
+与 DataFrame 按列向量化统计，并校验两者生成的“数据字段统计”文本逐字一致。
+--parity 随机生成混合类型的小数据集（True / 1 / 1.0 / '1' / 空值等），随机分批写入、后台合并、删除单条，
+部分提交保持未合并（读取时叠加），经统计表读出后与旧的逐条统计逐字对比。
+--ingest 对比提交时不维护统计与登记后台合并的单条提交耗时（文件 SQLite、30 个字段），以及后台合并的吞吐。
+
+使用方法：
+    python scripts/bench_field_stats.py                  # 1千 / 1万 / 10万 条
+    python scripts/bench_field_stats.py 50000 200000     # 指定条数
+    python scripts/bench_field_stats.py --parity 3000    # 统计表与逐条统计对比 3000 轮
+    python scripts/bench_field_stats.py --ingest 2000    # 单条提交耗时（各 2000 条）
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from services.field_stats import frame_field_stats, format_field_stats
+
+
+def legacy_section(all_data):
+    """旧实现：逐条判断类型、收集值，再逐字段 min / max / sum / Counter"""
+    field_types = {}
+    field_values = {}
+    for data in all_data:
+        try:
+            for key, value in data.items():
+                if key not in field_types:
+                    field_types[key] = []
+                    field_values[key] = []
+                if isinstance(value, (int, float)):
+                    field_types[key].append('numeric')
+                    field_values[key].append(value)
+                elif isinstance(value, bool):
+                    field_types[key].append('boolean')
+                    field_values[key].append(value)
+                else:
+                    field_types[key].append('text')
+                    field_values[key].append(str(value))
+        except:
+            pass
+
+    section = ''
+    first_item = all_data[0]
+    if isinstance(first_item, dict):
+        section += "数据字段统计：\n"
+        for field in first_item.keys():
+            field_type_list = field_types.get(field, [])
+            if not field_type_list:
+                continue
+            is_numeric = field_type_list.count('numeric') > len(field_type_list) * 0.8
+            section += f"  - {field}: "
+            if is_numeric:
+                values = [v for v in field_values[field] if isinstance(v, (int, float))]
+                if values:
+                    section += f"数值型，范围: {min(values)} - {max(values)}，平均值: {sum(values)/len(values):.2f}\n"
+                else:
+                    section += "数值型\n"
+            else:
+                top_values = Counter(field_values[field]).most_common(5)
+                if len(top_values) > 0:
+                    section += f"文本型，常见值: {', '.join([f'{k}({v}次)' for k, v in top_values[:3]])}\n"
+                else:
+                    section += "文本型\n"
+        section += "\n"
+    return section
+
+
+def make_rows(n, seed=1):
+    """模拟问卷提交：选择题、打分、是否、可选填写项、偶尔缺字段或填错类型"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        row = {
+            'name': f'学生{rng.randint(1, 500)}',
+            'class': rng.choice(['一班', '二班', '三班', '四班']),
+            'score': rng.randint(0, 100) if rng.random() > 0.05 else '缺考',
+            'time': round(rng.uniform(10, 600), 1),
+            'agree': rng.random() < 0.6,
+            'comment': rng.choice([None, '很好', '一般', '还需改进', 'ok']),
+        }
+        if rng.random() < 0.3:
+            row['extra'] = [rng.randint(1, 5), rng.randint(1, 5)]
+        if rng.random() < 0.02:
+            del row['class']
+        rows.append(json.dumps(row, ensure_ascii=False))
+    return rows
+
+
+MIXED_VALUES = [True, False, 1, 1.0, 0, 0.0, 2, 2.5, '', '1', '1.0', 'True', 'a', 'b', None, [1], {'k': 1}]
+
+
+def _memory_db():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+    from core.models import Base, Task, Submission, TaskFieldStat
+
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[Task.__table__, Submission.__table__, TaskFieldStat.__table__])
+    return sessionmaker(bind=engine)
+
+
+def parity(trials, seed=7):
+    """统计表（分批合并、单条删除、未合并的提交读取时叠加）生成的文本与旧的逐条统计对比，返回不一致的轮数"""
+    from core.models import Task, Submission, TaskFieldStat
+    from services.field_stats import catch_up_field_stats, remove_field_stats, load_field_stats
+
+    SessionLocal = _memory_db()
+    rng = random.Random(seed)
+    settled_at = datetime.now() - timedelta(hours=1)
+    mismatches = 0
+    for trial in range(trials):
+        db = SessionLocal()
+        task = Task(title=f'parity{trial}', user_id=1, field_stats_ready=True)
+        db.add(task)
+        db.commit()
+        task_id = task.id
+        for _ in range(rng.randint(1, 12)):
+            op = rng.random()
+            if op < 0.6:
+                # 一批新提交；少数提交时间为当前（未稳定，不会被合并，读取时叠加）
+                for _ in range(rng.randint(1, 8)):
+                    row = {'x': rng.choice(MIXED_VALUES), 'y': rng.choice(MIXED_VALUES[:8])}
+                    if rng.random() < 0.1:
+                        del row['y']
+                    fresh = rng.random() < 0.1
+                    db.add(Submission(task_id=task_id, data=json.dumps(row, ensure_ascii=False),
+                                      submitted_at=datetime.now() if fresh else settled_at))
+                db.commit()
+            elif op < 0.85:
+                catch_up_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id)
+            else:
+                ids = [sub_id for (sub_id,) in db.query(Submission.id).filter(Submission.task_id == task_id)]
+                if ids:
+                    submission = db.get(Submission, rng.choice(ids))
+                    raw = submission.data
+                    db.delete(submission)
+                    db.flush()
+                    remove_field_stats(db, Task, Submission, TaskFieldStat, task_id, submission.id, raw)
+                    db.commit()
+        remaining = [raw for (raw,) in db.query(Submission.data).filter(Submission.task_id == task_id).order_by(Submission.id)]
+        db.close()
+        expected = legacy_section([json.loads(raw) for raw in remaining]) if remaining else ''
+        actual = format_field_stats(load_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id))
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"第 {trial} 轮不一致：\n{expected}{actual}")
+    return mismatches
+
+
+def ingest(n, fields=30, seed=1):
+    """单条提交（每条一个事务）的耗时：不维护统计 / 登记后台合并，以及后台合并全部提交的耗时"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from core.models import Base, Task, Submission, TaskFieldStat
+    from services.submission_counter import bump_submission_count
+    from services.field_stats import FieldStatsUpdater, catch_up_field_stats
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'ingest.db')}")
+    Base.metadata.create_all(engine, tables=[Task.__table__, Submission.__table__, TaskFieldStat.__table__])
+    SessionLocal = sessionmaker(bind=engine)
+    rng = random.Random(seed)
+    choices = ['A', 'B', 'C', 1, 2, 3, '很好']
+    updater = FieldStatsUpdater(SessionLocal, Task, Submission, TaskFieldStat)
+
+    def submit_all(task_id, mark):
+        started = time.perf_counter()
+        for _ in range(n):
+            raw = json.dumps({f'q{i}': rng.choice(choices) for i in range(fields)}, ensure_ascii=False)
+            now = datetime.now()
+            db = SessionLocal()
+            db.add(Submission(task_id=task_id, data=raw, submitted_at=now))
+            bump_submission_count(db, Task, task_id, 1, now)
+            db.commit()
+            db.close()
+            if mark:
+                updater.mark(task_id)
+        return (time.perf_counter() - started) / n * 1000
+
+    results = []
+    for mark in (False, True):
+        db = SessionLocal()
+        task = Task(title=f'ingest{mark}', user_id=1, field_stats_ready=True)
+        db.add(task)
+        db.commit()
+        task_id = task.id
+        db.close()
+        results.append(submit_all(task_id, mark))
+    started = time.perf_counter()
+    merged, _ = catch_up_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id, settle_seconds=0)
+    merge_ms = (time.perf_counter() - started) * 1000
+    return results[0], results[1], merged, merge_ms
+
+
+def best_of(func, repeat=3):
+    """重复执行取最短用时（排除首次调用的导入、缓存预热）"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    if '--parity' in sys.argv:
+        trials = int(next((a for a in sys.argv[1:] if a.isdigit()), '3000'))
+        mismatches = parity(trials)
+        print(f"统计表与逐条统计对比 {trials} 轮，不一致 {mismatches} 轮")
+        sys.exit(1 if mismatches else 0)
+    if '--ingest' in sys.argv:
+        n = int(next((a for a in sys.argv[1:] if a.isdigit()), '2000'))
+        plain_ms, marked_ms, merged, merge_ms = ingest(n)
+        print(f"单条提交：不维护统计 {plain_ms:.2f}ms，登记后台合并 {marked_ms:.2f}ms")
+        print(f"后台合并 {merged} 条：{merge_ms:.1f}ms（每条 {merge_ms / max(merged, 1):.3f}ms）")
+        return
+    sizes = [int(a) for a in sys.argv[1:] if a.isdigit()] or [1000, 10000, 100000]
+    print(f"{'条数':>8} {'逐条统计':>10} {'向量化':>10} {'加速':>6}  一致")
+    for n in sizes:
+        all_data = [json.loads(raw) for raw in make_rows(n)]
+
+        legacy_seconds, expected = best_of(lambda: legacy_section(all_data))
+        frame_seconds, actual = best_of(lambda: format_field_stats(frame_field_stats(all_data)))
+
+        print(f"{n:>8} {legacy_seconds * 1000:>8.1f}ms {frame_seconds * 1000:>8.1f}ms "
+              f"{legacy_seconds / max(frame_seconds, 1e-9):>5.1f}x  {'✓' if expected == actual else '✗'}")
+        if expected != actual:
+            print(expected)
+            print(actual)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
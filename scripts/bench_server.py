@@ -0,0 +1,211 @@
+"""
+启动方式吞吐对比：app.py（Flask 开发服务器 threaded=True）vs serve.py（waitress / gunicorn）
+
+对每种启动方式起一个子进程，用多个客户端进程并发请求 /api/<task_id>
+（80% GET 读取任务信息，20% POST 提交数据），统计每秒请求数与延迟。
+测试使用 core/quickform.db 中临时创建的任务，结束后删除该任务及其提交数据。
+
+使用方法：
+    python scripts/bench_server.py                    # 全部启动方式，每种 15 秒
+    python scripts/bench_server.py 30 flask gunicorn  # 每种 30 秒，只测指定方式
+环境变量：BENCH_CLIENTS（客户端进程数，默认 4）、BENCH_THREADS（每进程线程数，默认 8）、
+          BENCH_WORKERS（gunicorn worker 数，默认 CPU×2+1）
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import subprocess
+import threading
+import http.client
+import multiprocessing
+
+from dotenv import load_dotenv
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env_path = os.path.join(project_root, '.env')
+if os.path.exists(env_path):
+    load_dotenv(env_path)
+else:
+    load_dotenv()
+sys.path.insert(0, project_root)
+
+HOST = '127.0.0.1'
+PORT = 5810
+CLIENTS = int(os.getenv('BENCH_CLIENTS', '4'))
+THREADS = int(os.getenv('BENCH_THREADS', '8'))
+WORKERS = int(os.getenv('BENCH_WORKERS', str(2 * (os.cpu_count() or 1) + 1)))
+
+LAUNCHERS = {
+    'flask': [sys.executable, 'app.py'],
+    'waitress': [sys.executable, 'serve.py', '--server', 'waitress'],
+    'gunicorn': [sys.executable, 'serve.py', '--server', 'gunicorn'],
+}
+
+
+def create_bench_task():
+    from core.blueprint import engine, SessionLocal
+    from core.models import Task, User, migrate_database
+    migrate_database(engine)
+    db = SessionLocal()
+    try:
+        user = db.query(User).order_by(User.id).first()
+        if user is None:
+            raise RuntimeError("数据库中没有用户，请先启动一次应用完成初始化")
+        task = Task(title='bench_server 临时任务', description='压测用，会自动删除', user_id=user.id)
+        db.add(task)
+        db.commit()
+        return task.id, task.task_id
+    finally:
+        db.close()
+
+
+def delete_bench_task(task_pk):
+    from core.blueprint import SessionLocal
+    from core.models import Task, Submission
+    db = SessionLocal()
+    try:
+        db.query(Submission).filter(Submission.task_id == task_pk).delete(synchronize_session=False)
+        db.query(Task).filter(Task.id == task_pk).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def wait_ready(timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((HOST, PORT), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def _client_thread(task_id, duration, latencies, errors):
+    conn = http.client.HTTPConnection(HOST, PORT, timeout=30)
+    deadline = time.time() + duration
+    path = f'/api/{task_id}'
+    while time.time() < deadline:
+        # 每个请求用不同的来源 IP，避免触发单 IP 提交限流
+        headers = {'X-Forwarded-For': f'10.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(1, 254)}'}
+        started = time.perf_counter()
+        try:
+            if random.random() < 0.2:
+                headers['Content-Type'] = 'application/json'
+                conn.request('POST', path, body=json.dumps({'score': random.randint(1, 100), 'name': '压测'}), headers=headers)
+            else:
+                conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status != 200:
+                errors.append(resp.status)
+            latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException):
+            errors.append('conn')
+            conn.close()
+            conn = http.client.HTTPConnection(HOST, PORT, timeout=30)
+    conn.close()
+
+
+def _client_process(task_id, duration, results):
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=_client_thread, args=(task_id, duration, latencies, errors))
+        for _ in range(THREADS)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((latencies, len(errors)))
+
+
+def run_load(task_id, duration):
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_client_process, args=(task_id, duration, results)) for _ in range(CLIENTS)]
+    started = time.perf_counter()
+    for p in procs:
+        p.start()
+    latencies, errors = [], 0
+    for _ in procs:
+        lat, err = results.get()
+        latencies.extend(lat)
+        errors += err
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000 if latencies else 0.0
+
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': pct(0.50),
+        'p99_ms': pct(0.99),
+        'errors': errors,
+    }
+
+
+def bench_launcher(name, task_id, duration):
+    env = dict(os.environ)
+    env.update({
+        'FLASK_HOST': HOST, 'FLASK_PORT': str(PORT),
+        'SERVE_HOST': HOST, 'SERVE_PORT': str(PORT),
+    })
+    if name == 'gunicorn':
+        # 多进程需要共享状态后端
+        env.setdefault('STATE_BACKEND', 'sqlite')
+        env['SERVE_WORKERS'] = str(WORKERS)
+    proc = subprocess.Popen(LAUNCHERS[name], cwd=project_root, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_ready():
+            print(f"  {name}: 启动失败（检查是否已安装对应服务器）")
+            return None
+        run_load(task_id, 2)  # 预热
+        return run_load(task_id, duration)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    args = sys.argv[1:]
+    duration = int(args[0]) if args and args[0].isdigit() else 15
+    names = [a for a in args if a in LAUNCHERS] or list(LAUNCHERS)
+
+    print("=" * 60)
+    print(f"启动方式吞吐对比：{CLIENTS} 客户端进程 × {THREADS} 线程，每种 {duration} 秒，CPU {os.cpu_count()} 核")
+    print("=" * 60)
+
+    task_pk, task_id = create_bench_task()
+    rows = []
+    try:
+        for name in names:
+            print(f"\n测试 {name} ...")
+            result = bench_launcher(name, task_id, duration)
+            if result:
+                rows.append((name, result))
+                print(f"  {result['rps']:.0f} 次/秒，p50 {result['p50_ms']:.1f} ms，p99 {result['p99_ms']:.1f} ms，错误 {result['errors']}")
+    finally:
+        delete_bench_task(task_pk)
+
+    if rows:
+        base = rows[0][1]['rps'] if rows[0][0] == 'flask' else None
+        print(f"\n{'启动方式':<10}{'次/秒':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'错误':>8}{'相对flask':>12}")
+        for name, r in rows:
+            ratio = f"{r['rps'] / base:.2f}x" if base else '-'
+            print(f"{name:<10}{r['rps']:>10.0f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['errors']:>8}{ratio:>12}")
+
+
+if __name__ == '__main__':
+    main()
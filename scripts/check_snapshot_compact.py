@@ -0,0 +1,118 @@
+"""
+列式快照合并自检：随机生成多段快照（同一列在不同段中为 bool / int / float / str / 列表 / 混合类型），
+合并为一个段后逐值与原始数据对比：
+- 列类型为 mixed 时值为 str(导出单元格值)，json 时为 JSON 文本，其他类型值与类型都不变（1 / 1.0 / True 不混淆）
+- 合并前含 mixed 列（导出需要回退到数据库）的快照，合并后仍不能是无损的
+
+使用方法：
+    python scripts/check_snapshot_compact.py          # 2000 轮
+    python scripts/check_snapshot_compact.py 10000    # 指定轮数
+"""
+import os
+import sys
+import shutil
+import random
+import tempfile
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from services.export_service import cell_value
+from services.snapshot_service import SnapshotStore, SnapshotReader, _build_table, pa
+
+# 同一段内只取一组值时该段的列类型单一，取多组时为 mixed
+VALUE_GROUPS = [
+    [True, False],
+    [0, 1, 7, -3],
+    [0.5, 1.0, 2.25],
+    ['a', 'b', '1', ''],
+    [[1, 2], {'k': 'v'}],
+]
+
+
+def expected_value(value, kind):
+    if value is None:
+        return None
+    if kind == 'mixed':
+        return str(cell_value(value))
+    if kind == 'json':
+        return cell_value(value)
+    return value
+
+
+def check_trial(store, task_id, rng):
+    """生成 2-5 个段并合并，返回错误描述列表"""
+    task_dir = store.task_dir(task_id)
+    os.makedirs(task_dir)
+    source, next_id = [], 1
+    for _ in range(rng.randint(2, 5)):
+        groups = {name: rng.sample(VALUE_GROUPS, rng.choice([1, 1, 1, 2])) for name in ('x', 'y')}
+        ids, rows = [], []
+        for _ in range(rng.randint(1, 6)):
+            row = {}
+            for name, chosen in groups.items():
+                if rng.random() < 0.15:
+                    continue  # 缺字段
+                row[name] = None if rng.random() < 0.1 else rng.choice(rng.choice(chosen))
+            ids.append(next_id)
+            rows.append(row)
+            next_id += 1
+        SnapshotStore._write_segment(task_dir, _build_table(ids, rows), ids[0], ids[-1])
+        source.extend(rows)
+
+    before = SnapshotReader(store.segments(task_id))
+    lossless_before = before.lossless
+    before.close()
+    store.compact(task_id)
+
+    errors = []
+    segments = store.segments(task_id)
+    if len(segments) != 1:
+        errors.append(f"合并后有 {len(segments)} 个段")
+    after = SnapshotReader(segments)
+    kinds = dict(after.kinds)
+    if not lossless_before and after.lossless:
+        errors.append(f"合并前有 mixed 列，合并后被标记为无损: {kinds}")
+    rows = list(after.iter_rows())
+    if len(rows) != len(source):
+        errors.append(f"行数 {len(rows)} != {len(source)}")
+    for index, (row, original) in enumerate(zip(rows, source)):
+        for name, kind in kinds.items():
+            expected = expected_value(original.get(name), kind)
+            actual = row.get(name)
+            if type(actual) is not type(expected) or actual != expected:
+                errors.append(f"第 {index} 行 {name}（{kind}）: {actual!r} != {expected!r}")
+    return errors
+
+
+def main():
+    trials = int(next((a for a in sys.argv[1:] if a.isdigit()), '2000'))
+    print("=" * 60)
+    print(f"列式快照合并自检: {trials} 轮")
+    print("=" * 60)
+    if pa is None:
+        print("✗ 未安装 pyarrow，请先执行 pip install pyarrow")
+        sys.exit(1)
+
+    snapshot_dir = tempfile.mkdtemp(prefix='qf-snapshot-check-')
+    store = SnapshotStore(None, None, None, snapshot_dir, enabled=True)
+    rng = random.Random(11)
+    failed = 0
+    try:
+        for trial in range(trials):
+            errors = check_trial(store, trial, rng)
+            if errors:
+                failed += 1
+                if failed <= 3:
+                    print(f"  第 {trial} 轮: " + "；".join(errors[:5]))
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    if failed:
+        print(f"\n✗ {failed} / {trials} 轮不一致")
+        sys.exit(1)
+    print(f"\n✓ {trials} 轮合并结果与原始数据一致")
+
+
+if __name__ == '__main__':
+    main()
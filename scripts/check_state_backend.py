@@ -0,0 +1,246 @@
+"""
+共享状态后端自检：对指定后端执行接口一致性检查，并用多个进程并发自增验证计数是否共享。
+没有 Redis 时可用 --fake-redis 启动一个本地 RESP 协议替身（只实现用到的命令）来验证客户端。
+
+使用方法：
+    python scripts/check_state_backend.py                     # 检查 STATE_BACKEND 配置的后端
+    python scripts/check_state_backend.py sqlite              # 检查 SQLite 文件后端（临时文件）
+    python scripts/check_state_backend.py redis               # 检查 STATE_REDIS_URL 指向的 Redis
+    python scripts/check_state_backend.py redis --fake-redis  # 对本地 RESP 替身检查 Redis 客户端
+"""
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+import socketserver
+import multiprocessing
+
+from dotenv import load_dotenv
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env_path = os.path.join(project_root, '.env')
+if os.path.exists(env_path):
+    load_dotenv(env_path)
+else:
+    load_dotenv()
+sys.path.insert(0, project_root)
+
+from core.state import (
+    STATE_BACKEND, MemoryStateBackend, SQLiteStateBackend, RedisStateBackend
+)
+
+PROCESSES = 4
+INCR_PER_PROCESS = 500
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """RESP 协议替身：GET/SET(NX/PX/EX)/DEL/INCRBY/MULTI/EXEC/PING/SELECT/AUTH"""
+
+    def _reply(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, bool):
+            return b'+OK\r\n' if value else b'$-1\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(self._reply(v) for v in value)
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _execute(self, args):
+        server = self.server
+        cmd = args[0].upper()
+        now = time.time()
+        with server.lock:
+            data = server.data
+            key = args[1] if len(args) > 1 else None
+            if key is not None and key in data and data[key][1] is not None and data[key][1] <= now:
+                del data[key]
+            if cmd == b'GET':
+                return data[key][0] if key in data else None
+            if cmd == b'SET':
+                opts = [a.upper() for a in args[3:]]
+                if b'NX' in opts and key in data:
+                    return None
+                expires_at = None
+                if b'PX' in opts:
+                    expires_at = now + int(args[3 + opts.index(b'PX') + 1]) / 1000
+                elif b'EX' in opts:
+                    expires_at = now + int(args[3 + opts.index(b'EX') + 1])
+                data[key] = (args[2], expires_at)
+                return True
+            if cmd == b'DEL':
+                return 1 if data.pop(key, None) is not None else 0
+            if cmd == b'INCRBY':
+                value, expires_at = data.get(key, (b'0', None))
+                value = int(value) + int(args[2])
+                data[key] = (str(value).encode(), expires_at)
+                return value
+            if cmd in (b'PING', b'SELECT', b'AUTH'):
+                return True
+        raise ValueError(f"unsupported command {cmd!r}")
+
+    def handle(self):
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        queued = None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            cmd = args[0].upper()
+            if cmd == b'MULTI':
+                queued = []
+                self.wfile.write(b'+OK\r\n')
+            elif cmd == b'EXEC':
+                # 替身用一把全局锁串行执行整个事务
+                with self.server.exec_lock:
+                    results = [self._execute(a) for a in queued]
+                queued = None
+                self.wfile.write(self._reply(results))
+            elif queued is not None:
+                queued.append(args)
+                self.wfile.write(b'+QUEUED\r\n')
+            else:
+                try:
+                    with self.server.exec_lock:
+                        self.wfile.write(self._reply(self._execute(args)))
+                except ValueError as e:
+                    self.wfile.write(b'-ERR %s\r\n' % str(e).encode())
+
+
+def start_fake_redis():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FakeRedisHandler)
+    server.daemon_threads = True
+    server.data = {}
+    server.lock = threading.Lock()
+    server.exec_lock = threading.RLock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_backend(kind, target):
+    if kind == 'sqlite':
+        return SQLiteStateBackend(target)
+    if kind == 'redis':
+        return RedisStateBackend(target, prefix='qfcheck:')
+    return MemoryStateBackend()
+
+
+def check_interface(backend):
+    """逐项检查接口语义，返回失败项列表"""
+    failures = []
+
+    def expect(name, actual, expected):
+        ok = actual == expected
+        print(f"  {'✓' if ok else '✗'} {name}: {actual!r}")
+        if not ok:
+            failures.append(f"{name}: 期望 {expected!r}，实际 {actual!r}")
+
+    suffix = str(time.time_ns())
+    k = f"check:{suffix}"
+    backend.set(k, {'status': 'in_progress', 'message': '中文'}, ttl=60)
+    expect('set/get', backend.get(k), {'status': 'in_progress', 'message': '中文'})
+    expect('add 已存在', backend.add(k, 1, ttl=60), False)
+    expect('pop', backend.pop(k), {'status': 'in_progress', 'message': '中文'})
+    expect('pop 后 get', backend.get(k), None)
+    expect('pop 不存在', backend.pop(k), None)
+    expect('add 不存在', backend.add(k, 5, ttl=60), True)
+    backend.delete(k)
+    expect('delete', backend.get(k), None)
+    expect('incr 新建', backend.incr(k, 1, ttl=60), 1)
+    expect('incr 累加', backend.incr(k, 4, ttl=60), 5)
+
+    short = f"check:ttl:{suffix}"
+    backend.set(short, 'x', ttl=0.3)
+    backend.incr(short + ':n', 3, ttl=0.3)
+    backend.add(short + ':a', 'a', ttl=0.3)
+    time.sleep(0.5)
+    expect('ttl 过期 get', backend.get(short), None)
+    expect('ttl 过期后 incr 重新计数', backend.incr(short + ':n', 1, ttl=60), 1)
+    expect('ttl 过期后 add', backend.add(short + ':a', 'b', ttl=60), True)
+    for key in (k, short + ':n', short + ':a'):
+        backend.delete(key)
+    return failures
+
+
+def _incr_worker(kind, target, key, count, results):
+    backend = make_backend(kind, target)
+    for _ in range(count):
+        backend.incr(key, 1, ttl=60)
+    results.put(os.getpid())
+
+
+def check_processes(kind, target):
+    """多个进程并发自增同一个键，最终值应等于总次数"""
+    key = f"check:procs:{time.time_ns()}"
+    results = multiprocessing.Queue()
+    started = time.perf_counter()
+    procs = [
+        multiprocessing.Process(target=_incr_worker, args=(kind, target, key, INCR_PER_PROCESS, results))
+        for _ in range(PROCESSES)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - started
+    value = make_backend(kind, target).get(key)
+    expected = PROCESSES * INCR_PER_PROCESS
+    print(f"  {'✓' if value == expected else '✗'} {PROCESSES} 个进程各自增 {INCR_PER_PROCESS} 次: {value}（{elapsed:.2f}s）")
+    return [] if value == expected else [f"多进程计数: 期望 {expected}，实际 {value}"]
+
+
+def main():
+    args = sys.argv[1:]
+    kind = next((a for a in args if not a.startswith('--')), STATE_BACKEND).lower()
+    fake = None
+    target = None
+    if kind == 'sqlite':
+        target = os.path.join(tempfile.mkdtemp(prefix='qf_state_'), 'state.db')
+    elif kind == 'redis':
+        if '--fake-redis' in args:
+            fake = start_fake_redis()
+            target = f"redis://127.0.0.1:{fake.server_address[1]}/0"
+        else:
+            target = os.getenv('STATE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+    print("=" * 60)
+    print(f"共享状态后端自检: {kind}{'（本地 RESP 替身）' if fake else ''} {target or ''}")
+    print("=" * 60)
+
+    try:
+        backend = make_backend(kind, target)
+        failures = check_interface(backend)
+        if backend.shared:
+            failures += check_processes(kind, target)
+        print(f"\n后端指标: {backend.stats()}")
+    except (OSError, socket.error) as e:
+        print(f"\n✗ 无法连接后端: {str(e)}")
+        sys.exit(1)
+    finally:
+        if fake is not None:
+            fake.shutdown()
+
+    if failures:
+        print(f"\n✗ {len(failures)} 项检查失败")
+        for f in failures:
+            print(f"  - {f}")
+        sys.exit(1)
+    print("\n✓ 全部检查通过")
+
+
+if __name__ == '__main__':
+    main()
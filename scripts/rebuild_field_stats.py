@@ -0,0 +1,82 @@
+"""
+重建任务字段统计（task_field_stat 表）
+升级后旧任务的统计会在第一次 AI 分析时自动重建；数据量大的任务可以先用本脚本离线重建。
+--check 会把统计表生成的提示词片段与重新解析全部提交数据的结果逐字对比。
+
+使用方法：
+    python scripts/rebuild_field_stats.py            # 全部任务
+    python scripts/rebuild_field_stats.py 12 15      # 只处理指定任务（数据库主键 id）
+    python scripts/rebuild_field_stats.py --check    # 重建后校验
+"""
+import os
+import sys
+import json
+import time
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env_path = os.path.join(project_root, '.env')
+if os.path.exists(env_path):
+    load_dotenv(env_path)
+else:
+    load_dotenv()
+sys.path.insert(0, project_root)
+
+from core.blueprint import engine, SessionLocal
+from core.models import Task, Submission, TaskFieldStat, migrate_database
+from services.export_service import iter_submissions
+from services.field_stats import rebuild_field_stats, load_field_stats, format_field_stats, frame_field_stats
+
+
+def check(task_id):
+    """逐条解析全部提交，用提示词的 DataFrame 统计重新计算后与统计表的结果逐字对比"""
+    rows = []
+    for _, raw, _ in iter_submissions(SessionLocal, Submission, task_id):
+        try:
+            rows.append(json.loads(raw))
+        except Exception:
+            pass
+    expected = frame_field_stats(rows) if rows else None
+    return format_field_stats(expected) == format_field_stats(
+        load_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id, rebuild=False)
+    )
+
+
+def main():
+    args = sys.argv[1:]
+    task_ids = [int(a) for a in args if a.isdigit()]
+
+    print("=" * 60)
+    print("重建任务字段统计")
+    print("=" * 60)
+    migrate_database(engine)
+
+    if not task_ids:
+        db = SessionLocal()
+        try:
+            task_ids = [task_id for (task_id,) in db.query(Task.id).order_by(Task.id).all()]
+        finally:
+            db.close()
+    print(f"待处理任务: {len(task_ids)} 个")
+
+    mismatched = 0
+    for task_id in task_ids:
+        started = time.perf_counter()
+        count = rebuild_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id)
+        line = f"  任务 {task_id}: {count} 个字段，用时 {time.perf_counter() - started:.2f}s"
+        if '--check' in args:
+            ok = check(task_id)
+            mismatched += 0 if ok else 1
+            line += "，校验一致" if ok else "，✗ 校验不一致"
+        print(line)
+
+    if mismatched:
+        print(f"\n✗ {mismatched} 个任务校验不一致")
+        sys.exit(1)
+    print(f"\n✓ 完成，{len(task_ids)} 个任务的字段统计已重建")
+
+
+if __name__ == '__main__':
+    main()
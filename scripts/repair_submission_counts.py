@@ -0,0 +1,86 @@
+"""
+修复任务提交计数（Task.submission_count / Task.last_submitted_at）
+按 submission 表重新统计，用于首次上线回填或发现计数不一致时修复。
+支持SQLite和MySQL两种数据库（沿用 .env 中的数据库配置）
+
+使用方法：
+    python scripts/repair_submission_counts.py            # 重算全部任务
+    python scripts/repair_submission_counts.py 12 15      # 只重算指定任务（数据库主键 id）
+    python scripts/repair_submission_counts.py --check    # 只检查不一致，不写入
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# 加载环境变量
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env_path = os.path.join(project_root, '.env')
+if os.path.exists(env_path):
+    load_dotenv(env_path)
+else:
+    load_dotenv()
+sys.path.insert(0, project_root)
+
+from sqlalchemy import func
+
+from core.blueprint import engine, SessionLocal
+from core.models import Task, Submission, migrate_database
+from services.submission_counter import refresh_submission_counts
+
+
+def find_mismatches(db, task_ids=None):
+    """返回计数与实际提交条数不一致的任务列表 [(id, 计数字段, 实际条数)]"""
+    actual = dict(
+        db.query(Submission.task_id, func.count(Submission.id))
+        .group_by(Submission.task_id)
+        .all()
+    )
+    query = db.query(Task.id, Task.submission_count)
+    if task_ids:
+        query = query.filter(Task.id.in_(task_ids))
+    return [
+        (task_id, stored or 0, actual.get(task_id, 0))
+        for task_id, stored in query.all()
+        if (stored or 0) != actual.get(task_id, 0)
+    ]
+
+
+def main():
+    args = sys.argv[1:]
+    check_only = '--check' in args
+    task_ids = [int(a) for a in args if a.isdigit()] or None
+
+    print("=" * 60)
+    print("修复任务提交计数")
+    print("=" * 60)
+
+    # 确保计数字段已存在（旧库首次运行时会自动添加并回填）
+    migrate_database(engine)
+
+    db = SessionLocal()
+    try:
+        mismatches = find_mismatches(db, task_ids)
+        print(f"计数不一致的任务: {len(mismatches)} 个")
+        for task_id, stored, actual in mismatches[:50]:
+            print(f"  任务 {task_id}: 记录 {stored} 条，实际 {actual} 条")
+        if len(mismatches) > 50:
+            print(f"  ... 其余 {len(mismatches) - 50} 个省略")
+
+        if check_only:
+            print("\n--check 模式，未写入任何修改")
+            return
+
+        updated = refresh_submission_counts(db, Task, Submission, task_ids)
+        db.commit()
+        print(f"\n✓ 已重新计算 {updated} 个任务的提交计数")
+    except Exception as e:
+        db.rollback()
+        print(f"\n✗ 修复失败: {str(e)}")
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
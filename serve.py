@@ -0,0 +1,112 @@
+"""QuickForm 生产环境启动入口（替代 app.py 自带的 Flask 开发服务器）
+
+使用方法：
+    python serve.py                      # Linux/macOS 默认 gunicorn（多进程 + 每进程多线程）
+    python serve.py --server waitress    # 单进程多线程（Windows 默认）
+    gunicorn -c gunicorn.conf.py app:app # 与 Linux 下 python serve.py 等价
+
+环境变量（也可写在 .env）：
+    SERVE_HOST / SERVE_PORT      监听地址，默认沿用 FLASK_HOST / FLASK_PORT（127.0.0.1:5000）
+    SERVE_WORKERS                worker 进程数；未设置时 STATE_BACKEND=memory 用 1 个，
+                                 sqlite/redis 用 min(2×CPU+1, 8) 个
+    SERVE_THREADS                每个 worker 的线程数，默认 8
+    SERVE_GRACEFUL_TIMEOUT       优雅退出等待秒数，默认 30（等待进行中的分析、写完提交队列）
+"""
+import os
+import sys
+import signal
+import logging
+
+from dotenv import load_dotenv
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+env_path = os.path.join(project_root, '.env')
+if os.path.exists(env_path):
+    load_dotenv(env_path)
+else:
+    load_dotenv()
+
+logger = logging.getLogger('quickform.serve')
+
+SERVE_HOST = os.getenv('SERVE_HOST', os.getenv('FLASK_HOST', '127.0.0.1'))
+SERVE_PORT = int(os.getenv('SERVE_PORT', os.getenv('FLASK_PORT', '5000')))
+SERVE_THREADS = max(1, int(os.getenv('SERVE_THREADS', '8')))
+SERVE_GRACEFUL_TIMEOUT = max(1, int(os.getenv('SERVE_GRACEFUL_TIMEOUT', '30')))
+
+
+def default_workers():
+    """worker 进程数
+
+    限流计数、验证码、分析进度保存在共享状态后端（STATE_BACKEND）；
+    进程内存储（memory）时多个 worker 之间互相看不到，只能用 1 个进程。
+    """
+    state_backend = os.getenv('STATE_BACKEND', 'memory').lower()
+    configured = os.getenv('SERVE_WORKERS')
+    if configured:
+        workers = max(1, int(configured))
+        if workers > 1 and state_backend == 'memory':
+            logger.warning(
+                f"SERVE_WORKERS={workers} 但 STATE_BACKEND=memory：限流、验证码、分析进度不会在进程间共享，"
+                f"建议设置 STATE_BACKEND=sqlite 或 redis"
+            )
+        return workers
+    if state_backend == 'memory':
+        return 1
+    return min(2 * (os.cpu_count() or 1) + 1, 8)
+
+
+def run_gunicorn():
+    """用 gunicorn.conf.py 启动（预加载应用，fork 后每个 worker 重建连接池和后台线程）"""
+    from gunicorn.app.wsgiapp import run
+    sys.argv = [sys.argv[0], '-c', os.path.join(project_root, 'gunicorn.conf.py'), 'app:app']
+    run()
+
+
+def run_waitress():
+    """单进程多线程；收到 SIGTERM / Ctrl+C 时先优雅退出再结束"""
+    from waitress import serve
+    from app import app
+    from core.blueprint import stop_background_workers
+
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    logger.info(f"Waitress 启动: {SERVE_HOST}:{SERVE_PORT}，线程数 {SERVE_THREADS}")
+    try:
+        # 转发头（X-Forwarded-For 等）由应用内的 ProxyFix 处理；waitress 默认会清除，
+        # 那样 Nginx 后面所有请求的来源 IP 都是 127.0.0.1，限流会误伤全部用户
+        serve(app, host=SERVE_HOST, port=SERVE_PORT, threads=SERVE_THREADS,
+              clear_untrusted_proxy_headers=False)
+    finally:
+        logger.info("正在优雅退出...")
+        stop_background_workers(timeout=SERVE_GRACEFUL_TIMEOUT)
+
+
+def main():
+    args = sys.argv[1:]
+    server = 'waitress' if os.name == 'nt' else 'gunicorn'
+    if '--server' in args:
+        server = args[args.index('--server') + 1].lower()
+
+    if server == 'gunicorn':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            print("未安装 gunicorn，请执行 pip install gunicorn，或使用 --server waitress")
+            sys.exit(1)
+        run_gunicorn()
+    elif server == 'waitress':
+        try:
+            import waitress  # noqa: F401
+        except ImportError:
+            print("未安装 waitress，请执行 pip install waitress")
+            sys.exit(1)
+        run_waitress()
+    else:
+        print(f"未知的服务器类型: {server}（可选 gunicorn / waitress）")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
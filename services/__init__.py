@@ -3,3 +3,21 @@
 from .file_service import *
 from .ai_service import *
 from .report_service import *
+from .submission_queue import *
+from .submission_counter import *
+from .task_cache import *
+from .rate_limit_events import *
+from .export_service import *
+from .export_jobs import *
+from .snapshot_service import *
+from .field_stats import *
+from .sampling import *
+from .ai_http import *
+from .ai_executor import *
+from .analysis_jobs import *
+from .report_stream import *
+from .ai_cache import *
+from .call_context import *
+from .chunked_analysis import *
+from .prompt_budget import *
+from .ai_usage import *
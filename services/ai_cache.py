@@ -0,0 +1,188 @@
+"""AI 响应缓存 - 同样的请求不再重复调用服务商
+
+教师经常在任务数据没有变化时多次点击“生成报告”，编辑任务时重新上传完全相同的 HTML 也会再分析一次，
+每次都要 30~180 秒并产生费用。call_ai_model 在发起网络请求之前先查这里：
+- 键：sha256(服务商, 模型, 温度, sha256(提示词))，同一提示词换了模型或温度不会命中
+- 存放在 ai_cache_entry 表，多 worker 共用
+- 淘汰：超过 AI_CACHE_TTL_HOURS 小时过期；条数超过 AI_CACHE_MAX_ENTRIES 或总大小超过 AI_CACHE_MAX_MB 时
+  按最近使用时间淘汰（最多每 AI_CACHE_EVICT_INTERVAL 秒检查一次）
+- “强制重新生成”跳过读取，新结果覆盖旧的缓存
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() == 'true'
+AI_CACHE_TTL_HOURS = float(os.getenv('AI_CACHE_TTL_HOURS', str(7 * 24)))     # 缓存有效期（小时）
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '2000'))         # 最多保留条数
+AI_CACHE_MAX_MB = float(os.getenv('AI_CACHE_MAX_MB', '64'))                   # 最多占用（MB，按响应文本计）
+AI_CACHE_EVICT_INTERVAL = 300                                                 # 淘汰检查间隔（秒）
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def cache_key(provider, model, temperature, prompt):
+    """(服务商, 模型, 温度, sha256(提示词)) -> 缓存键"""
+    prompt_hash = _sha256(prompt or '')
+    return _sha256(json.dumps([provider, model, temperature, prompt_hash])), prompt_hash
+
+
+class AIResponseCache:
+    """ai_cache_entry 表的读写与淘汰"""
+
+    def __init__(self, SessionLocal, AICacheEntry, ttl_hours=AI_CACHE_TTL_HOURS, max_entries=AI_CACHE_MAX_ENTRIES,
+                 max_mb=AI_CACHE_MAX_MB):
+        self.SessionLocal = SessionLocal
+        self.AICacheEntry = AICacheEntry
+        self.ttl = timedelta(hours=max(0.01, ttl_hours))
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = int(max(1, max_mb) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+        self._stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'stored': 0, 'evicted': 0, 'errors': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def get(self, provider, model, temperature, prompt):
+        """命中返回缓存的响应文本，否则返回 None"""
+        Entry = self.AICacheEntry
+        key, _ = cache_key(provider, model, temperature, prompt)
+        now = datetime.now()
+        db = self.SessionLocal()
+        try:
+            row = db.query(Entry.id, Entry.response, Entry.expires_at).filter(Entry.cache_key == key).first()
+            if row is None or row.expires_at <= now:
+                self._count('misses')
+                return None
+            db.execute(
+                update(Entry).where(Entry.id == row.id)
+                .values(hit_count=Entry.hit_count + 1, last_used_at=now)
+            )
+            db.commit()
+            self._count('hits')
+            return row.response
+        except Exception as e:
+            db.rollback()
+            self._count('errors')
+            logger.error(f"读取AI响应缓存失败: {str(e)}")
+            return None
+        finally:
+            db.close()
+
+    def bypass(self):
+        """记录一次跳过缓存（强制重新生成）"""
+        self._count('bypassed')
+
+    def put(self, provider, model, temperature, prompt, response):
+        """保存响应；同一个键已存在时覆盖"""
+        if not response or not response.strip():
+            return
+        Entry = self.AICacheEntry
+        key, prompt_hash = cache_key(provider, model, temperature, prompt)
+        now = datetime.now()
+        values = {
+            'response': response,
+            'size': len(response.encode('utf-8')),
+            'created_at': now,
+            'last_used_at': now,
+            'expires_at': now + self.ttl,
+        }
+        db = self.SessionLocal()
+        try:
+            try:
+                db.add(Entry(cache_key=key, provider=provider, model=model, temperature=temperature,
+                             prompt_hash=prompt_hash, hit_count=0, **values))
+                db.commit()
+            except IntegrityError:
+                # 已有缓存（强制重新生成或并发写入）：覆盖
+                db.rollback()
+                db.execute(update(Entry).where(Entry.cache_key == key).values(**values))
+                db.commit()
+            self._count('stored')
+        except Exception as e:
+            db.rollback()
+            self._count('errors')
+            logger.error(f"写入AI响应缓存失败: {str(e)}")
+        finally:
+            db.close()
+        self.evict()
+
+    def evict(self, force=False):
+        """删除过期缓存；超出条数或总大小时按最近使用时间淘汰，返回删除条数"""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_evict < AI_CACHE_EVICT_INTERVAL:
+                return 0
+            self._last_evict = now
+        Entry = self.AICacheEntry
+        db = self.SessionLocal()
+        try:
+            removed = db.execute(delete(Entry).where(Entry.expires_at <= datetime.now())).rowcount or 0
+            count, total = db.query(func.count(Entry.id), func.coalesce(func.sum(Entry.size), 0)).one()
+            if count > self.max_entries or total > self.max_bytes:
+                # 从最久未使用的开始累计，找到需要删除的最后一条
+                excess_count = max(0, count - self.max_entries)
+                excess_bytes = max(0, total - self.max_bytes)
+                boundary = None
+                dropped = dropped_bytes = 0
+                rows = (
+                    db.query(Entry.id, Entry.size, Entry.last_used_at)
+                    .order_by(Entry.last_used_at, Entry.id)
+                    .yield_per(500)
+                )
+                for row in rows:
+                    if dropped >= excess_count and dropped_bytes >= excess_bytes:
+                        break
+                    boundary = row
+                    dropped += 1
+                    dropped_bytes += row.size or 0
+                if boundary is not None:
+                    removed += db.execute(
+                        delete(Entry).where(
+                            (Entry.last_used_at < boundary.last_used_at)
+                            | ((Entry.last_used_at == boundary.last_used_at) & (Entry.id <= boundary.id))
+                        )
+                    ).rowcount or 0
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self._count('errors')
+            logger.error(f"淘汰AI响应缓存失败: {str(e)}")
+            return 0
+        finally:
+            db.close()
+        if removed:
+            logger.info(f"已淘汰AI响应缓存 {removed} 条")
+            self._count('evicted', removed)
+        return removed
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        lookups = s['hits'] + s['misses']
+        s['hit_rate'] = round(s['hits'] / lookups, 4) if lookups else None
+        s['enabled'] = AI_CACHE_ENABLED
+        Entry = self.AICacheEntry
+        db = self.SessionLocal()
+        try:
+            count, total = db.query(func.count(Entry.id), func.coalesce(func.sum(Entry.size), 0)).one()
+            s['entries'] = count
+            s['bytes'] = int(total)
+        except Exception as e:
+            logger.error(f"读取AI响应缓存统计失败: {str(e)}")
+        finally:
+            db.close()
+        return s
@@ -0,0 +1,378 @@
+"""AI 任务执行器 - 固定大小的工作线程池 + 每个服务商的并发上限 + 按用户轮转的公平队列
+
+原来每次生成报告、每次上传 HTML 都新开一个线程，分析里再用 timeout 装饰器套一个线程：
+一批上传就可能有上百个线程同时卡在同一个服务商上，超时后线程也不会退出。这里统一排队：
+- AI_EXECUTOR_WORKERS 个工作线程（进程内懒启动，gunicorn fork 后在 worker 中创建）
+- 每个服务商同时进行的请求不超过 AI_PROVIDER_CONCURRENCY（可用 AI_CONCURRENCY_<服务商> 单独设置），
+  已满的服务商的任务留在队列里，不占用工作线程
+- 每个用户一个先进先出队列，用户之间轮转取任务，一个用户连续提交很多任务不会挡住其他人
+- 排队位置变化时回调 on_position，便于写入进度供 /api/report_status 查询
+- 取消：排队中的任务直接移出队列；运行中的任务设置 cancel_event，由任务在各阶段之间检查，
+  并调用任务登记的取消回调（services.call_context 借此关闭正在读取的连接）
+- 任务内部的并行子调用（分块汇总的各块）用 provider_slot 各占一个服务商名额，与排队的任务共用上限；
+  等待子调用期间任务用 lend_slot 让出自己的名额，同一服务商同时进行的请求总数不超过上限
+"""
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+AI_EXECUTOR_WORKERS = int(os.getenv('AI_EXECUTOR_WORKERS', '8'))          # 工作线程数
+AI_PROVIDER_CONCURRENCY = int(os.getenv('AI_PROVIDER_CONCURRENCY', '4'))  # 每个服务商的默认并发上限
+AI_QUEUE_MAX_PER_USER = int(os.getenv('AI_QUEUE_MAX_PER_USER', '10'))     # 每个用户最多排队的任务数
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+class QueueFull(Exception):
+    """用户排队的任务过多"""
+
+
+class AIJob:
+    """一个排队执行的 AI 任务；func(job) 在工作线程中执行"""
+
+    def __init__(self, key, user_id, provider, func, on_position=None, on_cancel=None):
+        self.key = key
+        self.user_id = user_id
+        self.provider = provider
+        self.func = func
+        self.on_position = on_position
+        self.on_cancel = on_cancel
+        self.status = 'queued'          # queued / running / done / failed / cancelled
+        self.position = None
+        self.cancel_event = threading.Event()
+        self._cancel_hooks = []
+        self._hooks_lock = threading.Lock()
+        self.executor = None            # 所属的 AIJobExecutor（submit 时设置）
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """在任务的各阶段之间调用：已取消时抛出 JobCancelled"""
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"任务 {self.key} 已取消")
+
+    def add_cancel_hook(self, hook):
+        """任务被取消时调用 hook()；已取消时立即调用"""
+        with self._hooks_lock:
+            if not self.cancel_event.is_set():
+                self._cancel_hooks.append(hook)
+                return
+        hook()
+
+    def remove_cancel_hook(self, hook):
+        with self._hooks_lock:
+            if hook in self._cancel_hooks:
+                self._cancel_hooks.remove(hook)
+
+    def cancel(self):
+        """设置取消标记并调用取消回调"""
+        with self._hooks_lock:
+            self.cancel_event.set()
+            hooks, self._cancel_hooks = self._cancel_hooks, []
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"AI 任务取消回调失败 - {self.key}: {str(e)}")
+
+
+def provider_limit(provider, default=AI_PROVIDER_CONCURRENCY):
+    raw = os.getenv(f'AI_CONCURRENCY_{str(provider).upper()}', '').strip()
+    try:
+        return max(1, int(raw)) if raw else max(1, default)
+    except ValueError:
+        return max(1, default)
+
+
+class AIJobExecutor:
+    """AI 任务执行器"""
+
+    def __init__(self, workers=AI_EXECUTOR_WORKERS, provider_concurrency=AI_PROVIDER_CONCURRENCY,
+                 max_per_user=AI_QUEUE_MAX_PER_USER):
+        self.workers = max(1, workers)
+        self.provider_concurrency = provider_concurrency
+        self.max_per_user = max(1, max_per_user)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()     # user_id -> deque[AIJob]，顺序即轮转顺序
+        self._jobs = {}                  # key -> 排队中或运行中的 AIJob（运行中的任务被取消后可被同 key 的新任务替换）
+        self._active = set()             # 运行中的 AIJob
+        self._running = {}               # provider -> 运行中的任务数
+        self._limits = {}
+        self._threads = []
+        self._stopping = False
+        self._pid = None
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'rejected': 0, 'sub_calls': 0}
+
+    # ---------- 对外接口 ----------
+    def submit(self, key, user_id, provider, func, on_position=None, on_cancel=None):
+        """提交任务；同一 key 已在排队或运行（且未取消）时返回已有任务。用户排队过多时抛出 QueueFull"""
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError('服务正在停止，请稍后重试')
+            existing = self._jobs.get(key)
+            if existing is not None and not existing.cancelled:
+                return existing
+            queue = self._queues.get(user_id)
+            if queue is not None and len(queue) >= self.max_per_user:
+                self._stats['rejected'] += 1
+                raise QueueFull(f'排队中的分析任务过多（最多 {self.max_per_user} 个），请等待完成后再提交')
+            job = AIJob(key, user_id, provider, func, on_position, on_cancel)
+            job.executor = self
+            if queue is None:
+                queue = self._queues[user_id] = deque()
+            queue.append(job)
+            self._jobs[key] = job
+            self._stats['submitted'] += 1
+            self._ensure_workers()
+            self._cond.notify()
+            changes = self._reposition()
+        self._notify_positions(changes)
+        return job
+
+    def get(self, key):
+        with self._cond:
+            return self._jobs.get(key)
+
+    def position(self, key):
+        """排队位置（前面还有几个任务）；运行中返回 0，不存在返回 None"""
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None:
+                return None
+            return 0 if job.status == 'running' else job.position
+
+    def cancel(self, key):
+        """取消任务：返回取消前的状态 'queued' / 'running'，任务不存在返回 None"""
+        with self._cond:
+            job = self._jobs.get(key)
+            if job is None:
+                return None
+            job.cancel()
+            if job.status != 'queued':
+                return job.status
+            self._remove_queued(job)
+            changes = self._reposition()
+        self._notify_cancelled(job, '已取消')
+        self._notify_positions(changes)
+        return 'queued'
+
+    @contextmanager
+    def provider_slot(self, provider, check=None):
+        """任务内部的子调用占用服务商的一个并发名额（与排队的任务共用上限），名额已满时等待
+
+        check()：等待期间定期调用，可抛出异常中断等待（取消、超时）；执行器停止时抛出 JobCancelled
+        """
+        with self._cond:
+            while self._running.get(provider, 0) >= self._limit(provider):
+                if self._stopping:
+                    raise JobCancelled('服务正在停止')
+                if check is not None:
+                    check()
+                self._cond.wait(0.2)
+            self._running[provider] = self._running.get(provider, 0) + 1
+            self._stats['sub_calls'] += 1
+        try:
+            yield
+        finally:
+            self._release(provider)
+
+    @contextmanager
+    def lend_slot(self, job):
+        """运行中的任务等待自己的子调用（各自占用 provider_slot）期间让出自己的名额，结束后重新占用"""
+        self._release(job.provider)
+        try:
+            yield
+        finally:
+            with self._cond:
+                # 已取消或正在停止时不再等待：任务马上结束，_run 会归还名额
+                while (self._running.get(job.provider, 0) >= self._limit(job.provider)
+                       and not job.cancelled and not self._stopping):
+                    self._cond.wait(0.2)
+                self._running[job.provider] = self._running.get(job.provider, 0) + 1
+
+    def _release(self, provider):
+        with self._cond:
+            self._running[provider] = max(0, self._running.get(provider, 0) - 1)
+            # 服务商腾出名额，唤醒等待的工作线程和子调用
+            self._cond.notify_all()
+
+    # ---------- 调度 ----------
+    def _ensure_workers(self):
+        if self._pid != os.getpid():
+            # 延迟创建；fork 出的子进程重新创建线程
+            self._threads = []
+            self._pid = os.getpid()
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._worker, name=f'ai-worker-{len(self._threads) + 1}', daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def _limit(self, provider):
+        limit = self._limits.get(provider)
+        if limit is None:
+            limit = self._limits[provider] = provider_limit(provider, self.provider_concurrency)
+        return limit
+
+    def _take(self):
+        """按用户轮转取第一个服务商未满的任务（每个用户只看队首，保证用户内先进先出）"""
+        for user_id in list(self._queues):
+            queue = self._queues[user_id]
+            job = queue[0]
+            if self._running.get(job.provider, 0) >= self._limit(job.provider):
+                continue
+            queue.popleft()
+            # 取过任务的用户移到队尾
+            del self._queues[user_id]
+            if queue:
+                self._queues[user_id] = queue
+            self._running[job.provider] = self._running.get(job.provider, 0) + 1
+            self._active.add(job)
+            job.status = 'running'
+            job.position = 0
+            job.started_at = time.time()
+            return job
+        return None
+
+    def _remove_queued(self, job):
+        queue = self._queues.get(job.user_id)
+        if queue is not None:
+            try:
+                queue.remove(job)
+            except ValueError:
+                pass
+            if not queue:
+                del self._queues[job.user_id]
+        self._jobs.pop(job.key, None)
+        job.status = 'cancelled'
+        job.finished_at = time.time()
+        self._stats['cancelled'] += 1
+
+    def _reposition(self):
+        """按轮转顺序重新计算排队位置，返回位置有变化的 [(job, 位置)]"""
+        changes = []
+        position = 0
+        queues = [list(q) for q in self._queues.values()]
+        depth = max((len(q) for q in queues), default=0)
+        for i in range(depth):
+            for queue in queues:
+                if i < len(queue):
+                    job = queue[i]
+                    if job.position != position:
+                        job.position = position
+                        changes.append((job, position))
+                    position += 1
+        return changes
+
+    def _notify_positions(self, changes):
+        for job, position in changes:
+            # 通知在锁外进行，期间任务可能已经开始执行
+            if job.on_position is not None and job.status == 'queued':
+                try:
+                    job.on_position(position)
+                except Exception as e:
+                    logger.error(f"更新排队位置失败 - {job.key}: {str(e)}")
+
+    def _notify_cancelled(self, job, reason):
+        if job.on_cancel is not None:
+            try:
+                job.on_cancel(reason)
+            except Exception as e:
+                logger.error(f"取消回调失败 - {job.key}: {str(e)}")
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = None
+                while not self._stopping:
+                    job = self._take()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                if job is None:
+                    return
+                changes = self._reposition()
+            self._notify_positions(changes)
+            self._run(job)
+
+    def _run(self, job):
+        status = 'done'
+        try:
+            job.check_cancelled()
+            job.func(job)
+            if job.cancelled:
+                status = 'cancelled'
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            status = 'failed'
+            logger.error(f"AI 任务执行失败 - {job.key}: {str(e)}", exc_info=True)
+        finally:
+            with self._cond:
+                self._running[job.provider] = max(0, self._running.get(job.provider, 0) - 1)
+                self._active.discard(job)
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+                job.status = status
+                job.finished_at = time.time()
+                self._stats[{'done': 'completed', 'failed': 'failed', 'cancelled': 'cancelled'}[status]] += 1
+                # 服务商腾出名额，唤醒等待的工作线程
+                self._cond.notify_all()
+        if status == 'cancelled':
+            self._notify_cancelled(job, '已取消')
+
+    # ---------- 生命周期 ----------
+    def stop(self, timeout=20):
+        """停止：排队中的任务取消，运行中的任务设置取消标记并等待最多 timeout 秒；返回被中断的任务"""
+        with self._cond:
+            self._stopping = True
+            queued = [job for queue in self._queues.values() for job in queue]
+            for job in queued:
+                job.cancel()
+                self._remove_queued(job)
+            running = list(self._active)
+            threads = list(self._threads)
+            self._cond.notify_all()
+        for job in queued:
+            self._notify_cancelled(job, '服务重启，分析已中断，请重新生成报告')
+        if running:
+            logger.info(f"等待 {len(running)} 个 AI 任务结束（最多 {timeout} 秒）...")
+        deadline = time.monotonic() + timeout
+        for t in threads:
+            t.join(max(0, deadline - time.monotonic()))
+        interrupted = [job for job in running if job.status == 'running']
+        for job in interrupted:
+            job.cancel()
+            self._notify_cancelled(job, '服务重启，分析已中断，请重新生成报告')
+        if interrupted:
+            logger.warning(f"{len(interrupted)} 个 AI 任务在退出前未完成，已标记为中断")
+        return queued + interrupted
+
+    def stats(self):
+        with self._cond:
+            queued = {}
+            for queue in self._queues.values():
+                for job in queue:
+                    queued[job.provider] = queued.get(job.provider, 0) + 1
+            s = dict(self._stats)
+            s.update({
+                'workers': self.workers,
+                'threads_alive': sum(1 for t in self._threads if t.is_alive()),
+                'queued': queued,
+                'running': {p: n for p, n in self._running.items() if n},
+                'limits': dict(self._limits),
+                'users_waiting': len(self._queues),
+            })
+            return s
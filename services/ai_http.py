@@ -0,0 +1,299 @@
+"""AI 服务商 HTTP 连接池 - 每个服务商一个长连接会话
+
+原来每次调用都是裸 requests.post：一次分析、一次 HTML 分析、一次 /api/test_ai 都要重新建立 TCP + TLS 连接
+（国内访问这些接口握手通常要 100~300ms）。这里为每个服务商维护一个会话：
+- requests.Session + HTTPAdapter：连接池大小 AI_HTTP_POOL_SIZE，连接保持复用（keep-alive）
+- 安装了 httpx 和 h2 时（pip install 'httpx[http2]'）改用 httpx.Client(http2=True)，多个请求复用同一条连接
+- 每个服务商单独的连接 / 读取超时，可用环境变量覆盖：AI_TIMEOUT_DEEPSEEK=5,60
+- 接口地址可用环境变量覆盖（私有网关、本地压测）：AI_URL_DEEPSEEK=https://...
+- 在 services.call_context.call_scope 内发出的请求：超时不超过剩余时限；任务取消时关闭正在读取的连接
+  （httpx 会话只受时限约束，取消在下一行数据到达时生效）
+会话在进程内懒创建，gunicorn fork 出的 worker 不会共用主进程的连接。
+"""
+import os
+import threading
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .call_context import DeadlineExceeded, current_call
+
+try:
+    import httpx
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持需要 h2
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+AI_HTTP_POOL_SIZE = int(os.getenv('AI_HTTP_POOL_SIZE', '10'))        # 每个服务商最多保持的连接数
+AI_HTTP2 = os.getenv('AI_HTTP2', 'auto').lower()                     # auto：装了 httpx[http2] 就用；false：始终用 requests
+
+# 服务商：接口地址、(连接超时, 读取超时)
+AI_PROVIDERS = {
+    'deepseek': {
+        'label': 'DeepSeek',
+        'url': 'https://api.deepseek.com/v1/chat/completions',
+        'timeout': (10, 60),
+    },
+    'doubao': {
+        'label': '豆包',
+        'url': 'https://ark.cn-beijing.volces.com/api/v3/chat/completions',
+        'timeout': (10, 120),
+    },
+    'qwen': {
+        'label': '阿里云百炼',
+        'url': 'https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation',
+        'timeout': (10, 120),
+    },
+    'chat_server': {
+        'label': '硅基流动',
+        'url': 'https://api.siliconflow.cn/v1/chat/completions',
+        'timeout': (5, 120),
+    },
+}
+
+
+def _env_timeout(provider, default):
+    """AI_TIMEOUT_<服务商>=连接,读取 或 =读取"""
+    raw = os.getenv(f'AI_TIMEOUT_{provider.upper()}', '').strip()
+    if not raw:
+        return default
+    try:
+        parts = [float(p) for p in raw.split(',')]
+        return (parts[0], parts[1]) if len(parts) > 1 else (default[0], parts[0])
+    except ValueError:
+        logger.warning(f"无效的超时设置 AI_TIMEOUT_{provider.upper()}={raw}，使用默认值")
+        return default
+
+
+def provider_url(provider):
+    return os.getenv(f'AI_URL_{provider.upper()}', '').strip() or AI_PROVIDERS[provider]['url']
+
+
+def provider_timeout(provider):
+    return _env_timeout(provider, AI_PROVIDERS[provider]['timeout'])
+
+
+class _TrackedConnectionMixin:
+    """等待响应前把套接字登记到当前线程的 CallContext，取消时由其关闭"""
+
+    def getresponse(self, *args, **kwargs):
+        context = current_call()
+        if context is not None and self.sock is not None:
+            context.attach(self.sock)
+        return super().getresponse(*args, **kwargs)
+
+
+class _TrackedHTTPConnection(_TrackedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TrackedHTTPSConnection(_TrackedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+
+class _TrackedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TrackedHTTPConnectionPool,
+            'https': _TrackedHTTPSConnectionPool,
+        }
+
+
+def _call_timeout(provider):
+    """(连接超时, 读取超时)；在 call_scope 内时不超过剩余时限（已超时 / 已取消则直接抛出）"""
+    default = provider_timeout(provider)
+    context = current_call()
+    if context is None:
+        return default, None
+    context.check()
+    return context.http_timeout(default), context
+
+
+def _raise_for_context(context):
+    """请求出错时：如果是因为取消或超过时限，改为抛出 JobCancelled / DeadlineExceeded"""
+    if context is not None:
+        context.check()
+
+
+class AIHttpRegistry:
+    """按服务商缓存 HTTP 会话；线程安全，进程 fork 后自动重建"""
+
+    def __init__(self, pool_size=AI_HTTP_POOL_SIZE, http2=AI_HTTP2):
+        self.pool_size = max(1, pool_size)
+        self.use_http2 = httpx is not None and http2 != 'false'
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stats = {}
+
+    def _new_session(self, provider):
+        connect_timeout, read_timeout = provider_timeout(provider)
+        if self.use_http2:
+            return httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        session = requests.Session()
+        # 不自动重试：AI 请求不是幂等的，失败由调用方决定是否重试
+        adapter = _TrackedAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def session(self, provider):
+        if provider not in AI_PROVIDERS:
+            raise ValueError(f"不支持的AI模型: {provider}")
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork 出的子进程：不能复用父进程的连接
+                self._sessions = {}
+                self._stats = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(provider)
+            if session is None:
+                session = self._sessions[provider] = self._new_session(provider)
+                logger.info(f"已创建 {AI_PROVIDERS[provider]['label']} 连接池（{'HTTP/2' if self.use_http2 else 'HTTP/1.1 keep-alive'}，"
+                            f"最多 {self.pool_size} 个连接，超时 {provider_timeout(provider)}）")
+            return session
+
+    def post(self, provider, headers=None, json=None):
+        """向服务商接口发送 POST；超时抛出 requests.Timeout，其他网络错误抛出 requests.RequestException"""
+        session = self.session(provider)
+        url = provider_url(provider)
+        timeout, context = _call_timeout(provider)
+        self._count(provider, 'requests')
+        try:
+            if not self.use_http2:
+                return session.post(url, headers=headers, json=json, timeout=timeout)
+            try:
+                return _HttpxResponse(session.post(url, headers=headers, json=json, timeout=_httpx_timeout(timeout)))
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(str(e)) from e
+            except httpx.HTTPError as e:
+                raise requests.RequestException(str(e)) from e
+        except DeadlineExceeded:
+            raise
+        except requests.RequestException:
+            _raise_for_context(context)
+            raise
+        finally:
+            if context is not None:
+                context.detach_all()
+
+    def stream_lines(self, provider, headers=None, json=None):
+        """以流式方式 POST，逐行返回响应体（str，已去掉行尾换行），用于 SSE 格式的流式输出
+
+        状态码 >= 400 时读取响应体并抛出 requests.HTTPError；网络错误同 post
+        """
+        session = self.session(provider)
+        url = provider_url(provider)
+        timeout, context = _call_timeout(provider)
+        self._count(provider, 'requests')
+        self._count(provider, 'streams')
+        try:
+            if not self.use_http2:
+                response = session.post(url, headers=headers, json=json, timeout=timeout, stream=True)
+                try:
+                    if response.status_code >= 400:
+                        raise requests.HTTPError(f"HTTP {response.status_code}: {response.text[:200]}", response=response)
+                    # SSE 固定为 UTF-8，不按 Content-Type 猜测编码
+                    response.encoding = 'utf-8'
+                    # chunk_size=None：分块传输时每收到一块就处理，不等凑满固定字节数
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if context is not None:
+                            # 读取超时按行计算：每行都收紧到剩余时限，整次流式读取不会超出时限
+                            context.check()
+                            context.tighten(timeout[1])
+                        yield line
+                finally:
+                    response.close()
+                return
+            try:
+                with session.stream('POST', url, headers=headers, json=json, timeout=_httpx_timeout(timeout)) as response:
+                    if response.status_code >= 400:
+                        response.read()
+                        raise requests.HTTPError(f"HTTP {response.status_code}: {response.text[:200]}")
+                    for line in response.iter_lines():
+                        if context is not None:
+                            context.check()
+                        yield line
+            except httpx.TimeoutException as e:
+                raise requests.Timeout(str(e)) from e
+            except httpx.HTTPError as e:
+                raise requests.RequestException(str(e)) from e
+        except DeadlineExceeded:
+            raise
+        except requests.RequestException:
+            _raise_for_context(context)
+            raise
+        finally:
+            if context is not None:
+                context.detach_all()
+
+    def _count(self, provider, key):
+        with self._lock:
+            provider_stats = self._stats.setdefault(provider, {'requests': 0})
+            provider_stats[key] = provider_stats.get(key, 0) + 1
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            result = {'http2': self.use_http2, 'pool_size': self.pool_size, 'providers': {}}
+            for provider, session in self._sessions.items():
+                provider_stats = dict(self._stats.get(provider, {}))
+                if not self.use_http2:
+                    # urllib3 连接池累计新建的连接数；远小于请求数说明连接在复用
+                    pools = session.get_adapter('https://').poolmanager.pools
+                    provider_stats['connections'] = sum(
+                        getattr(pools[key], 'num_connections', 0) for key in list(pools.keys())
+                    )
+                provider_stats['timeout'] = provider_timeout(provider)
+                result['providers'][provider] = provider_stats
+            return result
+
+
+def _httpx_timeout(timeout):
+    connect_timeout, read_timeout = timeout
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+
+class _HttpxResponse:
+    """httpx 响应适配为 call_ai_model 用到的 requests.Response 接口"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.text = response.text
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self._response.url}", response=None)
+
+
+ai_http = AIHttpRegistry()
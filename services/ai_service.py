@@ -1,90 +1,254 @@
 """AI服务 - 处理AI模型调用和分析相关功能"""
 import json
+import time
 import requests
 import threading
 import logging
 from datetime import datetime
-from collections import Counter
 from flask import current_app
 
+from .field_stats import format_field_schema, format_field_stats, frame_field_stats
+from .sampling import sample_submissions, sample_from_list
+from .export_service import iter_submissions
+from .ai_http import ai_http
+from .ai_executor import JobCancelled
+from .ai_cache import AI_CACHE_ENABLED
+from .call_context import AI_JOB_DEADLINE, call_scope, current_call
+from .prompt_budget import AI_OUTPUT_TOKENS, SAMPLE_LEVELS, SampleBlock, estimate_tokens
+from .ai_usage import AI_STREAM_USAGE, parse_usage, record_usage
+
 logger = logging.getLogger(__name__)
 
+AI_SYSTEM_PROMPT = "你面向的用户一般是教师和学生"
+# 各服务商使用的模型和温度（同时作为 AI 响应缓存键的一部分）
+AI_MODEL_PARAMS = {
+    'deepseek': {'model': 'deepseek-chat', 'temperature': 0.7},
+    'doubao': {'model': 'doubao-seed-1-6-251015', 'temperature': 0.7},
+    'qwen': {'model': 'qwen-plus', 'temperature': 0.7},
+    'chat_server': {'model': 'deepseek-ai/DeepSeek-V2.5', 'temperature': None},  # 使用服务端默认温度
+}
+
+# 默认分析要求：放在提示词开头，每次分析都相同，可命中服务商的上下文缓存
+DEFAULT_ANALYSIS_INSTRUCTIONS = """你是一个数据分析专家，请基于本提示词末尾提供的表单数据撰写详细的分析报告。
+
+请提供一个全面的数据分析报告，包括但不限于：
+1. 数据概览：总提交量、关键数据分布、字段类型统计
+2. 主要发现：数据中的趋势、模式、异常和相关性
+3. 深入分析：基于数据的详细洞察，包括分布特征、集中趋势、离散程度等
+4. 建议和结论：基于分析结果的实用建议和改进方向
+
+请以中文撰写报告，使用Markdown格式，包括适当的标题、列表和表格来增强可读性。
+
+以下是表单数据：
+"""
+
+HTML_ANALYSIS_COMPRESSED_CHARS = 500   # 提示词超出预算时 HTML 分析结果保留的字数
+
+# AI 响应缓存（services/ai_cache.py），由 configure_ai_cache 注入；未注入时不使用缓存
+_ai_cache = None
+
+
+def configure_ai_cache(cache):
+    """设置 call_ai_model 使用的 AIResponseCache"""
+    global _ai_cache
+    _ai_cache = cache
+
 
-def call_ai_model(prompt, ai_config):
-    """调用AI模型生成分析报告"""
+def _sse_payloads(lines):
+    """从 SSE 响应行中取出 data 字段（JSON 文本）；忽略 id / event / 注释行"""
+    for line in lines:
+        if not line or not line.startswith('data:'):
+            continue
+        payload = line[5:].strip()
+        if payload:
+            yield payload
+
+
+def _stream_openai_compatible(provider, headers, data, on_delta):
+    """OpenAI 兼容接口的流式调用（DeepSeek、豆包、硅基流动）：逐段回调 on_delta，返回 (完整文本, token 用量)"""
+    parts = []
+    usage = None
+    data = dict(data, stream=True)
+    if AI_STREAM_USAGE:
+        # 最后一段（choices 为空）返回 token 用量，含上下文缓存命中数
+        data['stream_options'] = {'include_usage': True}
+    for payload in _sse_payloads(ai_http.stream_lines(provider, headers=headers, json=data)):
+        if payload == '[DONE]':
+            break
+        chunk = json.loads(payload)
+        if isinstance(chunk, dict) and chunk.get('error'):
+            error = chunk['error']
+            raise Exception(error.get('message') if isinstance(error, dict) else str(error))
+        usage = parse_usage(chunk) or usage
+        choices = chunk.get('choices') or []
+        delta = (choices[0].get('delta') or {}).get('content') if choices else None
+        if delta:
+            parts.append(delta)
+            if on_delta is not None:
+                on_delta(delta)
+    if not parts:
+        raise Exception('流式响应中没有内容')
+    return ''.join(parts), usage
+
+
+def _stream_qwen(headers, data, on_delta):
+    """阿里云百炼增量输出（X-DashScope-SSE + incremental_output）：逐段回调 on_delta，返回 (完整文本, token 用量)"""
+    headers = dict(headers, **{'X-DashScope-SSE': 'enable'})
+    data = dict(data, parameters=dict(data.get('parameters') or {}, incremental_output=True))
+    parts = []
+    usage = None
+    for payload in _sse_payloads(ai_http.stream_lines('qwen', headers=headers, json=data)):
+        chunk = json.loads(payload)
+        if not isinstance(chunk, dict):
+            continue
+        # 每段都带有截至目前的累计用量，取最后一段
+        usage = parse_usage(chunk) or usage
+        output = chunk.get('output')
+        if output is None and chunk.get('code'):
+            raise Exception(f"{chunk.get('message', '未知错误')} (错误码: {chunk.get('code')})")
+        output = output or {}
+        delta = output.get('text')
+        if delta is None and output.get('choices'):
+            delta = (output['choices'][0].get('message') or {}).get('content')
+        if delta:
+            parts.append(delta)
+            if on_delta is not None:
+                on_delta(delta)
+    if not parts:
+        raise Exception('流式响应中没有内容')
+    return ''.join(parts), usage
+
+
+def call_ai_model(prompt, ai_config, stream=False, on_delta=None, use_cache=True):
+    """调用AI模型生成分析报告（通过 services.ai_http 按服务商复用长连接）
+
+    stream=True 时使用服务商的流式输出，每收到一段文本调用 on_delta(文本)，返回值仍是完整文本
+    相同服务商、模型、温度和提示词的结果从 AI 响应缓存返回；use_cache=False（强制重新生成、测试连接）时
+    不读缓存，但新结果仍会写入缓存
+    """
+    provider = ai_config.selected_model
+    params = AI_MODEL_PARAMS.get(provider)
+    cache = _ai_cache if AI_CACHE_ENABLED and params is not None else None
+    # 系统提示词也会影响输出，一起计入缓存键
+    cache_prompt = f"{AI_SYSTEM_PROMPT}\n{prompt}"
+    if cache is not None:
+        if use_cache:
+            cached = cache.get(provider, params['model'], params['temperature'], cache_prompt)
+            if cached is not None:
+                logger.info(f"AI响应缓存命中 - 服务商: {provider}")
+                if stream and on_delta is not None:
+                    on_delta(cached)
+                return cached
+        else:
+            cache.bypass()
+
+    started = time.perf_counter()
+    first_token = []
+    
+    def on_provider_delta(delta):
+        if not first_token:
+            first_token.append(time.perf_counter() - started)
+        if on_delta is not None:
+            on_delta(delta)
+    
+    try:
+        result, usage = _call_provider(prompt, ai_config, stream, on_provider_delta if stream else None)
+    except Exception:
+        # 各服务商分支把异常包装成了普通 Exception：因取消 / 超过时限而失败时还原为 JobCancelled / DeadlineExceeded
+        context = current_call()
+        if context is not None:
+            context.check()
+        raise
+    # 服务商返回的 token 用量（含上下文缓存命中数）：累计到 /admin/metrics，并记在当前调用范围上供分析任务写入记录
+    record_usage(provider, usage, time.perf_counter() - started, first_token[0] if first_token else None)
+    context = current_call()
+    if context is not None:
+        context.add_usage(usage)
+    if usage:
+        logger.info(f"{provider} 提示词 {usage['prompt_tokens']} tokens，上下文缓存命中 {usage['cached_tokens']} tokens")
+    if cache is not None:
+        cache.put(provider, params['model'], params['temperature'], cache_prompt, result)
+    return result
+
+
+def _call_provider(prompt, ai_config, stream, on_delta):
+    """按服务商发起调用，返回 (文本, token 用量)；服务商没有返回用量时用量为 None"""
     if ai_config.selected_model == 'deepseek':
-        url = "https://api.deepseek.com/v1/chat/completions"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {ai_config.deepseek_api_key}"
         }
         data = {
-            "model": "deepseek-chat",
+            "model": AI_MODEL_PARAMS['deepseek']['model'],
             "messages": [
-                {"role": "system", "content": "你面向的用户一般是教师和学生"},
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.7,
-            "max_tokens": 4000
+            "temperature": AI_MODEL_PARAMS['deepseek']['temperature'],
+            "max_tokens": AI_OUTPUT_TOKENS
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=60)
+            if stream:
+                return _stream_openai_compatible('deepseek', headers, data, on_delta)
+            response = ai_http.post('deepseek', headers=headers, json=data)
             response.raise_for_status()
             result = response.json()
-            return result["choices"][0]["message"]["content"]
+            return result["choices"][0]["message"]["content"], parse_usage(result)
         except Exception as e:
             logger.error(f"DeepSeek API调用失败: {str(e)}")
             raise Exception(f"DeepSeek API调用失败: {str(e)}")
     
     elif ai_config.selected_model == 'doubao':
-        url = "https://ark.cn-beijing.volces.com/api/v3/chat/completions"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {ai_config.doubao_api_key}"
         }
         data = {
-            "model": "doubao-seed-1-6-251015",
+            "model": AI_MODEL_PARAMS['doubao']['model'],
             "messages": [
-                {"role": "system", "content": "你面向的用户一般是教师和学生"},
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.7,
-            "max_tokens": 4000
+            "temperature": AI_MODEL_PARAMS['doubao']['temperature'],
+            "max_tokens": AI_OUTPUT_TOKENS
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=120)
+            if stream:
+                return _stream_openai_compatible('doubao', headers, data, on_delta)
+            response = ai_http.post('doubao', headers=headers, json=data)
             response.raise_for_status()
             result = response.json()
-            return result["choices"][0]["message"]["content"]
+            return result["choices"][0]["message"]["content"], parse_usage(result)
         except Exception as e:
             logger.error(f"豆包API调用失败: {str(e)}")
             raise Exception(f"豆包API调用失败: {str(e)}")
     
     elif ai_config.selected_model == 'qwen':
-        url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {ai_config.qwen_api_key}"
         }
         data = {
-            "model": "qwen-plus",
+            "model": AI_MODEL_PARAMS['qwen']['model'],
             "input": {
                 "messages": [
-                    {"role": "system", "content": "你面向的用户一般是教师和学生"},
+                    {"role": "system", "content": AI_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ]
             },
             "parameters": {
-                "temperature": 0.7,
-                "max_tokens": 4000
+                "temperature": AI_MODEL_PARAMS['qwen']['temperature'],
+                "max_tokens": AI_OUTPUT_TOKENS
             }
         }
         
         try:
             logger.info(f"调用阿里云百炼API，模型: qwen-plus")
-            response = requests.post(url, headers=headers, json=data, timeout=120)
+            if stream:
+                return _stream_qwen(headers, data, on_delta)
+            response = ai_http.post('qwen', headers=headers, json=data)
             
             if response.status_code != 200:
                 raise Exception(f"阿里云百炼API调用失败，状态码: {response.status_code}，响应: {response.text[:200]}")
@@ -101,18 +265,19 @@ def call_ai_model(prompt, ai_config):
                 raise Exception(f"阿里云百炼API调用失败: {result.get('message', '未知错误')} (错误码: {result.get('code')})")
             
             if isinstance(result, dict):
+                usage = parse_usage(result)
                 if "output" in result and "text" in result["output"]:
-                    return result["output"]["text"]
+                    return result["output"]["text"], usage
                 elif "choices" in result and len(result["choices"]) > 0:
                     choice = result["choices"][0]
                     if "message" in choice and "content" in choice["message"]:
-                        return choice["message"]["content"]
+                        return choice["message"]["content"], usage
                     elif "text" in choice:
-                        return choice["text"]
+                        return choice["text"], usage
                 elif "data" in result and "choices" in result["data"] and len(result["data"]["choices"]) > 0:
                     choice = result["data"]["choices"][0]
                     if "message" in choice and "content" in choice["message"]:
-                        return choice["message"]["content"]
+                        return choice["message"]["content"], usage
             
             raise Exception(f"阿里云百炼API返回未知格式的响应: {str(result)[:200]}")
         except requests.exceptions.RequestException as re:
@@ -125,7 +290,6 @@ def call_ai_model(prompt, ai_config):
     elif ai_config.selected_model == 'chat_server':
         # 直接通过HTTP请求硅基流动 OpenAI 兼容接口（避免SDK依赖）
         import os as _os
-        import requests as _requests
         # Token 解析顺序：用户配置 > 环境变量 > 应用配置
         api_key = (ai_config.chat_server_api_token or '').strip()
         if not api_key:
@@ -137,20 +301,21 @@ def call_ai_model(prompt, ai_config):
                 api_key = ''
         if not api_key:
             raise Exception('硅基流动未配置，请设置 CHAT_SERVER_API_TOKEN 或在配置页填写 Token')
-        url = 'https://api.siliconflow.cn/v1/chat/completions'
         headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {api_key}'
         }
         payload = {
-            'model': 'deepseek-ai/DeepSeek-V2.5',
+            'model': AI_MODEL_PARAMS['chat_server']['model'],
             'messages': [
-                {"role": "system", "content": "你面向的用户一般是教师和学生"},
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ]
         }
         try:
-            resp = _requests.post(url, headers=headers, json=payload, timeout=(5, 120))
+            if stream:
+                return _stream_openai_compatible('chat_server', headers, payload, on_delta)
+            resp = ai_http.post('chat_server', headers=headers, json=payload)
             if resp.status_code != 200:
                 raise Exception(f"HTTP {resp.status_code}: {resp.text[:200]}")
             data = resp.json()
@@ -161,9 +326,9 @@ def call_ai_model(prompt, ai_config):
                 msg = (choice.get('message') or {})
                 content = msg.get('content') or choice.get('text')
                 if content:
-                    return content
+                    return content, parse_usage(data)
             raise Exception(f"未知响应格式: {str(data)[:200]}")
-        except _requests.Timeout as e:
+        except requests.Timeout as e:
             logger.error(f"硅基流动超时: {e}")
             raise Exception(f"硅基流动超时: {e}")
         except Exception as e:
@@ -173,181 +338,146 @@ def call_ai_model(prompt, ai_config):
         raise Exception(f"不支持的AI模型: {ai_config.selected_model}")
 
 
-def generate_analysis_prompt(task, submission=None, file_content=None, SessionLocal=None, Submission=None, user_template=None):
+def generate_analysis_prompt(task, submission=None, file_content=None, SessionLocal=None, Submission=None, user_template=None, field_stats=None,
+                             sample_strategy=None, stratify=None, token_budget=None, provider=None):
     """根据任务信息生成分析提示词（优化版）
     
     Args:
         task: 任务对象
-        submission: 提交数据列表
+        submission: 提交数据列表（可选；不提供时只从数据库读取总数和样例行）
         file_content: 文件内容
         SessionLocal: 数据库会话工厂
         Submission: 提交模型类
         user_template: 用户自定义的提示词模板（可选），如果提供，将在模板中查找 {DATA_SECTION} 占位符并替换为数据部分
+                       （占位符之后的文字排在随提交变化的数据之后，不能命中服务商的上下文缓存）
+        field_stats: 预先维护的字段统计（services.field_stats.load_field_stats 的返回值，可选），
+                     不提供时由解析后的提交数据按列向量化计算
+        sample_strategy: 样例抽取方式 spread（首/中/尾，默认）/ random，见 services.sampling
+        stratify: 分层抽样，time:day / time:week / time:month / field:字段名（可选）
+        token_budget: 提示词 token 预算（可选，见 services.prompt_budget）；超出时逐级压缩样例部分和 HTML 分析结果
+        provider: 服务商，用于按其分词器估算 token 数
     """
-    if not submission and SessionLocal and Submission:
-        db = SessionLocal()
-        try:
-            submission = db.query(Submission).filter_by(task_id=task.id).all()
-        finally:
-            db.close()
+    if submission:
+        total_count = len(submission)
+        samples = sample_from_list(submission)
+    elif SessionLocal and Submission:
+        total_count, samples = sample_submissions(SessionLocal, Submission, task.id, strategy=sample_strategy, stratify=stratify)
+    else:
+        total_count, samples = 0, []
     
-    # 生成数据部分
-    data_section = f"""任务标题：{task.title}
+    # 提示词按“稳定在前、易变在后”排列：服务商（DeepSeek 等）对与之前请求相同的开头部分命中上下文缓存，
+    # 计费打折、首字更快。说明和要求、任务标题描述、HTML 分析结果、字段列表在同一任务的多次分析之间不变，
+    # 提交数量、字段统计和样例随提交变化，放在最后
+    task_head = f"""任务标题：{task.title}
 任务描述：{task.description or '无'}
-
-提交数据信息：
 """
     
     # 生成数据详细内容
-    if submission:
-        total_count = len(submission)
-        data_section += f"总提交数量：{total_count} 条\n\n"
+    schema = ''
+    data_head = "\n提交数据信息：\n"
+    sample_block = None
+    if total_count:
+        data_head += f"总提交数量：{total_count} 条\n\n"
         
-        # 解析所有数据
-        all_data = []
-        field_types = {}  # 字段类型统计
-        field_values = {}  # 字段值统计
-        
-        for sub in submission:
-            try:
-                data = json.loads(sub.data)
-                all_data.append(data)
-                
-                # 统计字段类型和值
-                for key, value in data.items():
-                    if key not in field_types:
-                        field_types[key] = []
-                        field_values[key] = []
-                    
-                    # 判断字段类型
-                    if isinstance(value, (int, float)):
-                        field_types[key].append('numeric')
-                        field_values[key].append(value)
-                    elif isinstance(value, bool):
-                        field_types[key].append('boolean')
-                        field_values[key].append(value)
-                    else:
-                        field_types[key].append('text')
-                        field_values[key].append(str(value))
-            except:
-                pass
-        
-        # 添加字段统计信息
-        if all_data and len(all_data) > 0:
-            # 检查第一个数据项是否为字典类型
-            first_item = all_data[0]
-            if isinstance(first_item, dict):
-                data_section += "数据字段统计：\n"
-                for field in first_item.keys():
-                    field_type_list = field_types.get(field, [])
-                    if not field_type_list:
-                        continue
-                    
-                    # 判断主要类型
-                    is_numeric = field_type_list.count('numeric') > len(field_type_list) * 0.8
-                    is_boolean = field_type_list.count('boolean') > len(field_type_list) * 0.8
-                    
-                    data_section += f"  - {field}: "
-                    if is_numeric:
-                        values = [v for v in field_values[field] if isinstance(v, (int, float))]
-                        if values:
-                            data_section += f"数值型，范围: {min(values)} - {max(values)}，平均值: {sum(values)/len(values):.2f}\n"
-                        else:
-                            data_section += "数值型\n"
-                    elif is_boolean:
-                        values = field_values[field]
-                        true_count = sum(1 for v in values if v is True or str(v).lower() in ['true', '1', 'yes', '是'])
-                        data_section += f"布尔型，是: {true_count}，否: {len(values)-true_count}\n"
-                    else:
-                        # 文本型，统计常见值
-                        values = field_values[field]
-                        value_counts = Counter(values)
-                        top_values = value_counts.most_common(5)
-                        if len(top_values) > 0:
-                            data_section += f"文本型，常见值: {', '.join([f'{k}({v}次)' for k, v in top_values[:3]])}\n"
-                        else:
-                            data_section += "文本型\n"
-                
-                data_section += "\n"
+        # 添加字段统计信息（未传入预先维护的统计时，解析全部数据后一次性放进 DataFrame 按列计算）
+        if field_stats is None:
+            raws = (sub.data for sub in submission) if submission else (
+                raw for _, raw, _ in iter_submissions(SessionLocal, Submission, task.id)
+            )
+            all_data = []
+            for raw in raws:
+                try:
+                    all_data.append(json.loads(raw))
+                except:
+                    pass
+            if all_data:
+                field_stats = frame_field_stats(all_data)
+        if field_stats is not None:
+            schema = format_field_schema(field_stats)
+            data_head += format_field_stats(field_stats)
         
-        # 智能采样：根据数据量决定显示多少条
-        sample_size = min(20, total_count)  # 最多显示20条
+        records = []
         if total_count > 3:
-            # 如果有大量数据，均匀采样（首、中、尾）
-            if total_count <= sample_size:
-                sample_indices = list(range(total_count))
-            else:
-                # 均匀采样：取前几条、中间几条、后几条
-                sample_indices = list(range(0, min(5, total_count)))  # 前5条
-                if total_count > 10:
-                    mid_start = total_count // 2 - 3
-                    mid_end = total_count // 2 + 3
-                    sample_indices.extend(range(mid_start, mid_end))
-                sample_indices.extend(range(max(0, total_count - 5), total_count))  # 后5条
-                sample_indices = sorted(list(set(sample_indices)))[:sample_size]
-            
-            data_section += f"数据样例（共显示 {len(sample_indices)} 条，占总数的 {len(sample_indices)/total_count*100:.1f}%）：\n"
-            for idx, i in enumerate(sample_indices, 1):
+            # 数据库中只读取了样例行（默认首、中、尾，最多 PROMPT_SAMPLE_SIZE 条）
+            stratified = any(sample.stratum is not None for sample in samples)
+            heading = lambda shown: f"数据样例（共显示 {shown} 条，占总数的 {shown/total_count*100:.1f}%{'，分层抽样' if stratified else ''}）：\n"
+            for idx, sample in enumerate(samples, 1):
+                group = f"，分组: {sample.stratum}" if sample.stratum is not None else ''
                 try:
-                    data = all_data[i]
-                    data_section += f"\n样例 #{idx} (第 {i+1} 条记录):\n"
-                    for key, value in data.items():
-                        # 限制单个值长度，避免过长
-                        value_str = str(value)
-                        if len(value_str) > 100:
-                            value_str = value_str[:100] + "...[截断]"
-                        data_section += f"  - {key}: {value_str}\n"
+                    data = json.loads(sample.data)
                 except:
-                    if i < len(submission):
-                        data_section += f"\n样例 #{idx}: {submission[i].data[:100]}...\n"
+                    data = None
+                if isinstance(data, dict):
+                    records.append((f"样例 #{idx}", f"\n样例 #{idx} (第 {sample.position+1} 条记录{group}):\n", data))
+                else:
+                    records.append((f"样例 #{idx}", '', sample.data))
         else:
             # 数据量少，全部显示
-            data_section += "完整数据：\n"
-            for i, data in enumerate(all_data, 1):
-                data_section += f"\n提交 #{i}:\n"
-                for key, value in data.items():
-                    value_str = str(value)
-                    if len(value_str) > 100:
-                        value_str = value_str[:100] + "...[截断]"
-                    data_section += f"  - {key}: {value_str}\n"
+            heading = lambda shown: "完整数据：\n"
+            i = 0
+            for sample in samples:
+                try:
+                    data = json.loads(sample.data)
+                except:
+                    continue
+                i += 1
+                records.append((f"提交 #{i}", f"\n提交 #{i}:\n", data if isinstance(data, dict) else None))
+        sample_block = SampleBlock(records, heading)
     else:
-        data_section += "暂无提交数据\n"
+        data_head += "暂无提交数据\n"
     
-    # 如果任务有HTML分析结果，添加到数据部分
-    if hasattr(task, 'html_analysis') and task.html_analysis:
-        data_section += "\n\n【HTML文件分析结果】\n"
-        data_section += task.html_analysis
+    html_analysis = task.html_analysis if hasattr(task, 'html_analysis') and task.html_analysis else ''
     
-    # 根据是否有用户模板来决定如何组合最终的提示词
-    if user_template and user_template.strip():
-        # 如果提供了用户模板，将数据部分插入到模板中
-        # 查找 {DATA_SECTION} 占位符，如果存在则替换，否则追加到模板末尾
-        if '{DATA_SECTION}' in user_template:
-            prompt = user_template.replace('{DATA_SECTION}', data_section)
-        else:
+    def build(level=0, html_chars=None):
+        data_section = task_head
+        # 如果任务有HTML分析结果，添加到数据部分（放在易变的提交数据之前）
+        if html_analysis and html_chars != 0:
+            data_section += "\n【HTML文件分析结果】\n"
+            data_section += html_analysis if html_chars is None or len(html_analysis) <= html_chars else html_analysis[:html_chars] + "...[截断]"
+            data_section += "\n"
+        if schema:
+            data_section += "\n" + schema
+        data_section += data_head + (sample_block.render(level) if sample_block is not None else '')
+        
+        # 根据是否有用户模板来决定如何组合最终的提示词
+        if user_template and user_template.strip():
+            # 如果提供了用户模板，将数据部分插入到模板中
+            # 查找 {DATA_SECTION} 占位符，如果存在则替换，否则追加到模板末尾
+            if '{DATA_SECTION}' in user_template:
+                return user_template.replace('{DATA_SECTION}', data_section)
             # 如果没有占位符，将数据部分追加到模板末尾
-            prompt = user_template + "\n\n" + data_section
-    else:
-        # 使用默认模板
-        prompt = f"""你是一个数据分析专家，请基于以下表单数据提供详细的分析报告：
-
-{data_section}
-
-请提供一个全面的数据分析报告，包括但不限于：
-1. 数据概览：总提交量、关键数据分布、字段类型统计
-2. 主要发现：数据中的趋势、模式、异常和相关性
-3. 深入分析：基于数据的详细洞察，包括分布特征、集中趋势、离散程度等
-4. 建议和结论：基于分析结果的实用建议和改进方向
-
-请以中文撰写报告，使用Markdown格式，包括适当的标题、列表和表格来增强可读性。
-"""
+            return user_template + "\n\n" + data_section
+        # 使用默认模板：分析要求在前，数据在后
+        return f"{DEFAULT_ANALYSIS_INSTRUCTIONS}\n{data_section}"
     
+    prompt = build()
+    if not token_budget:
+        return prompt
+    tokens = estimate_tokens(prompt, provider)
+    if tokens <= token_budget:
+        return prompt
+    # 超出预算：先逐级压缩样例，仍放不下再缩短、去掉 HTML 分析结果
+    steps = [(level, None) for level in range(1, len(SAMPLE_LEVELS))]
+    steps += [(len(SAMPLE_LEVELS) - 1, HTML_ANALYSIS_COMPRESSED_CHARS), (len(SAMPLE_LEVELS) - 1, 0)]
+    original = tokens
+    for level, html_chars in steps:
+        prompt = build(level, html_chars)
+        tokens = estimate_tokens(prompt, provider)
+        if tokens <= token_budget:
+            break
+    logger.info(f"任务 {task.id}：提示词约 {original} tokens，超出预算 {token_budget}，压缩后约 {tokens} tokens"
+                f"（样例压缩级别 {level}{'，HTML 分析结果已缩短' if html_chars is not None else ''}）")
     return prompt
 
 
-def analyze_html_file(task_id, user_id, file_path, SessionLocal, Task, AIConfig, read_file_content_func, call_ai_model_func):
-    """在后台分析HTML文件，将分析结果存储到数据库"""
-    def analyze_in_background():
+def analyze_html_file(task_id, user_id, file_path, SessionLocal, Task, AIConfig, read_file_content_func, call_ai_model_func,
+                      executor=None):
+    """在后台分析HTML文件，将分析结果存储到数据库
+
+    executor：AI 任务执行器（services.ai_executor），传入时排队执行并受服务商并发上限约束；
+    同一任务重复上传时，排队中的旧分析被新文件替换
+    """
+    def analyze_in_background(job=None):
         print(f"[HTML分析] 后台分析任务开始，任务ID: {task_id}, 文件: {file_path}")
         db = SessionLocal()
         try:
@@ -388,16 +518,31 @@ HTML内容：
             
             # 调用AI进行分析
             try:
+                if job is not None:
+                    job.check_cancelled()
                 print(f"[HTML分析] → 正在调用AI模型进行分析...")
-                analysis_result = call_ai_model_func(analysis_prompt, ai_config)
+                # 超过时限或任务被取消时中断请求（services.call_context）
+                with call_scope(AI_JOB_DEADLINE, job):
+                    analysis_result = call_ai_model_func(analysis_prompt, ai_config)
+                if job is not None:
+                    job.check_cancelled()
                 # 保存分析结果到数据库
                 task.html_analysis = analysis_result
                 db.commit()
                 print(f"[HTML分析] ✓ HTML文件分析完成，结果长度: {len(analysis_result) if analysis_result else 0} 字符")
                 logger.info(f"任务 {task_id} 的HTML文件分析完成")
+            except JobCancelled:
+                print(f"[HTML分析] 分析已取消，丢弃结果")
+                raise
             except Exception as e:
+                if job is not None and job.cancelled:
+                    # 取消时连接被关闭，调用以网络错误返回
+                    print(f"[HTML分析] 分析已取消，丢弃结果")
+                    raise JobCancelled(f"任务 {task_id} 的HTML分析已取消")
                 print(f"[HTML分析] ❌ AI分析失败: {str(e)}")
                 logger.error(f"分析HTML文件失败: {str(e)}", exc_info=True)
+        except JobCancelled:
+            raise
         except Exception as e:
             print(f"[HTML分析] ❌ 后台分析任务失败: {str(e)}")
             logger.error(f"HTML分析后台任务失败: {str(e)}", exc_info=True)
@@ -405,7 +550,25 @@ HTML内容：
             db.close()
             print(f"[HTML分析] 后台分析任务结束\n")
     
-    # 在后台线程中执行分析
-    t = threading.Thread(target=analyze_in_background, daemon=True)
-    t.start()
+    if executor is None:
+        # 在后台线程中执行分析
+        t = threading.Thread(target=analyze_in_background, daemon=True)
+        t.start()
+        return
+
+    db = SessionLocal()
+    try:
+        provider = db.query(AIConfig.selected_model).filter_by(user_id=user_id).scalar()
+    finally:
+        db.close()
+    if not provider:
+        logger.warning(f"用户 {user_id} 未配置AI，跳过HTML分析")
+        return
+    key = ('html', task_id)
+    # 同一任务重新上传了文件：排队中的旧分析已经没有意义
+    executor.cancel(key)
+    try:
+        executor.submit(key, user_id, provider, analyze_in_background)
+    except Exception as e:
+        logger.warning(f"HTML分析未能加入队列 - Task ID: {task_id}: {str(e)}")
 
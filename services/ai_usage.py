@@ -0,0 +1,97 @@
+"""AI 调用的 token 用量 - 记录服务商返回的提示词 / 缓存命中 token 数，衡量上下文缓存的效果
+
+DeepSeek 等服务商对开头与之前请求相同的提示词命中上下文缓存：命中部分计费打折，首字也更快。
+generate_analysis_prompt 把不变的说明、字段列表放在前面，随提交变化的数据放在最后；这里统计实际效果：
+- parse_usage：从响应（或流式响应的最后一段）的 usage 中取出提示词、缓存命中、输出 token 数，
+  兼容 DeepSeek（prompt_cache_hit_tokens）、OpenAI 兼容接口（prompt_tokens_details.cached_tokens）
+  和阿里云百炼（input_tokens / output_tokens）
+- record_usage：按服务商累计，命中 / 未命中缓存的调用分别统计平均耗时和首字耗时，见 /admin/metrics 的 ai_usage
+流式调用需要请求 stream_options.include_usage 才会在最后一段返回用量（AI_STREAM_USAGE=false 可关闭）。
+"""
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+AI_STREAM_USAGE = os.getenv('AI_STREAM_USAGE', 'true').lower() in ('1', 'true', 'yes')   # 流式调用时请求返回 token 用量
+
+_lock = threading.Lock()
+_stats = {}  # 服务商 -> 累计值
+
+
+def parse_usage(payload):
+    """从响应 JSON 中取出 token 用量：{'prompt_tokens', 'cached_tokens', 'completion_tokens'}，没有用量时返回 None"""
+    usage = payload.get('usage') if isinstance(payload, dict) else None
+    if not isinstance(usage, dict):
+        return None
+    prompt = usage.get('prompt_tokens', usage.get('input_tokens'))
+    completion = usage.get('completion_tokens', usage.get('output_tokens'))
+    if 'prompt_cache_hit_tokens' in usage:
+        # DeepSeek：命中 + 未命中 = 提示词 token 数
+        cached = usage.get('prompt_cache_hit_tokens')
+        if prompt is None:
+            prompt = (cached or 0) + (usage.get('prompt_cache_miss_tokens') or 0)
+    else:
+        details = usage.get('prompt_tokens_details') or usage.get('input_tokens_details')
+        cached = details.get('cached_tokens') if isinstance(details, dict) else None
+    if prompt is None:
+        return None
+    try:
+        return {'prompt_tokens': int(prompt), 'cached_tokens': int(cached or 0), 'completion_tokens': int(completion or 0)}
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_usage(total, usage):
+    """累加两份用量，任一为 None 时返回另一份"""
+    if not usage:
+        return total
+    if not total:
+        return dict(usage)
+    return {key: total.get(key, 0) + value for key, value in usage.items()}
+
+
+def record_usage(provider, usage, seconds, first_token=None):
+    """记录一次服务商调用：usage 为 parse_usage 的结果（服务商未返回时为 None），seconds 为总耗时，first_token 为首字耗时"""
+    hit = bool(usage and usage['cached_tokens'] > 0)
+    suffix = 'hit' if hit else 'miss'
+    with _lock:
+        s = _stats.setdefault(provider, {
+            'calls': 0, 'reported': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+            'calls_hit': 0, 'calls_miss': 0, 'seconds_hit': 0.0, 'seconds_miss': 0.0,
+            'first_token_hit': 0.0, 'first_token_miss': 0.0, 'streams_hit': 0, 'streams_miss': 0,
+        })
+        s['calls'] += 1
+        if usage:
+            s['reported'] += 1
+            s['prompt_tokens'] += usage['prompt_tokens']
+            s['cached_tokens'] += usage['cached_tokens']
+            s['completion_tokens'] += usage['completion_tokens']
+        s[f'calls_{suffix}'] += 1
+        s[f'seconds_{suffix}'] += seconds
+        if first_token is not None:
+            s[f'streams_{suffix}'] += 1
+            s[f'first_token_{suffix}'] += first_token
+
+
+def usage_stats():
+    """各服务商的累计用量、缓存命中比例，以及命中 / 未命中缓存的调用的平均耗时（秒）"""
+    result = {}
+    with _lock:
+        items = [(provider, dict(s)) for provider, s in _stats.items()]
+    for provider, s in items:
+        result[provider] = {
+            'calls': s['calls'],
+            'reported': s['reported'],
+            'prompt_tokens': s['prompt_tokens'],
+            'cached_tokens': s['cached_tokens'],
+            'completion_tokens': s['completion_tokens'],
+            'cached_ratio': round(s['cached_tokens'] / s['prompt_tokens'], 4) if s['prompt_tokens'] else 0.0,
+            'calls_hit': s['calls_hit'],
+            'avg_seconds_hit': round(s['seconds_hit'] / s['calls_hit'], 3) if s['calls_hit'] else None,
+            'avg_seconds_miss': round(s['seconds_miss'] / s['calls_miss'], 3) if s['calls_miss'] else None,
+            'avg_first_token_hit': round(s['first_token_hit'] / s['streams_hit'], 3) if s['streams_hit'] else None,
+            'avg_first_token_miss': round(s['first_token_miss'] / s['streams_miss'], 3) if s['streams_miss'] else None,
+        }
+    return result
@@ -0,0 +1,245 @@
+"""分析任务状态 - 报告生成的进度、结果指针写入 analysis_job 表
+
+原来进度和报告正文放在共享状态后端里按 TTL 保留，进程重启或状态后端是 memory 时进行中的状态就丢了，
+报告正文还要在状态后端再存一份。这里改为数据库记录：
+- 执行分析的 worker 写入状态（queued / running / completed / error / cancelled）、进度、提示信息、
+  模型、提示词哈希、提示词 token 预算与估算 token 数、服务商返回的提示词 / 上下文缓存命中 token 数，完成后记录报告文件路径（报告正文仍在 task.analysis_report）
+- /api/report_status 读取任务最新一条记录，进程内缓存 ANALYSIS_JOB_CACHE_TTL 秒（前端每 2 秒轮询一次）
+- 已结束的记录不再被改写，取消后仍在执行的调用写不回 running / completed
+- 每小时清理一次：超过 ANALYSIS_JOB_RETENTION_DAYS 天的已结束记录删除；
+  超过 ANALYSIS_JOB_STALE_SECONDS 秒没有更新的进行中记录（进程崩溃遗留）标记为中断
+"""
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_JOB_CACHE_TTL = float(os.getenv('ANALYSIS_JOB_CACHE_TTL', '1'))                 # 状态查询缓存（秒）
+ANALYSIS_JOB_RETENTION_DAYS = int(os.getenv('ANALYSIS_JOB_RETENTION_DAYS', '30'))        # 已结束记录保留天数
+ANALYSIS_JOB_STALE_SECONDS = int(os.getenv('ANALYSIS_JOB_STALE_SECONDS', '1800'))        # 进行中记录多久无更新视为中断
+ANALYSIS_JOB_CACHE_MAX_SIZE = 1024
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('completed', 'error', 'cancelled')
+_FIELDS = ('status', 'progress', 'message', 'queue_position', 'result_path', 'prompt_tokens',
+           'provider_prompt_tokens', 'cached_tokens')
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256((prompt or '').encode('utf-8')).hexdigest()
+
+
+class AnalysisJobStore:
+    """analysis_job 表的读写"""
+
+    def __init__(self, SessionLocal, AnalysisJob, cache_ttl=ANALYSIS_JOB_CACHE_TTL,
+                 retention_days=ANALYSIS_JOB_RETENTION_DAYS, stale_seconds=ANALYSIS_JOB_STALE_SECONDS):
+        self.SessionLocal = SessionLocal
+        self.AnalysisJob = AnalysisJob
+        self.cache_ttl = cache_ttl
+        self.retention = timedelta(days=max(1, retention_days))
+        self.stale = timedelta(seconds=max(60, stale_seconds))
+        self._cache = OrderedDict()  # task_id -> (expires_at, 记录 dict 或 None)
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._stats = {'created': 0, 'updates': 0, 'cache_hits': 0, 'cache_misses': 0, 'deleted': 0, 'interrupted': 0}
+
+    def create(self, task_id, user_id, model, prompt, token_budget=None, prompt_tokens=None):
+        """新建一条排队中的记录，返回记录 id
+
+        token_budget / prompt_tokens：提示词 token 预算与估算 token 数（见 services/prompt_budget.py），
+        分析开始后按实际发送的提示词更新 prompt_tokens
+        """
+        self.cleanup()
+        AnalysisJob = self.AnalysisJob
+        db = self.SessionLocal()
+        try:
+            now = datetime.now()
+            job = AnalysisJob(
+                task_id=task_id, user_id=user_id, status='queued', progress=0, message='排队中...',
+                model=model, prompt_hash=prompt_hash(prompt), token_budget=token_budget, prompt_tokens=prompt_tokens,
+                created_at=now, updated_at=now,
+            )
+            db.add(job)
+            db.commit()
+            job_id = job.id
+        finally:
+            db.close()
+        self._invalidate(task_id)
+        with self._lock:
+            self._stats['created'] += 1
+        return job_id
+
+    def update(self, job_id, task_id=None, **fields):
+        """更新进行中的记录；记录已结束（完成 / 失败 / 取消）时不修改，返回 False"""
+        AnalysisJob = self.AnalysisJob
+        values = {k: v for k, v in fields.items() if k in _FIELDS}
+        now = datetime.now()
+        values['updated_at'] = now
+        status = values.get('status')
+        if status == 'running' or status in FINISHED_STATUSES:
+            values['queue_position'] = None
+        if status in FINISHED_STATUSES:
+            values['finished_at'] = now
+        db = self.SessionLocal()
+        try:
+            if status == 'running':
+                # 只在第一次进入 running 时记录开始时间
+                db.execute(
+                    update(AnalysisJob)
+                    .where(AnalysisJob.id == job_id, AnalysisJob.started_at.is_(None))
+                    .values(started_at=now)
+                )
+            result = db.execute(
+                update(AnalysisJob)
+                .where(AnalysisJob.id == job_id, AnalysisJob.status.in_(ACTIVE_STATUSES))
+                .values(**values)
+            )
+            db.commit()
+            changed = bool(result.rowcount)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"更新分析任务状态失败 - Job ID: {job_id}, 错误: {str(e)}")
+            return False
+        finally:
+            db.close()
+        self._invalidate(task_id)
+        with self._lock:
+            self._stats['updates'] += 1
+        return changed
+
+    def discard(self, job_id, task_id=None):
+        """删除没有实际执行的记录（例如已有相同任务在排队）"""
+        AnalysisJob = self.AnalysisJob
+        db = self.SessionLocal()
+        try:
+            db.execute(delete(AnalysisJob).where(AnalysisJob.id == job_id))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"删除分析任务记录失败 - Job ID: {job_id}, 错误: {str(e)}")
+        finally:
+            db.close()
+        self._invalidate(task_id)
+
+    def status(self, job_id):
+        """读取记录的当前状态（不走缓存，供执行中的任务检查是否已被其他进程取消）"""
+        AnalysisJob = self.AnalysisJob
+        db = self.SessionLocal()
+        try:
+            return db.query(AnalysisJob.status).filter(AnalysisJob.id == job_id).scalar()
+        finally:
+            db.close()
+
+    def latest(self, task_id):
+        """任务最新一条记录（dict），没有记录返回 None；进程内缓存 cache_ttl 秒"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(task_id)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(task_id)
+                self._stats['cache_hits'] += 1
+                return entry[1]
+            self._stats['cache_misses'] += 1
+
+        AnalysisJob = self.AnalysisJob
+        db = self.SessionLocal()
+        try:
+            job = (
+                db.query(AnalysisJob)
+                .filter(AnalysisJob.task_id == task_id)
+                .order_by(AnalysisJob.id.desc())
+                .first()
+            )
+            record = _to_dict(job) if job is not None else None
+        finally:
+            db.close()
+        if self.cache_ttl > 0:
+            with self._lock:
+                self._cache[task_id] = (now + self.cache_ttl, record)
+                self._cache.move_to_end(task_id)
+                while len(self._cache) > ANALYSIS_JOB_CACHE_MAX_SIZE:
+                    self._cache.popitem(last=False)
+        return record
+
+    def latest_active(self, task_id):
+        record = self.latest(task_id)
+        return record if record is not None and record['status'] in ACTIVE_STATUSES else None
+
+    def _invalidate(self, task_id):
+        with self._lock:
+            if task_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(task_id, None)
+
+    def cleanup(self, force=False):
+        """每小时一次：删除过期的已结束记录，把长时间无更新的进行中记录标记为中断"""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_cleanup < 3600:
+                return 0, 0
+            self._last_cleanup = now
+        AnalysisJob = self.AnalysisJob
+        db = self.SessionLocal()
+        try:
+            current = datetime.now()
+            interrupted = db.execute(
+                update(AnalysisJob)
+                .where(AnalysisJob.status.in_(ACTIVE_STATUSES), AnalysisJob.updated_at < current - self.stale)
+                .values(status='error', message='服务重启，分析已中断，请重新生成报告',
+                        queue_position=None, finished_at=current, updated_at=current)
+            ).rowcount or 0
+            deleted = db.execute(
+                delete(AnalysisJob)
+                .where(AnalysisJob.status.in_(FINISHED_STATUSES), AnalysisJob.updated_at < current - self.retention)
+            ).rowcount or 0
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"清理分析任务记录失败: {str(e)}")
+            return 0, 0
+        finally:
+            db.close()
+        if interrupted or deleted:
+            logger.info(f"分析任务记录清理：删除 {deleted} 条，标记中断 {interrupted} 条")
+            self._invalidate(None)
+        with self._lock:
+            self._stats['deleted'] += deleted
+            self._stats['interrupted'] += interrupted
+        return deleted, interrupted
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['cached'] = len(self._cache)
+            s['cache_ttl'] = self.cache_ttl
+        return s
+
+
+def _to_dict(job):
+    return {
+        'id': job.id,
+        'task_id': job.task_id,
+        'status': job.status,
+        'progress': job.progress or 0,
+        'message': job.message or '',
+        'queue_position': job.queue_position,
+        'model': job.model,
+        'prompt_hash': job.prompt_hash,
+        'token_budget': job.token_budget,
+        'prompt_tokens': job.prompt_tokens,
+        'provider_prompt_tokens': job.provider_prompt_tokens,
+        'cached_tokens': job.cached_tokens,
+        'result_path': job.result_path,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
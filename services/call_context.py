@@ -0,0 +1,171 @@
+"""AI 调用的时限与取消 - 时限向下传递到 HTTP 超时，取消时直接关闭连接
+
+原来分析外面套一个 timeout 装饰器：另开一个线程执行调用，超时后只是不再等待，
+底下的 requests.post 还会按自己的 120 秒超时继续跑，每次超时都留下一个线程和一条连接。
+现在在发起调用的线程上登记一个 CallContext（call_scope）：
+- services.ai_http 发请求时按剩余时间计算 (连接超时, 读取超时)，流式读取时每一行都收紧一次套接字超时
+- 任务被取消（AIJob.cancel）时对正在读取的套接字执行 shutdown，阻塞中的读取立即出错返回
+- 超过时限抛出 DeadlineExceeded（requests.Timeout 的子类），调用方按超时处理
+不会为一次调用另开线程；/admin/metrics 的 ai_calls 给出进程线程数，可确认超时 / 取消后没有线程残留。
+范围内各次调用的 token 用量（services.ai_usage）累计在 CallContext.usage 上，供分析任务写入记录。
+"""
+import os
+import time
+import socket
+import threading
+import logging
+from contextlib import contextmanager
+
+import requests
+
+from .ai_executor import JobCancelled
+from .ai_usage import merge_usage
+
+logger = logging.getLogger(__name__)
+
+AI_JOB_DEADLINE = float(os.getenv('AI_JOB_DEADLINE', '300'))      # 一次分析中模型调用的总时限（秒）
+AI_TEST_DEADLINE = float(os.getenv('AI_TEST_DEADLINE', '30'))     # /api/test_ai 连通性测试的时限（秒）
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {'calls': 0, 'active': 0, 'aborted': 0, 'deadline_exceeded': 0}
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+class DeadlineExceeded(requests.Timeout):
+    """超过调用时限"""
+
+
+class CallContext:
+    """一次调用的截止时间、所属任务、正在使用的套接字和累计的 token 用量"""
+
+    def __init__(self, seconds=None, job=None):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.job = job
+        self.aborted = False
+        self.expired = False
+        self.usage = None
+        self._sockets = set()
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """剩余秒数；没有时限返回 None"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def check(self):
+        """已取消抛出 JobCancelled，已超时抛出 DeadlineExceeded"""
+        if self.job is not None:
+            self.job.check_cancelled()
+        if self.aborted:
+            raise JobCancelled("调用已中断")
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            if not self.expired:
+                self.expired = True
+                _count('deadline_exceeded')
+            raise DeadlineExceeded(f"AI 调用超过时限（{self.seconds:g} 秒）")
+
+    def http_timeout(self, default):
+        """(连接超时, 读取超时)：不超过剩余时间"""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        remaining = max(0.01, remaining)
+        return min(default[0], remaining), min(default[1], remaining)
+
+    def attach(self, sock):
+        """登记正在使用的套接字；已取消时立即关闭"""
+        with self._lock:
+            if not self.aborted:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+    def detach_all(self):
+        with self._lock:
+            self._sockets.clear()
+
+    def tighten(self, read_timeout):
+        """把登记的套接字的读取超时收紧到剩余时间（流式读取时每行调用一次）"""
+        remaining = self.remaining()
+        if remaining is None:
+            return
+        timeout = max(0.01, min(read_timeout, remaining))
+        with self._lock:
+            sockets = list(self._sockets)
+        for sock in sockets:
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                pass
+
+    def add_usage(self, usage):
+        """累计服务商返回的 token 用量（并行汇总时由各工作线程调用）"""
+        if not usage:
+            return
+        with self._lock:
+            self.usage = merge_usage(self.usage, usage)
+
+    def abort(self):
+        """中断调用：关闭正在读取的套接字（由 AIJob.cancel 在其他线程调用）"""
+        with self._lock:
+            if self.aborted:
+                return
+            self.aborted = True
+            sockets = list(self._sockets)
+            self._sockets.clear()
+        for sock in sockets:
+            _shutdown(sock)
+        _count('aborted')
+
+
+def _shutdown(sock):
+    # shutdown 能唤醒阻塞在 recv 上的线程，close 不一定
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def current_call():
+    """当前线程的 CallContext，没有则返回 None"""
+    return getattr(_local, 'context', None)
+
+
+@contextmanager
+def call_scope(seconds=None, job=None):
+    """在当前线程登记调用时限与所属任务；期间 services.ai_http 发出的请求都受其约束
+
+    job 被取消时（AIJob.cancel）立即关闭正在读取的连接
+    """
+    context = CallContext(seconds, job)
+    previous = current_call()
+    _local.context = context
+    if job is not None:
+        job.add_cancel_hook(context.abort)
+    _count('calls')
+    _count('active')
+    try:
+        yield context
+    finally:
+        if job is not None:
+            job.remove_cancel_hook(context.abort)
+        context.detach_all()
+        _local.context = previous
+        _count('active', -1)
+
+
+def call_stats():
+    with _stats_lock:
+        s = dict(_stats)
+    s['deadline'] = AI_JOB_DEADLINE
+    # 进程内线程数：超时 / 取消的调用不再留下线程，这个数应当保持平稳
+    s['threads'] = threading.active_count()
+    return s
@@ -0,0 +1,214 @@
+"""分块汇总分析（map-reduce）- 提交很多的任务让模型看到全部数据，而不只是几十条样例
+
+generate_analysis_prompt 只放字段统计和最多 PROMPT_SAMPLE_SIZE 条样例，几千条提交时模型只看到很小一部分，
+开放式回答里的观点基本都看不到。分块汇总模式：
+- 分块：按提交顺序把每条记录渲染成一行，按估算 token 数（services.prompt_budget）装满一块（CHUNK_TOKEN_BUDGET）再开下一块；
+  新增提交只影响最后一块和新增的块
+- map：每块单独请模型汇总，一个分析任务内最多 CHUNK_FANOUT 块同时进行；在 AI 任务执行器中运行时，
+  每块调用占用执行器中该服务商的一个名额（AIJobExecutor.provider_slot），分析任务等待期间让出自己的名额，
+  同一服务商同时进行的请求总数仍不超过其并发上限。请求经 services.ai_http 的连接池发出，
+  受所在分析的时限与取消约束（services.call_context）
+- 汇总提示词只由任务标题和块内容决定，结果经 AI 响应缓存（services.ai_cache）按内容哈希复用：
+  重新生成报告时只有内容变化的块会真正调用模型
+- reduce：各块汇总附在原提示词之后生成最终报告；汇总总量超过 CHUNK_REDUCE_BUDGET 时先分组合并，直到放得下
+"""
+import os
+import json
+import logging
+import threading
+from collections import namedtuple
+from contextlib import ExitStack, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .export_service import iter_submissions
+from .ai_executor import JobCancelled, provider_limit
+from .call_context import call_scope, current_call
+from .prompt_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CHUNKED_ANALYSIS_MIN_ROWS = int(os.getenv('CHUNKED_ANALYSIS_MIN_ROWS', '200'))       # 提交数达到多少时页面默认勾选分块汇总
+CHUNKED_ANALYSIS_DEADLINE = float(os.getenv('CHUNKED_ANALYSIS_DEADLINE', '1800'))    # 分块汇总阶段的总时限（秒）
+CHUNK_TOKEN_BUDGET = int(os.getenv('CHUNK_TOKEN_BUDGET', '6000'))                    # 每块数据的估算 token 上限
+CHUNK_REDUCE_BUDGET = int(os.getenv('CHUNK_REDUCE_BUDGET', '12000'))                 # 附在最终提示词中的汇总总量上限（估算 token）
+CHUNK_FANOUT = int(os.getenv('CHUNK_FANOUT', '4'))                                   # 一个分析任务内同时汇总的块数
+CHUNK_SUMMARY_CHARS = 400         # 每块汇总的建议字数
+CHUNK_VALUE_MAX_CHARS = 200       # 单个字段值的截断长度
+CHUNK_MAX_MERGE_ROUNDS = 4        # 汇总合并的最多轮数
+
+# index：从 1 开始；first / last：块内第一条 / 最后一条记录的位置（从 1 开始）
+Chunk = namedtuple('Chunk', ['index', 'first', 'last', 'text'])
+
+
+def render_row(raw, submitted_at=None):
+    """一条提交渲染为一行：提交时间 | 字段: 值；字段: 值"""
+    try:
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        data = raw
+    if isinstance(data, dict):
+        parts = []
+        for key, value in data.items():
+            value_str = str(value).replace('\n', ' ')
+            if len(value_str) > CHUNK_VALUE_MAX_CHARS:
+                value_str = value_str[:CHUNK_VALUE_MAX_CHARS] + '...[截断]'
+            parts.append(f"{key}: {value_str}")
+        body = '；'.join(parts)
+    else:
+        body = str(data).replace('\n', ' ')[:CHUNK_VALUE_MAX_CHARS * 5]
+    when = submitted_at.strftime('%Y-%m-%d %H:%M') if submitted_at else '-'
+    return f"{when} | {body}"
+
+
+def _pack(lines, budget):
+    """把文本行按估算 token 数依次装块，返回 [(第一行位置, 最后一行位置, 文本)]（位置从 1 开始）"""
+    chunks = []
+    current, size, first = [], 0, 1
+    for position, line in enumerate(lines, 1):
+        cost = estimate_tokens(line) + 1
+        if current and size + cost > budget:
+            chunks.append((first, position - 1, '\n'.join(current)))
+            current, size, first = [], 0, position
+        current.append(line)
+        size += cost
+    if current:
+        chunks.append((first, first + len(current) - 1, '\n'.join(current)))
+    return chunks
+
+
+def split_chunks(SessionLocal, Submission, task_id, budget=CHUNK_TOKEN_BUDGET):
+    """按提交顺序读取任务的全部提交并分块，返回 (总条数, [Chunk])"""
+    lines = [render_row(raw, submitted_at) for _, raw, submitted_at in iter_submissions(SessionLocal, Submission, task_id)]
+    chunks = [Chunk(index, first, last, text) for index, (first, last, text) in enumerate(_pack(lines, max(100, budget)), 1)]
+    return len(lines), chunks
+
+
+def map_prompt(task_title, chunk):
+    """单块汇总提示词：只由任务标题和块内容决定，内容不变时命中 AI 响应缓存"""
+    rows = chunk.last - chunk.first + 1
+    return f"""以下是表单「{task_title}」的一批提交记录（{rows} 条，每行一条，格式：提交时间 | 字段: 值；字段: 值）。
+请用中文汇总这批数据，不超过 {CHUNK_SUMMARY_CHARS} 字：
+1. 选择题、评分题等字段的主要分布（给出条数）
+2. 开放式回答中的主要观点，每类附 1~2 句典型原话
+3. 异常或值得注意的记录
+只输出汇总内容，不要开场白和结尾。
+
+{chunk.text}"""
+
+
+def merge_prompt(task_title, summaries_text):
+    """合并多块汇总的提示词（汇总总量超出上限时使用）"""
+    return f"""以下是表单「{task_title}」连续若干批提交数据的汇总。请把它们合并成一份汇总，不超过 {CHUNK_SUMMARY_CHARS * 2} 字：
+合并相同的观点并累加条数，保留有代表性的原话和异常情况。只输出汇总内容，不要开场白和结尾。
+
+{summaries_text}"""
+
+
+def _section(first, last, summary):
+    return f"### 第 {first}–{last} 条\n{summary.strip()}"
+
+
+def _run_parallel(prompts, ai_config, call_ai_model_func, job, use_cache, fanout, on_done):
+    """并行调用模型，按输入顺序返回结果；任一调用失败时中断其他调用并抛出异常
+
+    job 由 AIJobExecutor 执行时，每个调用占用执行器中同一服务商的一个名额，job 自己的名额在此期间让出
+    """
+    executor = getattr(job, 'executor', None)
+    parent = current_call()
+    seconds = max(0.01, parent.remaining()) if parent is not None and parent.deadline is not None else None
+    contexts = []
+    lock = threading.Lock()
+    stopped = [False]
+
+    def run(prompt):
+        if job is not None:
+            job.check_cancelled()
+        with call_scope(seconds, job) as context:
+            with lock:
+                if stopped[0]:
+                    raise JobCancelled("分块汇总已中断")
+                contexts.append(context)
+            slot = executor.provider_slot(job.provider, context.check) if executor is not None else nullcontext()
+            with slot:
+                result = call_ai_model_func(prompt, ai_config, use_cache=use_cache)
+        if parent is not None:
+            parent.add_usage(context.usage)
+        return result
+
+    results = [None] * len(prompts)
+    stack = ExitStack()
+    if executor is not None:
+        stack.enter_context(executor.lend_slot(job))
+    pool = ThreadPoolExecutor(max_workers=max(1, min(fanout, len(prompts))), thread_name_prefix='chunked-analysis')
+    try:
+        futures = {pool.submit(run, prompt): i for i, prompt in enumerate(prompts)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            on_done(done)
+    except BaseException:
+        # 不再等待其他块：取消未开始的，关闭进行中的连接
+        pool.shutdown(wait=False, cancel_futures=True)
+        with lock:
+            stopped[0] = True
+            running = list(contexts)
+        for context in running:
+            context.abort()
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        stack.close()
+    return results
+
+
+def build_chunked_prompt(task, base_prompt, ai_config, call_ai_model_func, SessionLocal, Submission,
+                         job=None, use_cache=True, on_progress=None, fanout=None):
+    """分块汇总全部提交，把汇总附在 base_prompt 之后，返回最终报告的提示词
+
+    on_progress(已完成块数, 总块数, 阶段说明)：每块完成后在调用线程中回调，可抛出 JobCancelled 中断分析
+    """
+    fanout = min(max(1, fanout or CHUNK_FANOUT), provider_limit(ai_config.selected_model))
+    total, chunks = split_chunks(SessionLocal, Submission, task.id)
+    if not chunks:
+        return base_prompt
+    logger.info(f"任务 {task.id}：分块汇总 {total} 条提交，共 {len(chunks)} 块，并行 {fanout}")
+
+    def report(done, count, stage):
+        if on_progress is not None:
+            on_progress(done, count, stage)
+
+    report(0, len(chunks), 'map')
+    summaries = _run_parallel(
+        [map_prompt(task.title, chunk) for chunk in chunks], ai_config, call_ai_model_func, job, use_cache, fanout,
+        lambda done: report(done, len(chunks), 'map'),
+    )
+    # (第一条位置, 最后一条位置, 汇总)
+    sections = [(chunk.first, chunk.last, summary or '') for chunk, summary in zip(chunks, summaries)]
+
+    rounds = 0
+    while (sum(estimate_tokens(_section(*s)) for s in sections) > CHUNK_REDUCE_BUDGET
+           and len(sections) > 1 and rounds < CHUNK_MAX_MERGE_ROUNDS):
+        rounds += 1
+        groups = [
+            [sections[i - 1] for i in range(first, last + 1)]
+            for first, last, _ in _pack([_section(*s) for s in sections], CHUNK_TOKEN_BUDGET)
+        ]
+        if len(groups) == len(sections):
+            # 每组只有一块，合并不会再缩短
+            break
+        report(0, len(groups), 'merge')
+        merged = _run_parallel(
+            [merge_prompt(task.title, '\n\n'.join(_section(*s) for s in group)) for group in groups],
+            ai_config, call_ai_model_func, job, use_cache, fanout,
+            lambda done: report(done, len(groups), 'merge'),
+        )
+        sections = [(group[0][0], group[-1][1], summary or '') for group, summary in zip(groups, merged)]
+
+    summary_text = '\n\n'.join(_section(*s) for s in sections)
+    return f"""{base_prompt}
+
+【全部提交数据的分批汇总】
+以下是把全部 {total} 条提交按提交顺序分成 {len(chunks)} 批、逐批汇总的结果，覆盖全部数据（上面的样例只是其中一小部分）。
+撰写报告时请以这些汇总为准，具体数量和比例以字段统计为准：
+
+{summary_text}
+"""
@@ -0,0 +1,295 @@
+"""后台导出任务 - 导出文件在后台线程生成并缓存到 uploads/exports/
+
+文件按 (任务, 最大提交ID, 提交条数, 格式) 命名：数据没有变化时再次导出直接返回已有文件；
+有新提交或删除后水位线变化，自动生成新文件。
+任务进度保存在共享状态后端（多 worker 部署时任一进程都能查询），
+同一文件同时只会有一个进程在生成。旧文件按保留时长和总大小上限清理。
+"""
+import os
+import re
+import time
+import glob
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from .export_service import iter_export, EXPORT_FORMATS
+
+logger = logging.getLogger(__name__)
+
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))                      # 每个进程同时生成的导出文件数
+EXPORT_RETENTION_HOURS = float(os.getenv('EXPORT_RETENTION_HOURS', '24'))           # 导出文件保留时长
+EXPORT_MAX_TOTAL_MB = float(os.getenv('EXPORT_MAX_TOTAL_MB', '1024'))               # 导出目录总大小上限
+EXPORT_JOB_STATE_TTL = 24 * 3600     # 任务状态在状态后端中的保留时长（秒）
+EXPORT_JOB_LOCK_TTL = 60             # 生成中的锁，进度更新时续期；进程异常退出后自动释放
+EXPORT_CLEANUP_INTERVAL = 600        # 两次清理之间的最短间隔（秒）
+
+# 文件名：task{任务id}_{最大提交id}_{条数}.{格式}
+_ARTIFACT_RE = re.compile(r'^task(\d+)_(\d+)_(\d+)\.(xlsx|csv|ndjson)$')
+JOB_ID_RE = re.compile(r'^(xlsx|csv|ndjson)-(\d+)-(\d+)$')
+
+
+class ExportJobManager:
+    """导出任务管理：水位线计算、任务去重、进度、缓存文件清理"""
+
+    def __init__(self, SessionLocal, Submission, export_dir, state_backend,
+                 workers=EXPORT_JOB_WORKERS, retention_hours=EXPORT_RETENTION_HOURS,
+                 max_total_mb=EXPORT_MAX_TOTAL_MB, snapshot_store=None):
+        self.SessionLocal = SessionLocal
+        self.Submission = Submission
+        self.snapshot_store = snapshot_store
+        self.export_dir = export_dir
+        self.state = state_backend
+        self.workers = max(1, workers)
+        self.retention_seconds = retention_hours * 3600
+        self.max_total_bytes = max_total_mb * 1024 * 1024
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_cleanup = 0.0
+        self._stats = {'requested': 0, 'cache_hits': 0, 'started': 0, 'completed': 0, 'failed': 0, 'cleaned': 0}
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+
+    # ---------- 键与路径 ----------
+    @staticmethod
+    def job_id(fmt, max_id, count):
+        return f"{fmt}-{max_id}-{count}"
+
+    def artifact_path(self, task_id, fmt, max_id, count):
+        return os.path.join(self.export_dir, f"task{task_id}_{max_id}_{count}.{fmt}")
+
+    def _state_key(self, task_id, job_id):
+        return f"export:job:{task_id}:{job_id}"
+
+    def watermark(self, task_id):
+        """当前数据水位线 (最大提交ID, 提交条数)，走 submission.task_id 索引"""
+        Submission = self.Submission
+        db = self.SessionLocal()
+        try:
+            max_id, count = (
+                db.query(func.max(Submission.id), func.count(Submission.id))
+                .filter(Submission.task_id == task_id)
+                .one()
+            )
+            return max_id or 0, count or 0
+        finally:
+            db.close()
+
+    # ---------- 对外接口 ----------
+    def request(self, task_id, fmt):
+        """请求导出：文件已存在直接返回 ready；否则启动（或复用）后台任务。返回状态字典"""
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"不支持的导出格式: {fmt}")
+        self._maybe_cleanup()
+        max_id, count = self.watermark(task_id)
+        job_id = self.job_id(fmt, max_id, count)
+        with self._lock:
+            self._stats['requested'] += 1
+
+        path = self.artifact_path(task_id, fmt, max_id, count)
+        if os.path.exists(path):
+            with self._lock:
+                self._stats['cache_hits'] += 1
+            # 访问即续期，常用的文件不会被按时间清理掉
+            os.utime(path)
+            return self._ready_status(job_id, path, count)
+
+        # 同一文件只允许一个进程生成（锁在进度更新时续期）
+        if self.state.add(self._state_key(task_id, job_id) + ':lock', os.getpid(), ttl=EXPORT_JOB_LOCK_TTL):
+            status = {'job_id': job_id, 'status': 'queued', 'format': fmt, 'rows': 0, 'total': count}
+            self.state.set(self._state_key(task_id, job_id), status, ttl=EXPORT_JOB_STATE_TTL)
+            self._submit(task_id, fmt, max_id, count, job_id)
+            with self._lock:
+                self._stats['started'] += 1
+            return status
+        return self.status(task_id, job_id)
+
+    def status(self, task_id, job_id):
+        """查询任务状态；返回 None 表示任务不存在"""
+        match = JOB_ID_RE.match(job_id or '')
+        if not match:
+            return None
+        fmt, max_id, count = match.group(1), int(match.group(2)), int(match.group(3))
+        path = self.artifact_path(task_id, fmt, max_id, count)
+        if os.path.exists(path):
+            return self._ready_status(job_id, path, count)
+        status = self.state.get(self._state_key(task_id, job_id))
+        if status and status.get('status') in ('queued', 'running'):
+            # 生成进程已退出（锁过期）而文件未生成
+            if self.state.get(self._state_key(task_id, job_id) + ':lock') is None:
+                status = dict(status, status='error', message='导出中断，请重新导出')
+        return status
+
+    def artifact_for(self, task_id, job_id):
+        """已生成文件的路径与格式；未生成返回 (None, None)"""
+        match = JOB_ID_RE.match(job_id or '')
+        if not match:
+            return None, None
+        fmt = match.group(1)
+        path = self.artifact_path(task_id, fmt, int(match.group(2)), int(match.group(3)))
+        return (path, fmt) if os.path.exists(path) else (None, None)
+
+    def cached_artifact(self, task_id, fmt):
+        """当前水位线对应的文件已存在时返回路径（同步导出时直接复用）"""
+        max_id, count = self.watermark(task_id)
+        path = self.artifact_path(task_id, fmt, max_id, count)
+        return path if os.path.exists(path) else None
+
+    def purge_task(self, task_id):
+        """任务删除后清理它的全部导出文件"""
+        removed = 0
+        for path in glob.glob(os.path.join(self.export_dir, f"task{task_id}_*")):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    # ---------- 生成 ----------
+    def _ready_status(self, job_id, path, count):
+        return {
+            'job_id': job_id, 'status': 'ready', 'format': job_id.split('-', 1)[0],
+            'rows': count, 'total': count, 'size': os.path.getsize(path),
+        }
+
+    def _submit(self, task_id, fmt, max_id, count, job_id):
+        with self._lock:
+            if self._executor is None:
+                # 延迟创建：gunicorn 预加载时主进程不创建线程
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='export-job')
+            self._executor.submit(self._run, task_id, fmt, max_id, count, job_id)
+
+    def _run(self, task_id, fmt, max_id, count, job_id):
+        key = self._state_key(task_id, job_id)
+        path = self.artifact_path(task_id, fmt, max_id, count)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        started = time.time()
+        last_update = [0.0]
+
+        def on_progress(rows):
+            if self._stop.is_set():
+                raise RuntimeError('服务正在停止，导出已中断')
+            now = time.monotonic()
+            if now - last_update[0] < 0.5:
+                return
+            last_update[0] = now
+            self.state.set(key, {'job_id': job_id, 'status': 'running', 'format': fmt, 'rows': rows, 'total': count},
+                           ttl=EXPORT_JOB_STATE_TTL)
+            self.state.set(key + ':lock', os.getpid(), ttl=EXPORT_JOB_LOCK_TTL)
+
+        snapshot = None
+        try:
+            on_progress(0)
+            if self.snapshot_store is not None and fmt != 'ndjson':
+                snapshot = self.snapshot_store.reader(task_id, max_id)
+            with open(tmp_path, 'wb') as f:
+                for chunk in iter_export(self.SessionLocal, self.Submission, task_id, fmt,
+                                         on_progress=on_progress, max_id=max_id, snapshot=snapshot):
+                    f.write(chunk)
+            # 写完再改名，其他请求不会读到半个文件
+            os.replace(tmp_path, path)
+            self.state.set(key, self._ready_status(job_id, path, count), ttl=EXPORT_JOB_STATE_TTL)
+            with self._lock:
+                self._stats['completed'] += 1
+            logger.info(f"导出完成 - Task ID: {task_id}, 格式: {fmt}, {count} 条, 用时 {time.time() - started:.1f}s")
+            self._remove_superseded(task_id, fmt, path)
+        except Exception as e:
+            with self._lock:
+                self._stats['failed'] += 1
+            logger.error(f"导出失败 - Task ID: {task_id}, 格式: {fmt}, 错误: {str(e)}", exc_info=True)
+            self.state.set(key, {'job_id': job_id, 'status': 'error', 'format': fmt, 'message': f'导出失败: {str(e)}'},
+                           ttl=EXPORT_JOB_STATE_TTL)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+            self.state.delete(key + ':lock')
+
+    # ---------- 清理 ----------
+    def _remove_superseded(self, task_id, fmt, keep_path):
+        """同一任务同一格式只保留最新水位线的文件"""
+        for path in glob.glob(os.path.join(self.export_dir, f"task{task_id}_*.{fmt}")):
+            if path != keep_path:
+                try:
+                    os.remove(path)
+                    with self._lock:
+                        self._stats['cleaned'] += 1
+                except OSError:
+                    pass
+
+    def _maybe_cleanup(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_cleanup < EXPORT_CLEANUP_INTERVAL:
+                return
+            self._last_cleanup = now
+        self.cleanup()
+
+    def cleanup(self):
+        """按保留时长删除旧文件，超过总大小上限时从最久未使用的开始删除；返回删除的文件数"""
+        now = time.time()
+        files = []
+        for name in os.listdir(self.export_dir):
+            path = os.path.join(self.export_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # 进程异常退出留下的临时文件
+            if name.endswith('.tmp'):
+                if now - st.st_mtime > 3600:
+                    files.append((0, 0, path))
+                continue
+            if _ARTIFACT_RE.match(name):
+                files.append((st.st_mtime, st.st_size, path))
+
+        removed = 0
+        keep = []
+        for mtime, size, path in files:
+            if now - mtime > self.retention_seconds:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            else:
+                keep.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in keep)
+        for mtime, size, path in sorted(keep):
+            if total <= self.max_total_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+                total -= size
+            except OSError:
+                pass
+
+        if removed:
+            with self._lock:
+                self._stats['cleaned'] += removed
+            logger.info(f"已清理导出文件 {removed} 个")
+        return removed
+
+    # ---------- 生命周期 ----------
+    def stop(self):
+        """停止：进行中的导出在下一批数据时中断，未开始的取消"""
+        self._stop.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        files = [n for n in os.listdir(self.export_dir) if _ARTIFACT_RE.match(n)] if os.path.exists(self.export_dir) else []
+        s['artifacts'] = len(files)
+        s['artifact_bytes'] = sum(os.path.getsize(os.path.join(self.export_dir, n)) for n in files)
+        return s
@@ -0,0 +1,723 @@
+"""任务字段统计 - 后台增量维护，分析提示词直接读取（O(字段数)）
+
+generate_analysis_prompt 原来每次都把全部提交逐条解析，重新统计每个字段的类型、
+数值范围 / 平均值和文本常见值；smart_analyze 每次打开页面生成预览提示词都要做一遍。
+这里把统计量存入 task_field_stat 表（每个任务每个字段一行）：
+- 出现次数、数值个数 / 合计 / 平方和 / 最小值 / 最大值、布尔值真假计数、文本个数
+- 常见值：有界的 Space-Saving 计数（最多 FIELD_STATS_TOP_CAPACITY 个值），不同值不超过容量时与精确计数一致
+- 统计表记录合并到的提交 id（Task.field_stats_through_id）。提交时只登记任务（FieldStatsUpdater.mark），
+  不在提交事务中读写统计行：后台线程每 FIELD_STATS_FLUSH_SECONDS 秒把水位之后的新提交成批合并，
+  一个 30 字段的表单每条提交省下约 2.5ms（scripts/bench_field_stats.py --ingest）
+- 读取时先合并已稳定的新提交，再在内存中叠加尚未合并的提交，结果与逐条统计一致
+- 删除单条已合并的提交时扣减；删除的值恰好是最小 / 最大值，或是某个常见值第一次出现的提交时无法扣减，
+  标记任务统计失效，下次读取时重建
+- Task.field_stats_ready 为假（升级前的旧任务、统计失效）时读取方自动重建；也可用
+  scripts/rebuild_field_stats.py 批量重建
+
+统计口径与 generate_analysis_prompt 原有逐条计算完全一致（包括 bool 按数值处理、True / 1 / 1.0 计为同一个常见值、
+字段列表取第一条可解析提交的字段顺序），输出文本不变（scripts/bench_field_stats.py --parity 校验）。
+
+没有维护好的统计时（直接传入提交列表生成提示词等），frame_field_stats 把已解析的提交
+一次性放进 DataFrame，按列向量化计算同样结构的统计，另外给出缺失率、分位数、标准差等。
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import update
+
+from .export_service import iter_submissions
+
+logger = logging.getLogger(__name__)
+
+FIELD_STATS_TOP_CAPACITY = int(os.getenv('FIELD_STATS_TOP_CAPACITY', '64'))   # 每个字段保留的常见值个数上限
+FIELD_STATS_FLUSH_SECONDS = float(os.getenv('FIELD_STATS_FLUSH_SECONDS', '2'))      # 后台合并新提交的间隔（秒）
+FIELD_STATS_SETTLE_SECONDS = float(os.getenv('FIELD_STATS_SETTLE_SECONDS', '5'))    # 只合并提交时间早于此秒数的提交
+FIELD_STATS_BATCH_SIZE = 5000                                                       # 每个事务最多合并的提交条数
+FIELD_NAME_MAX_LENGTH = 255
+
+_UNPARSED = object()
+
+
+def _parse(raw):
+    try:
+        return json.loads(raw)
+    except Exception:
+        return _UNPARSED
+
+
+def _value_key(value):
+    """常见值计数的键，与 Counter 的相等判断一致：
+
+    数值与文本分开计数（1 与 '1' 是两个值）；True、1、1.0 相等，计为同一个值（按浮点数取键，
+    浮点数无法精确表示的大整数按整数取键）；其他值按 str() 文本计数
+    """
+    if isinstance(value, (int, float)):
+        if value != value:
+            return 'NaN'
+        try:
+            number = float(value)
+        except OverflowError:
+            return json.dumps(int(value))
+        return json.dumps(number if number == value else int(value))
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def _is_number_key(key):
+    return not key.startswith('"')
+
+
+class FieldAccumulator:
+    """一个字段在一批提交中的统计增量"""
+
+    __slots__ = ('count', 'numeric_count', 'numeric_sum', 'numeric_sumsq', 'numeric_min', 'numeric_max',
+                 'true_count', 'false_count', 'text_count', 'values', 'first', 'display')
+
+    def __init__(self):
+        self.count = 0
+        self.numeric_count = 0
+        self.numeric_sum = 0.0
+        self.numeric_sumsq = 0.0
+        self.numeric_min = None
+        self.numeric_max = None
+        self.true_count = 0
+        self.false_count = 0
+        self.text_count = 0
+        self.values = {}   # 值键 -> 次数（按首次出现顺序）
+        self.first = {}    # 值键 -> 第一次出现的提交 id（常见值同次数时按它排序，与 Counter 一致）
+        self.display = {}  # 数值键 -> 第一次出现的原始值（True / 1 / 1.0 按先出现的显示，与 Counter 一致）
+
+    def add(self, value, submission_id):
+        self.count += 1
+        # 与原统计口径一致：bool 是 int 的子类，按数值统计
+        if isinstance(value, (int, float)):
+            self.numeric_count += 1
+            self.numeric_sum += value
+            self.numeric_sumsq += value * value
+            if self.numeric_min is None or value < self.numeric_min:
+                self.numeric_min = value
+            if self.numeric_max is None or value > self.numeric_max:
+                self.numeric_max = value
+            if isinstance(value, bool):
+                if value:
+                    self.true_count += 1
+                else:
+                    self.false_count += 1
+        else:
+            self.text_count += 1
+        key = _value_key(value)
+        count = self.values.get(key)
+        if count is None:
+            self.values[key] = 1
+            self.first[key] = submission_id
+            if _is_number_key(key):
+                self.display[key] = value
+        else:
+            self.values[key] = count + 1
+
+
+def collect_field_stats(rows, first_keys=None, fields=None):
+    """按 id 顺序统计一批提交 [(提交 id, 原始 JSON 文本)]，返回 (第一条可解析提交的字段列表或 None, {字段: FieldAccumulator})
+
+    第一条可解析提交不是 JSON 对象时字段列表为 False（提示词不输出字段统计，与原逻辑一致）；
+    传入上一次的返回值可继续累加
+    """
+    if fields is None:
+        fields = {}
+    for submission_id, raw in rows:
+        data = _parse(raw)
+        if data is _UNPARSED:
+            continue
+        if first_keys is None:
+            first_keys = list(data.keys()) if isinstance(data, dict) else False
+        if not isinstance(data, dict):
+            continue
+        for key, value in data.items():
+            if len(key) > FIELD_NAME_MAX_LENGTH:
+                continue
+            acc = fields.get(key)
+            if acc is None:
+                acc = fields[key] = FieldAccumulator()
+            acc.add(value, submission_id)
+    return first_keys, fields
+
+
+# ---------- 常见值（Space-Saving） ----------
+def _load_top(text):
+    top = json.loads(text) if text else {}
+    return top.get('items', {})
+
+
+def _dump_top(items):
+    return json.dumps({'items': items}, ensure_ascii=False)
+
+
+def _top_value(key, entry):
+    """常见值的显示值：数值取第一次出现的原始值"""
+    return entry[2] if len(entry) > 2 else json.loads(key)
+
+
+def _merge_top(items, acc, sign, capacity, removed_id=None):
+    """items: {值键: [次数, 第一次出现的提交 id(, 数值的原始值)]}，把 acc 的常见值累加（sign=1）或扣减（sign=-1）
+
+    扣减后值仍存在、而删除的提交（removed_id）正是它第一次出现的提交时返回 False：
+    下一次出现在哪一条提交无法得知，调用方应标记统计失效
+    """
+    exact = True
+    for key, count in acc.values.items():
+        entry = items.get(key)
+        if sign < 0:
+            if entry is not None:
+                entry[0] -= count
+                if entry[0] <= 0:
+                    del items[key]
+                elif removed_id is not None and entry[1] == removed_id:
+                    exact = False
+            continue
+        if entry is not None:
+            entry[0] += count
+            continue
+        new_entry = [count, acc.first[key]] + ([acc.display[key]] if key in acc.display else [])
+        if len(items) >= capacity:
+            # 已满：替换计数最小的值（同样最小时替换最晚出现的），新值继承其计数
+            victim = min(items, key=lambda k: (items[k][0], -items[k][1]))
+            new_entry[0] += items.pop(victim)[0]
+        items[key] = new_entry
+    return exact
+
+
+# ---------- 统计状态（统计表一行 / 读取时的内存副本） ----------
+_COUNTERS = ('count', 'numeric_count', 'numeric_sum', 'numeric_sumsq', 'true_count', 'false_count', 'text_count')
+
+
+def _empty_state():
+    state = dict.fromkeys(_COUNTERS, 0)
+    state.update(numeric_sum=0.0, numeric_sumsq=0.0, numeric_min=None, numeric_max=None, items={})
+    return state
+
+
+def _row_state(stat):
+    return {
+        'count': stat.value_count or 0,
+        'numeric_count': stat.numeric_count or 0,
+        'numeric_sum': stat.numeric_sum or 0.0,
+        'numeric_sumsq': stat.numeric_sumsq or 0.0,
+        'numeric_min': json.loads(stat.numeric_min) if stat.numeric_min else None,
+        'numeric_max': json.loads(stat.numeric_max) if stat.numeric_max else None,
+        'true_count': stat.true_count or 0,
+        'false_count': stat.false_count or 0,
+        'text_count': stat.text_count or 0,
+        'items': _load_top(stat.top_values),
+    }
+
+
+def _store_state(stat, state, now):
+    stat.value_count = state['count']
+    stat.numeric_count = state['numeric_count']
+    stat.numeric_sum = state['numeric_sum']
+    stat.numeric_sumsq = state['numeric_sumsq']
+    stat.numeric_min = json.dumps(state['numeric_min']) if state['numeric_min'] is not None else None
+    stat.numeric_max = json.dumps(state['numeric_max']) if state['numeric_max'] is not None else None
+    stat.true_count = state['true_count']
+    stat.false_count = state['false_count']
+    stat.text_count = state['text_count']
+    stat.top_values = _dump_top(state['items'])
+    stat.updated_at = now
+
+
+def _merge_state(state, acc, sign=1, removed_id=None):
+    """把 acc 累加 / 扣减到 state；无法精确扣减（删除了最小 / 最大值或常见值第一次出现的提交）时返回 False"""
+    state['count'] += sign * acc.count
+    state['numeric_count'] += sign * acc.numeric_count
+    state['numeric_sum'] += sign * acc.numeric_sum
+    state['numeric_sumsq'] += sign * acc.numeric_sumsq
+    state['true_count'] += sign * acc.true_count
+    state['false_count'] += sign * acc.false_count
+    state['text_count'] += sign * acc.text_count
+    exact = True
+    if sign > 0:
+        if acc.numeric_min is not None and (state['numeric_min'] is None or acc.numeric_min < state['numeric_min']):
+            state['numeric_min'] = acc.numeric_min
+        if acc.numeric_max is not None and (state['numeric_max'] is None or acc.numeric_max > state['numeric_max']):
+            state['numeric_max'] = acc.numeric_max
+    elif acc.numeric_count and (acc.numeric_min == state['numeric_min'] or acc.numeric_max == state['numeric_max']):
+        exact = False
+    return _merge_top(state['items'], acc, sign, FIELD_STATS_TOP_CAPACITY, removed_id) and exact
+
+
+def _public_stat(state):
+    """load_field_stats 返回的单字段统计"""
+    stat = {key: value for key, value in state.items() if key != 'items'}
+    # [(值, 次数)]，按次数降序、同次数按第一次出现的先后（与 Counter.most_common 一致）
+    stat['top_values'] = [
+        (_top_value(key, entry), entry[0])
+        for key, entry in sorted(state['items'].items(), key=lambda kv: (-kv[1][0], kv[1][1]))
+    ]
+    return stat
+
+
+# ---------- 写入 ----------
+def _lock_task_stats(db, Task, task_id):
+    """在当前事务中锁定任务行（SQLite 取得写锁），之后读改写统计行不会与其他进程交错；
+    返回 (ready, 字段顺序, 已合并到的提交 id)
+    """
+    db.execute(update(Task).where(Task.id == task_id).values(field_stats_ready=Task.field_stats_ready))
+    row = (
+        db.query(Task.field_stats_ready, Task.field_stats_order, Task.field_stats_through_id)
+        .filter(Task.id == task_id).one_or_none()
+    )
+    if row is None:
+        return False, None, None
+    return bool(row[0]), row[1], row[2] or 0
+
+
+def _first_keys(db, Submission, task_id, scan_limit=50):
+    """按剩余数据重新确定字段顺序；前 scan_limit 条都无法解析时返回 _UNPARSED"""
+    for (raw,) in (
+        db.query(Submission.data).filter(Submission.task_id == task_id)
+        .order_by(Submission.id).limit(scan_limit)
+    ):
+        data = _parse(raw)
+        if data is not _UNPARSED:
+            return list(data.keys()) if isinstance(data, dict) else False
+    return None if db.query(Submission.id).filter(Submission.task_id == task_id).first() is None else _UNPARSED
+
+
+def _apply_rows(db, Task, TaskFieldStat, task_id, order, rows, sign=1):
+    """在当前事务中把一批提交累加（sign=1）或扣减（sign=-1，一条）到统计行；无法精确扣减时标记统计失效"""
+    first_keys, fields = collect_field_stats(rows)
+    if sign > 0 and order is None and first_keys is not None:
+        db.execute(update(Task).where(Task.id == task_id).values(field_stats_order=json.dumps(first_keys, ensure_ascii=False)))
+    if not fields:
+        return
+    existing = {
+        stat.field: stat for stat in
+        db.query(TaskFieldStat).filter(TaskFieldStat.task_id == task_id, TaskFieldStat.field.in_(list(fields))).all()
+    }
+    removed_id = rows[0][0] if sign < 0 else None
+    now = datetime.now()
+    exact = True
+    for name, acc in fields.items():
+        stat = existing.get(name)
+        if stat is None:
+            if sign < 0:
+                continue
+            stat = TaskFieldStat(task_id=task_id, field=name)
+            db.add(stat)
+            state = _empty_state()
+        else:
+            state = _row_state(stat)
+        exact = _merge_state(state, acc, sign, removed_id) and exact
+        _store_state(stat, state, now)
+    if not exact:
+        invalidate_field_stats(db, Task, task_id)
+
+
+def catch_up_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id,
+                         settle_seconds=FIELD_STATS_SETTLE_SECONDS, batch_size=FIELD_STATS_BATCH_SIZE):
+    """把水位之后、提交时间早于 settle_seconds 秒的新提交合并进统计表并提交，返回 (合并条数, 是否还有未合并的提交)
+
+    只合并已稳定的提交：并发事务的自增 id 可能晚于更大的 id 提交，水位越过它就会漏算；
+    统计未就绪时不合并（读取时整体重建）
+    """
+    merged = 0
+    while True:
+        cutoff = datetime.now() - timedelta(seconds=max(0.0, settle_seconds))
+        db = SessionLocal()
+        try:
+            # 先不加锁看一眼，没有新提交时不占用写锁
+            through = db.query(Task.field_stats_through_id).filter(Task.id == task_id).scalar() or 0
+            if db.query(Submission.id).filter(Submission.task_id == task_id, Submission.id > through).first() is None:
+                return merged, False
+            ready, order, through = _lock_task_stats(db, Task, task_id)
+            if not ready:
+                db.rollback()
+                return merged, False
+            rows = (
+                db.query(Submission.id, Submission.data, Submission.submitted_at)
+                .filter(Submission.task_id == task_id, Submission.id > through)
+                .order_by(Submission.id).limit(batch_size).all()
+            )
+            settled = []
+            for sub_id, raw, submitted_at in rows:
+                if submitted_at is not None and submitted_at > cutoff:
+                    break
+                settled.append((sub_id, raw))
+            if not settled:
+                db.rollback()
+                return merged, bool(rows)
+            _apply_rows(db, Task, TaskFieldStat, task_id, order, settled)
+            db.execute(update(Task).where(Task.id == task_id).values(field_stats_through_id=settled[-1][0]))
+            db.commit()
+            merged += len(settled)
+            if len(settled) < len(rows) or len(rows) < batch_size:
+                return merged, len(settled) < len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+def remove_field_stats(db, Task, Submission, TaskFieldStat, task_id, submission_id, raw):
+    """在当前事务中扣减一条已删除的提交（调用方须已 flush 删除，不提交事务）；尚未合并的提交无需扣减"""
+    ready, order, through = _lock_task_stats(db, Task, task_id)
+    if not ready:
+        return False
+    if submission_id <= through:
+        _apply_rows(db, Task, TaskFieldStat, task_id, order, [(submission_id, raw)], sign=-1)
+    if submission_id == through:
+        # SQLite 会把删除的最大 id 分配给下一条提交，水位退回到本任务的上一条提交，新提交才会被合并
+        previous = (
+            db.query(Submission.id).filter(Submission.task_id == task_id, Submission.id < submission_id)
+            .order_by(Submission.id.desc()).limit(1).scalar()
+        )
+        db.execute(update(Task).where(Task.id == task_id).values(field_stats_through_id=previous))
+    # 删除的可能是第一条提交，字段顺序按剩余数据重新确定
+    keys = _first_keys(db, Submission, task_id)
+    if keys is _UNPARSED:
+        invalidate_field_stats(db, Task, task_id)
+    else:
+        db.execute(update(Task).where(Task.id == task_id).values(
+            field_stats_order=json.dumps(keys, ensure_ascii=False) if keys is not None else None
+        ))
+    return True
+
+
+def invalidate_field_stats(db, Task, task_id):
+    """标记任务统计失效（不提交事务），下次读取时重建"""
+    db.execute(update(Task).where(Task.id == task_id).values(field_stats_ready=False))
+
+
+def reset_field_stats(db, Task, TaskFieldStat, task_id):
+    """清空任务统计（清空全部提交后调用，不提交事务）"""
+    db.query(TaskFieldStat).filter(TaskFieldStat.task_id == task_id).delete(synchronize_session=False)
+    db.execute(update(Task).where(Task.id == task_id).values(
+        field_stats_ready=True, field_stats_order=None, field_stats_through_id=None
+    ))
+
+
+def rebuild_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id):
+    """按 submission 表重建任务统计并提交，返回统计的字段数
+
+    在事务外扫描全部提交，水位设为扫描到的最后一个 id，之后的新提交由后台合并或读取时叠加；
+    写入时才锁定任务行，锁定时间与数据量无关
+    """
+    last_id = [0]
+
+    def scan():
+        for sub_id, raw, _ in iter_submissions(SessionLocal, Submission, task_id):
+            last_id[0] = sub_id
+            yield sub_id, raw
+
+    first_keys, fields = collect_field_stats(scan())
+
+    db = SessionLocal()
+    try:
+        _lock_task_stats(db, Task, task_id)
+        db.query(TaskFieldStat).filter(TaskFieldStat.task_id == task_id).delete(synchronize_session=False)
+        now = datetime.now()
+        for name, acc in fields.items():
+            state = _empty_state()
+            _merge_state(state, acc)
+            stat = TaskFieldStat(task_id=task_id, field=name)
+            _store_state(stat, state, now)
+            db.add(stat)
+        db.execute(update(Task).where(Task.id == task_id).values(
+            field_stats_ready=True,
+            field_stats_order=json.dumps(first_keys, ensure_ascii=False) if first_keys is not None else None,
+            field_stats_through_id=last_id[0] or None,
+        ))
+        db.commit()
+        return len(fields)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+class FieldStatsUpdater:
+    """后台合并新提交：提交时只登记任务 id，每 flush_seconds 秒把登记过的任务的新提交成批合并进统计表"""
+
+    def __init__(self, SessionLocal, Task, Submission, TaskFieldStat, flush_seconds=FIELD_STATS_FLUSH_SECONDS):
+        self.SessionLocal = SessionLocal
+        self.Task = Task
+        self.Submission = Submission
+        self.TaskFieldStat = TaskFieldStat
+        self.flush_seconds = max(0.1, flush_seconds)
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'marked': 0, 'runs': 0, 'merged': 0, 'errors': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='field-stats-updater', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        # 退出前把已稳定的提交合并完（未稳定的由下次读取时叠加、合并）
+        self.flush()
+
+    def mark(self, task_id):
+        """登记有新提交的任务（只入内存，不访问数据库）"""
+        with self._lock:
+            self._dirty.add(task_id)
+            self._stats['marked'] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            task_ids, self._dirty = self._dirty, set()
+        if not task_ids:
+            return 0
+        started = time.monotonic()
+        merged, pending, errors = 0, set(), 0
+        for task_id in task_ids:
+            try:
+                count, more = catch_up_field_stats(self.SessionLocal, self.Task, self.Submission, self.TaskFieldStat, task_id)
+            except Exception as e:
+                errors += 1
+                more = True
+                logger.error(f"合并字段统计失败 - Task ID: {task_id}, 错误: {str(e)}")
+            else:
+                merged += count
+            if more:
+                pending.add(task_id)
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self._dirty |= pending
+            s = self._stats
+            s['runs'] += 1
+            s['merged'] += merged
+            s['errors'] += errors
+            s['last_flush_ms'] = elapsed_ms
+            s['max_flush_ms'] = max(s['max_flush_ms'], elapsed_ms)
+        return merged
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['pending_tasks'] = len(self._dirty)
+        s['flush_seconds'] = self.flush_seconds
+        s['settle_seconds'] = FIELD_STATS_SETTLE_SECONDS
+        return s
+
+
+# ---------- 读取 ----------
+def load_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id, rebuild=True):
+    """读取任务字段统计：{'fields': 字段顺序或 None, 'stats': {字段: dict}}；统计未就绪时先重建
+
+    先合并已稳定的新提交，尚未合并的提交（刚提交、还在 FIELD_STATS_SETTLE_SECONDS 内）在内存中叠加，不写回；
+    rebuild=False 且未就绪时返回 None
+    """
+    catch_up_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id)
+    db = SessionLocal()
+    try:
+        row = (
+            db.query(Task.field_stats_ready, Task.field_stats_order, Task.field_stats_through_id)
+            .filter(Task.id == task_id).one_or_none()
+        )
+        if row is None:
+            return None
+        ready, order, through = row
+        if not ready:
+            db.close()
+            if not rebuild:
+                return None
+            started = datetime.now()
+            rebuild_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id)
+            logger.info(f"已重建任务字段统计 - Task ID: {task_id}, 用时 {(datetime.now() - started).total_seconds():.2f}s")
+            return load_field_stats(SessionLocal, Task, Submission, TaskFieldStat, task_id, rebuild=False)
+        states = {stat.field: _row_state(stat) for stat in db.query(TaskFieldStat).filter(TaskFieldStat.task_id == task_id).all()}
+        tail = (
+            db.query(Submission.id, Submission.data)
+            .filter(Submission.task_id == task_id, Submission.id > (through or 0))
+            .order_by(Submission.id).all()
+        )
+        fields = json.loads(order) if order else None
+        if tail:
+            first_keys, accs = collect_field_stats(tail)
+            if fields is None and first_keys is not None:
+                fields = first_keys
+            for name, acc in accs.items():
+                _merge_state(states.setdefault(name, _empty_state()), acc)
+        return {'fields': fields, 'stats': {name: _public_stat(state) for name, state in states.items()}}
+    finally:
+        db.close()
+
+
+# ---------- 批量计算（pandas） ----------
+_MISSING = object()
+_NUMERIC_TYPES = (int, float, bool)
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def _column_stats(column, rows, field):
+    """一列（object 数组，保留 JSON 解析出的原始值）的统计，结构与 load_field_stats 相同，
+    另含 kind / missing_rate / std / quantiles / unique_count
+
+    缺失和 null 在 DataFrame 中都是 NA，只回查 NA 单元格区分“没有这个字段”和“值为 null”
+    """
+    total = len(rows)
+    na = pd.isna(column)
+    pos = np.flatnonzero(~na)
+    none_pos = []      # 值为 null：按文本 'None' 统计
+    nan_count = 0      # 非标准 JSON 的 NaN：按数值统计（平均值为 nan，与内置 sum 一致）
+    for i in np.flatnonzero(na).tolist():
+        value = rows[i].get(field, _MISSING)
+        if value is None:
+            none_pos.append(i)
+        elif value is not _MISSING:
+            nan_count += 1
+    values = column[pos]
+    count = len(pos) + len(none_pos) + nan_count
+
+    # 先整体推断类型，只有混合类型的列逐个判断
+    inferred = pd.api.types.infer_dtype(values, skipna=False) if len(values) else 'empty'
+    keys = None        # 常见值计数的键（数值保留原值，其他按 str()），None 表示直接用原值
+    if inferred == 'boolean':
+        numeric_mask = np.ones(len(pos), dtype=bool)
+        bool_values = values.astype(bool)
+    elif inferred in ('integer', 'floating', 'mixed-integer-float'):
+        numeric_mask = np.ones(len(pos), dtype=bool)
+        bool_values = np.zeros(0, dtype=bool)
+    elif inferred in ('string', 'empty'):
+        numeric_mask = np.zeros(len(pos), dtype=bool)
+        bool_values = np.zeros(0, dtype=bool)
+    else:
+        types = pd.Series(values, dtype=object).map(type).to_numpy()
+        numeric_mask = np.isin(types, _NUMERIC_TYPES)
+        bool_values = values[types == bool].astype(bool)
+        keys = column.copy()
+        keys[pos[~numeric_mask]] = [str(v) for v in values[~numeric_mask]]
+    numeric_count = int(numeric_mask.sum()) + nan_count
+
+    stat = {
+        'count': count,
+        'numeric_count': numeric_count,
+        'numeric_sum': 0.0, 'numeric_sumsq': 0.0,
+        'numeric_min': None, 'numeric_max': None,
+        'true_count': int(bool_values.sum()),
+        'false_count': int(len(bool_values) - bool_values.sum()),
+        'text_count': count - numeric_count,
+        'kind': 'numeric' if numeric_count > count * 0.8 else 'text',
+        'missing_rate': 1 - count / total if total else 0.0,
+        'std': None, 'quantiles': None,
+    }
+    numbers = None
+    if numeric_mask.any():
+        numeric_pos = pos[numeric_mask]
+        numbers = values[numeric_mask].astype(float)
+        # 最小 / 最大值取第一次出现的原始值（与内置 min/max 相同，整数不会显示成 1.0）
+        stat['numeric_min'] = rows[numeric_pos[int(np.argmin(numbers))]][field]
+        stat['numeric_max'] = rows[numeric_pos[int(np.argmax(numbers))]][field]
+        stat['numeric_sum'] = float(numbers.sum()) + (float('nan') if nan_count else 0.0)
+        stat['numeric_sumsq'] = float(np.square(numbers).sum())
+        stat['std'] = float(numbers.std(ddof=1)) if len(numbers) > 1 else None
+        stat['quantiles'] = dict(zip(QUANTILES, (float(q) for q in np.quantile(numbers, QUANTILES))))
+
+    # 常见值：次数降序，同次数按首次出现顺序（与 Counter.most_common 一致；1 / 1.0 / True 计为同一个值）
+    if none_pos:
+        if keys is None:
+            keys = column.copy()
+        keys[none_pos] = 'None'
+        pos = np.sort(np.concatenate([pos, np.asarray(none_pos, dtype=pos.dtype)]))
+    # factorize 按首次出现顺序编号；纯数值列直接在浮点数组上计数
+    if keys is not None:
+        codes, uniques = pd.factorize(keys[pos])
+    elif numeric_mask.all() and len(pos):
+        codes, uniques = pd.factorize(numbers)
+    else:
+        codes, uniques = pd.factorize(values)
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    order = np.argsort(-counts, kind='stable')[:FIELD_STATS_TOP_CAPACITY]
+    top_values = []
+    for code in order:
+        key = uniques[code]
+        if not isinstance(key, str):
+            # 数值按第一次出现的原始值显示
+            key = rows[pos[int(np.argmax(codes == code))]][field]
+        top_values.append((key, int(counts[code])))
+    stat['unique_count'] = len(uniques)
+    stat['top_values'] = top_values
+    return stat
+
+
+def frame_field_stats(data_list):
+    """由已解析的提交数据（json.loads 结果的列表）计算字段统计，返回结构与 load_field_stats 相同
+
+    数据一次性放进 DataFrame，按列计算；字段顺序取第一条数据的字段，
+    第一条不是 JSON 对象时 fields 为 False，与逐条统计一致
+    """
+    if not data_list:
+        return {'fields': None, 'stats': {}}
+    first = data_list[0]
+    if not isinstance(first, dict):
+        return {'fields': False, 'stats': {}}
+    rows = [data for data in data_list if isinstance(data, dict)]
+    frame = pd.DataFrame(rows, dtype=object)
+    matrix = frame.to_numpy()
+    stats = {}
+    for i, field in enumerate(frame.columns):
+        stat = _column_stats(matrix[:, i], rows, field)
+        if stat['count'] > 0:
+            stats[field] = stat
+    return {'fields': list(first.keys()), 'stats': stats}
+
+
+def format_field_stats(field_stats):
+    """生成提示词中的“数据字段统计”部分（与逐条统计的输出一致）；没有可输出的内容时返回空字符串"""
+    fields = field_stats.get('fields') if field_stats else None
+    if not isinstance(fields, list):
+        return ''
+    section = "数据字段统计：\n"
+    for field in fields:
+        stat = field_stats['stats'].get(field)
+        if not stat or stat['count'] <= 0:
+            continue
+        section += f"  - {field}: "
+        if stat['numeric_count'] > stat['count'] * 0.8:
+            if stat['numeric_count'] > 0:
+                section += (f"数值型，范围: {stat['numeric_min']} - {stat['numeric_max']}，"
+                            f"平均值: {stat['numeric_sum'] / stat['numeric_count']:.2f}\n")
+            else:
+                section += "数值型\n"
+        else:
+            top_values = stat['top_values'][:5]
+            if len(top_values) > 0:
+                section += f"文本型，常见值: {', '.join([f'{k}({v}次)' for k, v in top_values[:3]])}\n"
+            else:
+                section += "文本型\n"
+    section += "\n"
+    return section
+
+
+def format_field_schema(field_stats):
+    """生成提示词中的字段列表（只有字段名，不含随提交变化的统计值）；没有可输出的字段时返回空字符串"""
+    fields = field_stats.get('fields') if field_stats else None
+    if not isinstance(fields, list):
+        return ''
+    names = [str(field) for field in fields if (field_stats['stats'].get(field) or {}).get('count', 0) > 0]
+    if not names:
+        return ''
+    return f"表单字段（共 {len(names)} 个）：{'、'.join(names)}\n"
@@ -0,0 +1,214 @@
+"""提示词 token 预算 - 离线估算提示词长度，超出预算时压缩
+
+generate_analysis_prompt 原来只把单个值截断到 100 字，不知道整个提示词有多长：用户模板 + HTML 分析结果 + 样例
+加起来可能超过服务商的上下文长度，排队、等待几十秒之后才收到失败。这里：
+- estimate_tokens：按字符类别估算 token 数（汉字 / 日韩文字按各服务商分词器的经验比例，英文单词约 4 个字母一个 token，
+  数字约 3 位一个 token，标点各算一个），不依赖分词器，误差由 PROMPT_BUDGET_SAFETY 留出余量
+- prompt_token_budget：提示词预算 = min(PROMPT_TOKEN_BUDGET, (上下文长度 - 输出预留) × 余量)，
+  可用 PROMPT_TOKEN_BUDGET_<服务商> 单独设置
+- SampleBlock：提示词中的样例部分按压缩级别重新渲染，依次：省略取值全部相同或为空的字段、重复的值改为引用、
+  长字段名换成代号并附对照表、缩短单个值、减少样例条数
+- compress_text：对已经成形的提示词（用户编辑过的完整提示词）做文本级压缩：合并空白、去掉重复的长行、截断过长的行
+"""
+import os
+import re
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+AI_OUTPUT_TOKENS = 4000     # 为模型输出预留的 token 数（即 call_ai_model 的 max_tokens）
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '24000'))             # 提示词 token 预算
+PROMPT_BUDGET_SAFETY = float(os.getenv('PROMPT_BUDGET_SAFETY', '0.85'))         # 估算误差余量（占可用上下文的比例）
+
+# 各服务商模型的上下文长度（token）
+PROVIDER_CONTEXT_TOKENS = {
+    'deepseek': 65536,
+    'doubao': 131072,
+    'qwen': 131072,
+    'chat_server': 32768,
+}
+DEFAULT_CONTEXT_TOKENS = 32768
+# 每个汉字（及日韩文字、全角标点）平均折合的 token 数
+CJK_TOKENS_PER_CHAR = {
+    'deepseek': 0.6,
+    'doubao': 0.7,
+    'qwen': 0.7,
+    'chat_server': 0.6,
+}
+DEFAULT_CJK_TOKENS_PER_CHAR = 0.7
+
+_CJK_RE = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]')  # 中日韩文字及全角标点
+_WORD_RE = re.compile(r'[A-Za-z]+')
+_DIGIT_RE = re.compile(r'[0-9]+')
+_SPACE_RE = re.compile(r'\s')
+_NEWLINE_RE = re.compile(r'\n+')
+
+
+def estimate_tokens(text, provider=None):
+    """离线估算 text 的 token 数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    words = _WORD_RE.findall(text)
+    digits = _DIGIT_RE.findall(text)
+    letters = sum(len(w) for w in words)
+    numbers = sum(len(d) for d in digits)
+    spaces = len(_SPACE_RE.findall(text))
+    other = max(0, len(text) - cjk - letters - numbers - spaces)
+    tokens = (
+        cjk * CJK_TOKENS_PER_CHAR.get(provider, DEFAULT_CJK_TOKENS_PER_CHAR)
+        + sum(max(1, round(len(w) / 4)) for w in words)
+        + sum(math.ceil(len(d) / 3) for d in digits)
+        + other
+        + len(_NEWLINE_RE.findall(text))
+    )
+    return int(math.ceil(tokens))
+
+
+def context_limit(provider):
+    """提示词的硬上限：上下文长度减去输出预留"""
+    return PROVIDER_CONTEXT_TOKENS.get(provider, DEFAULT_CONTEXT_TOKENS) - AI_OUTPUT_TOKENS
+
+
+def prompt_token_budget(provider):
+    """提示词的 token 预算"""
+    budget = PROMPT_TOKEN_BUDGET
+    raw = os.getenv(f'PROMPT_TOKEN_BUDGET_{str(provider).upper()}', '').strip()
+    if raw:
+        try:
+            budget = int(raw)
+        except ValueError:
+            logger.warning(f"无效的提示词预算 PROMPT_TOKEN_BUDGET_{str(provider).upper()}={raw}，使用默认值")
+    return max(1000, min(budget, int(context_limit(provider) * PROMPT_BUDGET_SAFETY)))
+
+
+# 样例部分的压缩级别，依次尝试直到放得下
+SAMPLE_LEVELS = (
+    {},
+    {'drop_low_info': True},
+    {'drop_low_info': True, 'dedupe': True},
+    {'drop_low_info': True, 'dedupe': True, 'legend': True},
+    {'drop_low_info': True, 'dedupe': True, 'legend': True, 'value_chars': 50},
+    {'drop_low_info': True, 'dedupe': True, 'legend': True, 'value_chars': 30, 'max_samples': 10},
+    {'drop_low_info': True, 'dedupe': True, 'legend': True, 'value_chars': 20, 'max_samples': 5},
+    {'drop_low_info': True, 'dedupe': True, 'legend': True, 'value_chars': 20, 'max_samples': 3},
+)
+SAMPLE_VALUE_CHARS = 100    # 不压缩时单个值的截断长度（与原提示词一致）
+DEDUPE_MIN_CHARS = 12       # 不短于此长度的重复值改为引用
+LEGEND_MIN_KEY_CHARS = 5    # 不短于此长度的字段名换成代号
+
+
+def _truncate(value, limit):
+    value_str = str(value)
+    if len(value_str) > limit:
+        value_str = value_str[:limit] + "...[截断]"
+    return value_str
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, (str, list, dict)) and not value)
+
+
+class SampleBlock:
+    """提示词中的样例部分
+
+    records：[(标签, 标题行, 数据 dict / 无法解析时为原始文本)]，例如 ('样例 #1', '\\n样例 #1 (第 1 条记录):\\n', {...})
+    heading(显示条数)：返回样例部分的第一行
+    """
+
+    def __init__(self, records, heading):
+        self.records = records
+        self.heading = heading
+
+    def render(self, level=0):
+        options = SAMPLE_LEVELS[min(level, len(SAMPLE_LEVELS) - 1)]
+        records = self.records
+        max_samples = options.get('max_samples')
+        if max_samples and len(records) > max_samples:
+            # 均匀保留，首尾样例始终保留
+            step = (len(records) - 1) / (max_samples - 1)
+            records = [records[round(i * step)] for i in range(max_samples)]
+        value_chars = options.get('value_chars', SAMPLE_VALUE_CHARS)
+        dicts = [data for _, _, data in records if isinstance(data, dict)]
+
+        notes = []
+        omitted = set()
+        if options.get('drop_low_info') and len(dicts) > 1:
+            keys = list(dict.fromkeys(key for data in dicts for key in data))
+            empty, constant = [], []
+            for key in keys:
+                values = [data.get(key) for data in dicts]
+                if all(_is_empty(v) for v in values):
+                    empty.append(key)
+                elif all(key in data for data in dicts) and len({str(v) for v in values}) == 1:
+                    constant.append((key, values[0]))
+            omitted = set(empty) | {key for key, _ in constant}
+            if constant:
+                notes.append("以下字段在所有样例中取值相同，样例中不再重复："
+                             + '；'.join(f"{key}={_truncate(value, value_chars)}" for key, value in constant))
+            if empty:
+                notes.append("以下字段在所有样例中均为空，已省略：" + '、'.join(empty))
+
+        codes = {}
+        if options.get('legend'):
+            counts = {}
+            for data in dicts:
+                for key in data:
+                    if key not in omitted and len(str(key)) >= LEGEND_MIN_KEY_CHARS:
+                        counts[key] = counts.get(key, 0) + 1
+            for key, count in counts.items():
+                if count > 1:
+                    codes[key] = f"F{len(codes) + 1}"
+            if codes:
+                notes.append("字段代号：" + '；'.join(f"{code}={key}" for key, code in codes.items()))
+
+        seen = {}
+        body = ''
+        for label, title, data in records:
+            if not isinstance(data, dict):
+                body += title if data is None else f"\n{label}: {str(data)[:value_chars]}...\n"
+                continue
+            body += title
+            for key, value in data.items():
+                if key in omitted:
+                    continue
+                value_str = _truncate(value, value_chars)
+                if options.get('dedupe') and len(value_str) >= DEDUPE_MIN_CHARS:
+                    first = seen.setdefault((key, value_str), label)
+                    if first != label:
+                        value_str = f"〃同{first}"
+                body += f"  - {codes.get(key, key)}: {value_str}\n"
+
+        section = self.heading(len(records))
+        if notes:
+            section += ''.join(f"（{note}）\n" for note in notes)
+        return section + body
+
+
+def compress_text(prompt, budget, provider=None, max_line_chars=(400, 200, 100)):
+    """对成形的提示词做文本级压缩，返回 (压缩后的提示词, 估算 token 数)；放不下时返回压缩到最后一步的结果"""
+    tokens = estimate_tokens(prompt, provider)
+    if tokens <= budget:
+        return prompt, tokens
+    # 合并行内多余空白和多余空行
+    lines = [re.sub(r'[ \t　]{2,}', ' ', line.rstrip()) for line in prompt.split('\n')]
+    text = re.sub(r'\n{3,}', '\n\n', '\n'.join(lines))
+    # 去掉重复的长行（保留第一次出现）
+    seen = set()
+    kept = []
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if len(stripped) >= 20:
+            if stripped in seen:
+                continue
+            seen.add(stripped)
+        kept.append(line)
+    text = '\n'.join(kept)
+    tokens = estimate_tokens(text, provider)
+    for limit in max_line_chars:
+        if tokens <= budget:
+            break
+        text = '\n'.join(line if len(line) <= limit else line[:limit] + '...[截断]' for line in text.split('\n'))
+        tokens = estimate_tokens(text, provider)
+    return text, tokens
@@ -0,0 +1,152 @@
+"""限流事件记录 - 把封禁事件批量写入 rate_limit_event 表
+
+被拦截的请求只在内存中登记，同一 IP 在同一次封禁期内对同一任务只记一条；
+后台线程定期批量插入，并按任务保留最近 N 条、按天数清理过期记录。
+"""
+import os
+import time
+import atexit
+import threading
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_EVENT_FLUSH_SECONDS = float(os.getenv('RATE_LIMIT_EVENT_FLUSH_SECONDS', '2'))   # 批量写入间隔
+RATE_LIMIT_EVENT_MAX_PER_TASK = int(os.getenv('RATE_LIMIT_EVENT_MAX_PER_TASK', '200'))     # 每个任务最多保留条数
+RATE_LIMIT_EVENT_RETENTION_DAYS = int(os.getenv('RATE_LIMIT_EVENT_RETENTION_DAYS', '7'))   # 过期事件保留天数
+RATE_LIMIT_EVENT_MAX_PENDING = 10000                                                       # 内存中待写入上限
+
+
+class RateLimitEventLog:
+    """限流事件的缓冲写入器"""
+
+    def __init__(self, SessionLocal, RateLimitEvent, flush_seconds=RATE_LIMIT_EVENT_FLUSH_SECONDS,
+                 max_per_task=RATE_LIMIT_EVENT_MAX_PER_TASK, retention_days=RATE_LIMIT_EVENT_RETENTION_DAYS):
+        self.SessionLocal = SessionLocal
+        self.RateLimitEvent = RateLimitEvent
+        self.flush_seconds = max(0.1, flush_seconds)
+        self.max_per_task = max(1, max_per_task)
+        self.retention = timedelta(days=max(1, retention_days))
+        self._pending = []
+        self._recorded = {}  # (task_id, ip) -> 已记录封禁的结束时间戳，用于同一封禁期去重
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_cleanup = 0.0
+        self._stats = {'recorded': 0, 'deduplicated': 0, 'dropped': 0, 'written': 0, 'trimmed': 0, 'flush_errors': 0}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rate-limit-event-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self.flush()
+
+    def record(self, task_id, ip, started_ts, expires_ts, window_seconds=None):
+        """登记一次封禁（只入内存，不访问数据库）"""
+        key = (task_id, ip)
+        with self._lock:
+            if self._recorded.get(key, 0) >= expires_ts:
+                self._stats['deduplicated'] += 1
+                return False
+            if len(self._pending) >= RATE_LIMIT_EVENT_MAX_PENDING:
+                self._stats['dropped'] += 1
+                return False
+            self._recorded[key] = expires_ts
+            self._pending.append({
+                'task_id': task_id,
+                'ip': ip[:64],
+                'created_at': datetime.fromtimestamp(started_ts),
+                'expires_at': datetime.fromtimestamp(expires_ts),
+                'window_seconds': window_seconds,
+            })
+            self._stats['recorded'] += 1
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            # 去重表只需保留仍在封禁期内的记录
+            now_ts = time.time()
+            self._recorded = {k: v for k, v in self._recorded.items() if v > now_ts}
+        if not batch:
+            self._cleanup_expired()
+            return 0
+        Event = self.RateLimitEvent
+        db = self.SessionLocal()
+        try:
+            db.execute(Event.__table__.insert(), batch)
+            trimmed = 0
+            for task_id in {row['task_id'] for row in batch}:
+                trimmed += self._trim_task(db, task_id)
+            db.commit()
+            with self._lock:
+                self._stats['written'] += len(batch)
+                self._stats['trimmed'] += trimmed
+        except Exception as e:
+            db.rollback()
+            with self._lock:
+                self._stats['flush_errors'] += 1
+            logger.error(f"写入限流事件失败（{len(batch)} 条）: {str(e)}")
+        finally:
+            db.close()
+        self._cleanup_expired()
+        return len(batch)
+
+    def _trim_task(self, db, task_id):
+        """每个任务只保留最近 max_per_task 条（环形缓冲）"""
+        Event = self.RateLimitEvent
+        boundary = (
+            db.query(Event.id)
+            .filter(Event.task_id == task_id)
+            .order_by(Event.id.desc())
+            .offset(self.max_per_task)
+            .limit(1)
+            .scalar()
+        )
+        if boundary is None:
+            return 0
+        result = db.execute(delete(Event).where(Event.task_id == task_id, Event.id <= boundary))
+        return result.rowcount or 0
+
+    def _cleanup_expired(self):
+        """每小时清理一次早已结束的封禁记录"""
+        now = time.monotonic()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        Event = self.RateLimitEvent
+        db = self.SessionLocal()
+        try:
+            result = db.execute(delete(Event).where(Event.expires_at < datetime.now() - self.retention))
+            db.commit()
+            if result.rowcount:
+                logger.info(f"已清理过期限流事件 {result.rowcount} 条")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"清理过期限流事件失败: {str(e)}")
+        finally:
+            db.close()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['pending'] = len(self._pending)
+        s['running'] = self._thread is not None and self._thread.is_alive()
+        return s
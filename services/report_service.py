@@ -3,53 +3,122 @@ import os
 import io
 import re
 import urllib.parse
-import threading
 import logging
 from datetime import datetime
-from functools import wraps
 from PIL import Image, ImageDraw, ImageFont
 
+from .analysis_jobs import ACTIVE_STATUSES
+from .report_stream import REPORT_STREAM_ENABLED
+from .call_context import AI_JOB_DEADLINE, call_scope
+from .chunked_analysis import CHUNKED_ANALYSIS_DEADLINE, build_chunked_prompt
+from .prompt_budget import compress_text, context_limit, estimate_tokens, prompt_token_budget
+from .ai_usage import merge_usage
+
 logger = logging.getLogger(__name__)
 
-# 用于存储分析任务进度的字典
-analysis_progress = {}
-analysis_results = {}
-completed_reports = set()
-progress_lock = threading.Lock()
+# 分析任务的状态记录在 analysis_job 表（services/analysis_jobs.py），多 worker 部署时任一进程都能查询；
+# 由 configure_analysis_jobs 注入
+_analysis_jobs = None
+# 生成中的报告文本（services/report_stream.py），由 configure_report_stream 注入；未注入时不使用流式调用
+_report_stream = None
 
 
-def timeout(seconds, error_message="函数执行超时"):
-    """超时装饰器"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            result = [None]
-            exception = [None]
-            
-            def target():
-                try:
-                    result[0] = func(*args, **kwargs)
-                except Exception as e:
-                    exception[0] = e
-            
-            thread = threading.Thread(target=target)
-            thread.daemon = True
-            thread.start()
-            thread.join(seconds)
-            
-            if thread.is_alive():
-                raise TimeoutError(error_message)
-            elif exception[0]:
-                raise exception[0]
-            else:
-                return result[0]
-        
-        return wrapper
-    return decorator
+def configure_analysis_jobs(store):
+    """设置保存分析任务状态的 AnalysisJobStore"""
+    global _analysis_jobs
+    _analysis_jobs = store
+
+
+def configure_report_stream(hub):
+    """设置转发生成中报告文本的 ReportStreamHub"""
+    global _report_stream
+    _report_stream = hub
+
+
+def set_analysis_progress(task_id, progress, job_id):
+    """更新分析任务记录（dict：status / progress / message ...，status 为 queued / running / completed / error / cancelled）"""
+    if _analysis_jobs is None:
+        logger.error(f"未配置分析任务记录，无法保存进度 - Task ID: {task_id}")
+        return False
+    try:
+        return _analysis_jobs.update(job_id, task_id=task_id, **progress)
+    except Exception as e:
+        logger.error(f"保存分析进度失败 - Task ID: {task_id}, 错误: {str(e)}")
+        return False
+
+
+def get_analysis_progress(task_id):
+    """任务最新一次分析的状态；排队和执行中统一返回 status='in_progress'，没有记录返回 None"""
+    if _analysis_jobs is None:
+        return None
+    try:
+        record = _analysis_jobs.latest(task_id)
+    except Exception as e:
+        logger.error(f"读取分析进度失败 - Task ID: {task_id}, 错误: {str(e)}")
+        return None
+    if record is None:
+        return None
+    progress = dict(record)
+    if record['status'] in ACTIVE_STATUSES:
+        progress['status'] = 'in_progress'
+    return progress
+
+
+def cancel_analysis_record(task_id):
+    """把任务进行中的分析记录标记为已取消；执行该任务的进程（可能是其他 worker）在阶段之间读取到后丢弃结果"""
+    if _analysis_jobs is None:
+        return False
+    record = _analysis_jobs.latest_active(task_id)
+    if record is None:
+        return False
+    return set_analysis_progress(task_id, {'status': 'cancelled', 'message': '已取消'}, record['id'])
+
+
+def _queued_progress(position):
+    if position:
+        message = f'排队中，前面还有 {position} 个分析任务'
+    else:
+        message = '排队中，即将开始分析...'
+    return {'status': 'queued', 'progress': 0, 'message': message, 'queue_position': position}
+
+
+def start_analysis_job(executor, provider, task_id, user_id, ai_config_id, custom_prompt, *args, use_cache=True,
+                       chunked=False):
+    """新建分析任务记录，并把 perform_analysis_with_custom_prompt 提交到 AI 任务执行器（services.ai_executor）
+
+    排队位置变化时写入记录，取消或服务重启时写入 cancelled / error；执行器中已有同一任务时返回已有任务
+    use_cache=False 时（强制重新生成）不使用 AI 响应缓存中的结果；chunked=True 时先分块汇总全部提交
+    记录中同时写入该服务商的提示词 token 预算和提示词的估算 token 数
+    """
+    record_id = _analysis_jobs.create(task_id, user_id, provider, custom_prompt,
+                                      token_budget=prompt_token_budget(provider),
+                                      prompt_tokens=estimate_tokens(custom_prompt, provider))
+
+    def run(job):
+        perform_analysis_with_custom_prompt(task_id, user_id, ai_config_id, custom_prompt, *args,
+                                            job=job, record_id=record_id, use_cache=use_cache, chunked=chunked)
+
+    def on_cancel(reason):
+        status = 'cancelled' if reason == '已取消' else 'error'
+        set_analysis_progress(task_id, {'status': status, 'message': reason}, record_id)
+
+    try:
+        job = executor.submit(
+            ('report', task_id), user_id, provider, run,
+            on_position=lambda position: set_analysis_progress(task_id, _queued_progress(position), record_id),
+            on_cancel=on_cancel,
+        )
+    except Exception:
+        _analysis_jobs.discard(record_id, task_id)
+        raise
+    if job.func is not run:
+        # 同一任务已在排队或执行
+        _analysis_jobs.discard(record_id, task_id)
+    return job
 
 
 def save_analysis_report(task_id, report_content, SessionLocal, Task, upload_folder):
-    """保存分析报告到文件系统和数据库"""
+    """保存分析报告到文件系统和数据库，返回报告文件路径（失败返回 None）"""
     db = SessionLocal()
     try:
         task = db.query(Task).filter_by(id=task_id).first()
@@ -133,14 +202,13 @@ def save_analysis_report(task_id, report_content, SessionLocal, Task, upload_fol
             task.report_generated_at = datetime.now()
             db.commit()
             
-            with progress_lock:
-                completed_reports.add(task_id)
-            
             logger.info(f"任务 {task_id} 的分析报告已保存")
+            return report_path
     except Exception as e:
         logger.error(f"保存分析报告失败: {str(e)}")
     finally:
         db.close()
+    return None
 
 
 def generate_report_image(task, report_content):
@@ -302,137 +370,224 @@ def generate_report_image(task, report_content):
 def perform_analysis_with_custom_prompt(task_id, user_id, ai_config_id, custom_prompt, 
                                          SessionLocal, Task, Submission, AIConfig,
                                          read_file_content_func, call_ai_model_func, 
-                                         save_analysis_report_func):
-    """使用自定义提示词执行分析任务"""
+                                         save_analysis_report_func, job=None, record_id=None, use_cache=True,
+                                         chunked=False):
+    """使用自定义提示词执行分析任务
+
+    job：在 AI 任务执行器中运行时传入，各阶段之间检查是否已取消；已取消的任务不保存结果
+    record_id：analysis_job 记录 id，进度写入该记录
+    use_cache：False 时跳过 AI 响应缓存，重新调用模型
+    chunked：先把全部提交分块汇总（services.chunked_analysis），汇总附在提示词之后再生成报告
+    """
     import traceback
     import logging
+    from .ai_executor import JobCancelled
+    
+    def progress(fields):
+        set_analysis_progress(task_id, fields, record_id)
+    
+    def cancelled():
+        if job is not None and job.cancelled:
+            return True
+        # 取消请求可能由其他 worker 进程写入记录
+        return record_id is not None and _analysis_jobs is not None and _analysis_jobs.status(record_id) == 'cancelled'
     
     db = SessionLocal()
     try:
         task = db.query(Task).filter_by(id=task_id, user_id=user_id).first()
         if not task:
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': '任务不存在'
-                }
+            progress({
+                'status': 'error',
+                'message': '任务不存在'
+            })
             return
         
-        submission = db.query(Submission).filter_by(task_id=task_id).all()
-        
         file_content = None
         if task.file_path and os.path.exists(task.file_path):
             file_content = read_file_content_func(task.file_path)
         
         ai_config = db.query(AIConfig).filter_by(id=ai_config_id).first()
         if not ai_config:
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': 'AI配置不存在'
-                }
+            progress({
+                'status': 'error',
+                'message': 'AI配置不存在'
+            })
             return
         
         if ai_config.selected_model == 'deepseek' and not ai_config.deepseek_api_key:
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': 'DeepSeek API密钥未配置'
-                }
+            progress({
+                'status': 'error',
+                'message': 'DeepSeek API密钥未配置'
+            })
             logging.error(f"任务 {task_id}：DeepSeek API密钥未配置")
             return
         elif ai_config.selected_model == 'doubao' and not ai_config.doubao_api_key:
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': '豆包API密钥未配置完整'
-                }
+            progress({
+                'status': 'error',
+                'message': '豆包API密钥未配置完整'
+            })
             logging.error(f"任务 {task_id}：豆包API密钥未配置完整")
             return
         
         logging.info(f"任务 {task_id}：使用模型 {ai_config.selected_model}")
         
-        with progress_lock:
-            analysis_progress[task_id] = {
-                'status': 'in_progress',
-                'progress': 0,
-                'message': '正在生成提示词...'
-            }
+        progress({
+            'status': 'running',
+            'progress': 0,
+            'message': '正在生成提示词...'
+        })
         
         prompt = custom_prompt
+        # 服务商返回的 token 用量（分批汇总和生成报告的各次调用合计），完成时写入记录
+        usage = None
         
-        with progress_lock:
-            analysis_progress[task_id] = {
-                'status': 'in_progress',
-                'progress': 1,
-                'message': '大模型分析中，这可能需要几分钟时间...'
-            }
-        logging.info(f"任务 {task_id}：调用AI模型进行分析")
+        if chunked:
+            def on_chunk(done, count, stage):
+                if cancelled():
+                    raise JobCancelled(f"任务 {task_id} 已取消")
+                label = '分批汇总全部数据' if stage == 'map' else '合并分批汇总'
+                progress({
+                    'status': 'running',
+                    'progress': 1,
+                    'message': f'正在{label}：{done}/{count} 批已完成...'
+                })
+            
+            try:
+                with call_scope(CHUNKED_ANALYSIS_DEADLINE, job) as context:
+                    prompt = build_chunked_prompt(task, custom_prompt, ai_config, call_ai_model_func, SessionLocal, Submission,
+                                                  job=job, use_cache=use_cache, on_progress=on_chunk)
+                usage = context.usage
+            except JobCancelled:
+                raise
+            except Exception as chunk_error:
+                if cancelled():
+                    raise JobCancelled(f"任务 {task_id} 已取消")
+                logging.error(f"任务 {task_id}：分批汇总失败: {str(chunk_error)}")
+                progress({
+                    'status': 'error',
+                    'message': f'分批汇总失败: {str(chunk_error)}'
+                })
+                return
         
-        # 调整各模型超时，避免后端刚返回而前端已判定超时的情况
-        timeout_seconds = 180 if ai_config.selected_model == 'chat_server' else (120 if ai_config.selected_model in ['deepseek', 'qwen'] else 90)
+        # 发送前按服务商估算 token 数：超出预算时压缩，超出上下文长度时直接失败，不再排队等服务商拒绝
+        provider = ai_config.selected_model
+        token_budget = prompt_token_budget(provider)
+        prompt_tokens = estimate_tokens(prompt, provider)
+        if prompt_tokens > token_budget:
+            original_tokens = prompt_tokens
+            prompt, prompt_tokens = compress_text(prompt, token_budget, provider)
+            logging.info(f"任务 {task_id}：提示词约 {original_tokens} tokens，超出预算 {token_budget}，压缩后约 {prompt_tokens} tokens")
+        if prompt_tokens > context_limit(provider):
+            logging.error(f"任务 {task_id}：提示词约 {prompt_tokens} tokens，超出 {provider} 的上下文长度 {context_limit(provider)}")
+            progress({
+                'status': 'error',
+                'message': f'提示词过长（约 {prompt_tokens} tokens，超出模型上限 {context_limit(provider)}），请精简提示词后重试',
+                'prompt_tokens': prompt_tokens
+            })
+            return
+        if prompt_tokens > token_budget:
+            logging.warning(f"任务 {task_id}：提示词压缩后约 {prompt_tokens} tokens，仍超出预算 {token_budget}")
+        
+        progress({
+            'status': 'running',
+            'progress': 1,
+            'message': '大模型分析中，这可能需要几分钟时间...',
+            'prompt_tokens': prompt_tokens
+        })
+        logging.info(f"任务 {task_id}：调用AI模型进行分析")
         
-        @timeout(seconds=timeout_seconds, error_message=f"调用{ai_config.selected_model}模型超时（{timeout_seconds}秒）")
-        def call_ai_with_timeout(prompt, config):
-            logging.info(f"开始调用 {config.selected_model} API，提示词长度: {len(prompt)} 字符，超时设置: {timeout_seconds}秒")
-            return call_ai_model_func(prompt, config)
+        if cancelled():
+            raise JobCancelled(f"任务 {task_id} 已取消")
         
+        # 直接在执行器的工作线程中调用，不另开计时线程：call_scope 把剩余时限（AI_JOB_DEADLINE）传给
+        # services.ai_http 作为 HTTP 超时，任务取消时关闭正在读取的连接
         try:
-            analysis_report = call_ai_with_timeout(prompt, ai_config)
+            logging.info(f"开始调用 {ai_config.selected_model} API，提示词长度: {len(prompt)} 字符，约 {prompt_tokens} tokens")
+            stream_hub = _report_stream if REPORT_STREAM_ENABLED else None
+            if stream_hub is None:
+                with call_scope(AI_JOB_DEADLINE, job) as context:
+                    analysis_report = call_ai_model_func(prompt, ai_config, use_cache=use_cache)
+                usage = merge_usage(usage, context.usage)
+            else:
+                # 流式调用：每段文本转给 /api/report_stream，页面在首个 token 到达时就开始显示
+                first_delta = [True]
+                
+                def on_delta(delta):
+                    if job is not None:
+                        # 取消后中断流式读取（关闭连接），不再等待剩余输出
+                        job.check_cancelled()
+                    if first_delta[0]:
+                        first_delta[0] = False
+                        progress({
+                            'status': 'running',
+                            'progress': 2,
+                            'message': '大模型正在输出报告...'
+                        })
+                    stream_hub.append(task_id, delta)
+                
+                stream_hub.open(task_id, record_id)
+                try:
+                    with call_scope(AI_JOB_DEADLINE, job) as context:
+                        analysis_report = call_ai_model_func(prompt, ai_config, stream=True, on_delta=on_delta, use_cache=use_cache)
+                    usage = merge_usage(usage, context.usage)
+                finally:
+                    stream_hub.close(task_id)
             logging.info(f"成功获取 {ai_config.selected_model} API 响应，报告长度: {len(analysis_report)} 字符")
-        except TimeoutError as timeout_error:
-            error_msg = str(timeout_error)
-            logging.error(f"任务 {task_id}：{error_msg}")
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': f"分析超时：{error_msg}，请检查网络连接或稍后重试"
-                }
-            return
         except Exception as api_error:
+            if cancelled():
+                raise JobCancelled(f"任务 {task_id} 已取消")
             logging.error(f"任务 {task_id}：AI模型调用失败: {str(api_error)}")
             logging.error(f"详细错误堆栈: {traceback.format_exc()}")
-            with progress_lock:
-                analysis_progress[task_id] = {
-                    'status': 'error',
-                    'message': f'API调用失败: {str(api_error)}'
-                }
+            progress({
+                'status': 'error',
+                'message': f'API调用失败: {str(api_error)}'
+            })
             return
         
+        if cancelled():
+            # 调用期间被取消：丢弃结果
+            logging.info(f"任务 {task_id}：分析已取消，丢弃模型返回的结果")
+            raise JobCancelled(f"任务 {task_id} 已取消")
+        
         if analysis_report.startswith("错误：") or \
            (analysis_report.startswith("DeepSeek API调用") and "失败" in analysis_report) or \
            (analysis_report.startswith("豆包API调用") and "失败" in analysis_report):
             logging.error(f"任务 {task_id}：AI模型返回错误: {analysis_report}")
             raise Exception(analysis_report)
         
-        with progress_lock:
-            # 先保存到内存，确保状态查询能立即获取
-            analysis_results[task_id] = analysis_report
-            analysis_progress[task_id] = {
-                'status': 'completed',
-                'progress': 100,
-                'message': '分析完成，请查看报告',
-                'report': analysis_report  # 直接包含在progress中，确保前端能获取
-            }
-            logger.info(f"任务 {task_id} 报告已保存到内存，长度: {len(analysis_report)} 字符")
+        # 报告正文保存到数据库（task.analysis_report），任务记录只保存报告文件路径
+        # 获取upload_folder路径
+        quickform_dir = os.path.dirname(os.path.abspath(__file__))
+        upload_folder = os.path.join(quickform_dir, 'uploads')
+        report_path = save_analysis_report_func(task_id, analysis_report, SessionLocal, Task, upload_folder)
+        if not report_path:
+            progress({
+                'status': 'error',
+                'message': '报告保存失败，请稍后重新生成'
+            })
+            return
+        completed = {
+            'status': 'completed',
+            'progress': 100,
+            'message': '分析完成，请查看报告',
+            'result_path': report_path
+        }
+        if usage:
+            completed['provider_prompt_tokens'] = usage['prompt_tokens']
+            completed['cached_tokens'] = usage['cached_tokens']
+            logger.info(f"任务 {task_id}：服务商报告提示词 {usage['prompt_tokens']} tokens，"
+                        f"上下文缓存命中 {usage['cached_tokens']} tokens")
+        progress(completed)
+        logger.info(f"任务 {task_id} 报告已保存到数据库，长度: {len(analysis_report)} 字符")
         
-        # 保存到数据库（在锁外执行，避免阻塞状态查询）
-        try:
-            # 获取upload_folder路径
-            quickform_dir = os.path.dirname(os.path.abspath(__file__))
-            upload_folder = os.path.join(quickform_dir, 'uploads')
-            save_analysis_report_func(task_id, analysis_report, SessionLocal, Task, upload_folder)
-            logger.info(f"任务 {task_id} 报告已保存到数据库")
-        except Exception as e:
-            logger.error(f"保存报告到数据库失败 - Task ID: {task_id}, 错误: {str(e)}")
-            # 即使数据库保存失败，内存中已有报告，不影响用户查看
-            
+    except JobCancelled:
+        # 状态由执行器的取消回调写入
+        raise
     except Exception as e:
-        with progress_lock:
-            analysis_progress[task_id] = {
-                'status': 'error',
-                'message': f'分析过程中出错: {str(e)}'
-            }
+        progress({
+            'status': 'error',
+            'message': f'分析过程中出错: {str(e)}'
+        })
     finally:
         db.close()
 
@@ -0,0 +1,179 @@
+"""报告流式输出 - 把模型逐段返回的文本转给 /api/report_stream 的 SSE 连接
+
+原来页面每 2 秒轮询一次 /api/report_status，整篇报告（60~180 秒）生成完之前什么也看不到。
+现在分析任务用服务商的流式接口调用模型，每收到一段文本就追加到这里：
+- 同一进程内的 SSE 连接在条件变量上等待，新文本到达立即推送
+- 共享状态后端（sqlite / redis）可用时，每 REPORT_STREAM_MIRROR_INTERVAL 秒把已生成的文本写入一次，
+  连到其他 worker 进程的 SSE 连接从那里读取
+完整报告仍由 save_analysis_report 保存；这里只保存生成中的文本，分析结束后很快过期。
+每个 SSE 连接在整个生成过程中占用一个服务线程（最长 REPORT_STREAM_MAX_SECONDS），本进程同时保持的连接数
+不超过 REPORT_STREAM_MAX_CONNECTIONS（默认 SERVE_THREADS 的一半），超出时 /api/report_stream 返回 503，页面改为轮询。
+"""
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+REPORT_STREAM_ENABLED = os.getenv('REPORT_STREAM_ENABLED', 'true').lower() == 'true'          # 是否使用流式调用
+REPORT_STREAM_MIRROR_INTERVAL = float(os.getenv('REPORT_STREAM_MIRROR_INTERVAL', '0.5'))     # 写入共享状态的最小间隔（秒）
+REPORT_STREAM_TTL = 600                                                                      # 共享状态中生成中文本的保留时长（秒）
+REPORT_STREAM_KEEP_SECONDS = 60                                                              # 结束后在本进程保留多久，供读取方取完剩余文本
+# 每个进程同时保持的 SSE 连接上限；默认为服务线程数（SERVE_THREADS）的一半，其余线程留给普通请求
+REPORT_STREAM_MAX_CONNECTIONS = int(os.getenv('REPORT_STREAM_MAX_CONNECTIONS', '0')) or max(1, int(os.getenv('SERVE_THREADS', '8')) // 2)
+
+
+class _Stream:
+    __slots__ = ('job_id', 'parts', 'length', 'done', 'closed_at', 'mirrored_at', 'mirrored_length')
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.parts = []
+        self.length = 0
+        self.done = False
+        self.closed_at = None
+        self.mirrored_at = 0.0
+        self.mirrored_length = 0
+
+    def text(self, offset):
+        return ''.join(self.parts)[offset:]
+
+
+class ReportStreamHub:
+    """按任务保存生成中的报告文本"""
+
+    def __init__(self, state_backend=None, mirror_interval=REPORT_STREAM_MIRROR_INTERVAL,
+                 max_readers=REPORT_STREAM_MAX_CONNECTIONS):
+        # 只有跨进程共享的状态后端才需要镜像；memory 后端下读写都在本进程
+        self.state = state_backend if state_backend is not None and getattr(state_backend, 'shared', False) else None
+        self.mirror_interval = max(0.05, mirror_interval)
+        self.max_readers = max(1, max_readers)
+        self._streams = {}  # task_id -> _Stream
+        self._readers = 0   # 本进程保持中的 SSE 连接数
+        self._cond = threading.Condition()
+        self._stats = {'opened': 0, 'chunks': 0, 'mirror_writes': 0, 'mirror_errors': 0, 'readers_rejected': 0}
+
+    @staticmethod
+    def _key(task_id):
+        return f"analysis:stream:{task_id}"
+
+    def open(self, task_id, job_id):
+        """开始一次新的流式输出（替换该任务之前的文本）"""
+        with self._cond:
+            self._evict()
+            self._streams[task_id] = _Stream(job_id)
+            self._stats['opened'] += 1
+            self._cond.notify_all()
+        self._mirror(task_id, force=True)
+
+    def append(self, task_id, text):
+        if not text:
+            return
+        with self._cond:
+            stream = self._streams.get(task_id)
+            if stream is None or stream.done:
+                return
+            stream.parts.append(text)
+            stream.length += len(text)
+            self._stats['chunks'] += 1
+            self._cond.notify_all()
+        self._mirror(task_id)
+
+    def close(self, task_id):
+        """结束流式输出；等待中的读取方读完剩余文本后结束"""
+        with self._cond:
+            stream = self._streams.get(task_id)
+            if stream is None or stream.done:
+                return
+            stream.done = True
+            stream.closed_at = time.monotonic()
+            self._cond.notify_all()
+        self._mirror(task_id, force=True)
+
+    def acquire_reader(self):
+        """登记一个 SSE 连接；已达 max_readers 时返回 False（调用方返回 503，页面改为轮询）"""
+        with self._cond:
+            if self._readers >= self.max_readers:
+                self._stats['readers_rejected'] += 1
+                return False
+            self._readers += 1
+            return True
+
+    def release_reader(self):
+        with self._cond:
+            self._readers = max(0, self._readers - 1)
+
+    def _evict(self):
+        """清理结束已久的文本（调用方持有锁）"""
+        now = time.monotonic()
+        for task_id in [t for t, s in self._streams.items() if s.done and now - s.closed_at > REPORT_STREAM_KEEP_SECONDS]:
+            del self._streams[task_id]
+
+    def read(self, task_id, job_id, offset, timeout=1.0):
+        """读取 offset 之后的新文本，返回 (文本, 是否已结束)；没有新文本时最多等待 timeout 秒
+
+        job_id 与正在输出的分析不一致（旧连接 / 新一轮分析）时返回 ('', False)
+        """
+        deadline = time.monotonic() + max(0.0, timeout)
+        with self._cond:
+            stream = self._streams.get(task_id)
+            if stream is not None and stream.job_id == job_id:
+                while stream.length <= offset and not stream.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                return stream.text(offset), stream.done
+        if self.state is None:
+            if timeout > 0:
+                time.sleep(min(timeout, self.mirror_interval))
+            return '', False
+        # 流式输出在其他 worker 进程中：读取镜像
+        while True:
+            value = self._read_mirror(task_id)
+            if value is not None and value.get('job_id') == job_id:
+                text = value.get('text', '')
+                if len(text) > offset or value.get('done'):
+                    return text[offset:], bool(value.get('done'))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return '', False
+            time.sleep(min(remaining, self.mirror_interval))
+
+    def _mirror(self, task_id, force=False):
+        if self.state is None:
+            return
+        now = time.monotonic()
+        with self._cond:
+            stream = self._streams.get(task_id)
+            if stream is None:
+                return
+            if not force and (now - stream.mirrored_at < self.mirror_interval or stream.length == stream.mirrored_length):
+                return
+            stream.mirrored_at = now
+            stream.mirrored_length = stream.length
+            value = {'job_id': stream.job_id, 'text': stream.text(0), 'done': stream.done}
+        try:
+            self.state.set(self._key(task_id), value, ttl=REPORT_STREAM_TTL)
+            self._stats['mirror_writes'] += 1
+        except Exception as e:
+            self._stats['mirror_errors'] += 1
+            logger.error(f"写入流式输出失败 - Task ID: {task_id}, 错误: {str(e)}")
+
+    def _read_mirror(self, task_id):
+        try:
+            return self.state.get(self._key(task_id))
+        except Exception as e:
+            logger.error(f"读取流式输出失败 - Task ID: {task_id}, 错误: {str(e)}")
+            return None
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s['active'] = sum(1 for stream in self._streams.values() if not stream.done)
+            s['readers'] = self._readers
+        s['max_readers'] = self.max_readers
+        s['enabled'] = REPORT_STREAM_ENABLED
+        s['mirror'] = self.state is not None
+        return s
@@ -0,0 +1,296 @@
+"""提交数据抽样 - 生成分析提示词时只读取样例行，内存与样例数有关、与任务数据量无关
+
+generate_analysis_prompt 原来把任务的全部提交读进内存，只为了按位置挑出前 5 / 中间 6 / 后 5 条样例。
+这里直接在数据库里取样：
+- spread（默认）：与原来相同的首 / 中 / 尾位置，每段一条 LIMIT/OFFSET 查询（走 submission.task_id 索引）
+- random：在任务的 id 范围内随机探测（id >= 随机值 ORDER BY id LIMIT 1），不扫描整个任务
+- 分层（stratify）：按提交时间（time:day / time:week / time:month）或某个字段的取值（field:字段名）分组，
+  单遍流式读取、每组一个蓄水池，结束后按各组条数比例分配样例名额，最后按 id 取回样例行
+"""
+import os
+import json
+import random
+import logging
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from .export_service import EXPORT_YIELD_PER
+
+logger = logging.getLogger(__name__)
+
+PROMPT_SAMPLE_SIZE = int(os.getenv('PROMPT_SAMPLE_SIZE', '20'))               # 提示词中最多显示的样例条数
+PROMPT_SAMPLE_STRATEGY = os.getenv('PROMPT_SAMPLE_STRATEGY', 'spread')         # spread / random
+PROMPT_SAMPLE_STRATIFY = os.getenv('PROMPT_SAMPLE_STRATIFY', '')              # 空 / time:day / time:week / time:month / field:字段名
+SAMPLE_MAX_STRATA = 50        # 分层时最多保留的组数，之后出现的新取值并入“其他”
+SAMPLE_STRATUM_OTHER = '其他'
+
+SAMPLE_STRATEGIES = ('spread', 'random')
+_TIME_BUCKETS = {
+    'day': lambda dt: dt.strftime('%Y-%m-%d'),
+    'week': lambda dt: dt.strftime('%G-W%V'),
+    'month': lambda dt: dt.strftime('%Y-%m'),
+}
+
+# position：按 id 排序后的位置（从 0 开始）；stratum：分层抽样时所在的组
+SampledSubmission = namedtuple('SampledSubmission', ['position', 'id', 'data', 'submitted_at', 'stratum'])
+
+
+def spread_positions(total, size=PROMPT_SAMPLE_SIZE):
+    """首 / 中 / 尾样例位置（与原 generate_analysis_prompt 的选取规则一致）"""
+    sample_size = min(size, total)
+    if total <= sample_size:
+        return list(range(total))
+    positions = list(range(0, min(5, total)))                        # 前5条
+    if total > 10:
+        positions.extend(range(total // 2 - 3, total // 2 + 3))      # 中间6条
+    positions.extend(range(max(0, total - 5), total))                # 后5条
+    return sorted(set(positions))[:sample_size]
+
+
+def _runs(positions):
+    """把有序位置拆成连续区间 [(起点, 长度)]"""
+    runs = []
+    for position in positions:
+        if runs and runs[-1][0] + runs[-1][1] == position:
+            runs[-1][1] += 1
+        else:
+            runs.append([position, 1])
+    return runs
+
+
+def reservoir_sample(items, size, rng=None, key=None):
+    """单遍蓄水池抽样，返回 [(序号, 元素)]（按序号排序）
+
+    key 不为空时分层：每个 key 一个蓄水池（最多 SAMPLE_MAX_STRATA 个，之后的新 key 并入“其他”），
+    返回 ({key: [(序号, 元素)]}, {key: 条数})。内存只与 size × 组数有关
+    """
+    rng = rng or random.Random()
+    reservoirs = {}
+    counts = {}
+    for index, item in enumerate(items):
+        stratum = None
+        if key is not None:
+            stratum = key(item)
+            if stratum not in reservoirs and len(reservoirs) >= SAMPLE_MAX_STRATA:
+                stratum = SAMPLE_STRATUM_OTHER
+        seen = counts.get(stratum, 0) + 1
+        counts[stratum] = seen
+        reservoir = reservoirs.setdefault(stratum, [])
+        if len(reservoir) < size:
+            reservoir.append((index, item))
+        else:
+            j = rng.randrange(seen)
+            if j < size:
+                reservoir[j] = (index, item)
+    if key is None:
+        return sorted(reservoirs.get(None, []), key=lambda pair: pair[0])
+    return {s: sorted(r, key=lambda pair: pair[0]) for s, r in reservoirs.items()}, counts
+
+
+def allocate_quotas(counts, size):
+    """按各组条数比例分配样例名额（最大余数法），每组至少 1 条（组数超过 size 时取条数最多的组）"""
+    if not counts:
+        return {}
+    strata = sorted(counts, key=lambda s: -counts[s])
+    if len(strata) >= size:
+        return {s: 1 for s in strata[:size]}
+    total = sum(counts.values())
+    quotas = {s: 1 for s in strata}
+    remaining = size - len(strata)
+    shares = {s: remaining * counts[s] / total for s in strata}
+    for s in strata:
+        extra = int(shares[s])
+        quotas[s] += extra
+    left = size - sum(quotas.values())
+    for s in sorted(strata, key=lambda s: -(shares[s] - int(shares[s])))[:left]:
+        quotas[s] += 1
+    return {s: min(quotas[s], counts[s]) for s in strata}
+
+
+def parse_stratify(stratify):
+    """'time:day' / 'field:班级' -> ('time', 'day') / ('field', '班级')；无效时返回 None"""
+    if not stratify:
+        return None
+    kind, _, arg = str(stratify).partition(':')
+    kind, arg = kind.strip().lower(), arg.strip()
+    if kind == 'time' and (arg or 'day') in _TIME_BUCKETS:
+        return 'time', arg or 'day'
+    if kind == 'field' and arg:
+        return 'field', arg
+    logger.warning(f"无效的分层抽样设置: {stratify}")
+    return None
+
+
+def _stratum_of_field(field):
+    def key(row):
+        try:
+            data = json.loads(row[1])
+            value = data.get(field) if isinstance(data, dict) else None
+        except Exception:
+            value = None
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        return '（空）' if value is None or value == '' else str(value)
+    return key
+
+
+def _stratum_of_time(bucket):
+    label = _TIME_BUCKETS[bucket]
+
+    def key(row):
+        return label(row[1]) if row[1] is not None else '（未知时间）'
+    return key
+
+
+class SubmissionSampler:
+    """按任务抽取提示词样例；数据库查询只返回样例行"""
+
+    def __init__(self, SessionLocal, Submission, size=PROMPT_SAMPLE_SIZE, rng=None):
+        self.SessionLocal = SessionLocal
+        self.Submission = Submission
+        self.size = max(1, size)
+        self.rng = rng or random.Random()
+
+    def count(self, task_id):
+        Submission = self.Submission
+        db = self.SessionLocal()
+        try:
+            return db.query(func.count(Submission.id)).filter(Submission.task_id == task_id).scalar() or 0
+        finally:
+            db.close()
+
+    def sample(self, task_id, strategy=None, stratify=None, total=None):
+        """返回 (总条数, [SampledSubmission])，样例按位置排序"""
+        strategy = strategy or PROMPT_SAMPLE_STRATEGY
+        if strategy not in SAMPLE_STRATEGIES:
+            logger.warning(f"未知的抽样方式 {strategy}，改用 spread")
+            strategy = 'spread'
+        if total is None:
+            total = self.count(task_id)
+        if total <= 0:
+            return 0, []
+        stratify = parse_stratify(stratify if stratify is not None else PROMPT_SAMPLE_STRATIFY)
+        # 数据量不超过样例数时全部显示，不需要抽样
+        if total > self.size and stratify is not None:
+            return total, self._stratified(task_id, *stratify)
+        if total > self.size and strategy == 'random':
+            return total, self._random(task_id, total)
+        return total, self._spread(task_id, total)
+
+    # ---------- 首 / 中 / 尾 ----------
+    def _spread(self, task_id, total):
+        Submission = self.Submission
+        samples = []
+        db = self.SessionLocal()
+        try:
+            base = db.query(Submission.id, Submission.data, Submission.submitted_at).filter(Submission.task_id == task_id)
+            for start, length in _runs(spread_positions(total, self.size)):
+                if start + length == total and start > length:
+                    # 末段倒序取，避免数据库跳过前面的全部行
+                    rows = base.order_by(Submission.id.desc()).limit(length).all()[::-1]
+                else:
+                    rows = base.order_by(Submission.id).offset(start).limit(length).all()
+                for offset, row in enumerate(rows):
+                    samples.append(SampledSubmission(start + offset, row.id, row.data, row.submitted_at, None))
+        finally:
+            db.close()
+        return samples
+
+    # ---------- 随机 ----------
+    def _random(self, task_id, total):
+        """在 [最小 id, 最大 id] 内随机探测；id 间隔不均匀时紧跟在大间隔后的行被抽中的概率略高"""
+        Submission = self.Submission
+        db = self.SessionLocal()
+        try:
+            low, high = (
+                db.query(func.min(Submission.id), func.max(Submission.id))
+                .filter(Submission.task_id == task_id).one()
+            )
+            chosen = {}
+            attempts = 0
+            while len(chosen) < min(self.size, total) and attempts < self.size * 8:
+                attempts += 1
+                probe = self.rng.randint(low, high)
+                row = (
+                    db.query(Submission.id, Submission.data, Submission.submitted_at)
+                    .filter(Submission.task_id == task_id, Submission.id >= probe)
+                    .order_by(Submission.id).first()
+                )
+                if row is not None:
+                    chosen[row.id] = row
+            return [
+                SampledSubmission(self._position(db, task_id, row.id), row.id, row.data, row.submitted_at, None)
+                for row in sorted(chosen.values(), key=lambda r: r.id)
+            ]
+        finally:
+            db.close()
+
+    def _position(self, db, task_id, submission_id):
+        Submission = self.Submission
+        return db.query(func.count(Submission.id)).filter(
+            Submission.task_id == task_id, Submission.id < submission_id
+        ).scalar() or 0
+
+    # ---------- 分层 ----------
+    def _stratified(self, task_id, kind, arg):
+        """单遍流式读取分层所需的列，每组蓄水池只保留 (id, 组) 和位置，最后按 id 取回样例"""
+        Submission = self.Submission
+        column = Submission.submitted_at if kind == 'time' else Submission.data
+        key = _stratum_of_time(arg) if kind == 'time' else _stratum_of_field(arg)
+
+        db = self.SessionLocal()
+        try:
+            rows = (
+                db.query(Submission.id, column)
+                .filter(Submission.task_id == task_id)
+                .order_by(Submission.id)
+                .execution_options(stream_results=True, yield_per=EXPORT_YIELD_PER)
+            )
+            # 蓄水池中只保存 (id, 组)，不保留 data 文本
+            reservoirs, counts = reservoir_sample(
+                ((row[0], key(row)) for row in rows), self.size, self.rng, key=lambda item: item[1]
+            )
+        finally:
+            db.close()
+
+        picked = []
+        for stratum, quota in allocate_quotas(counts, self.size).items():
+            reservoir = reservoirs[stratum]
+            picked.extend(reservoir if len(reservoir) <= quota else self.rng.sample(reservoir, quota))
+        picked.sort(key=lambda pair: pair[0])
+        return self._fetch(picked)
+
+    def _fetch(self, picked):
+        """picked: [(位置, (id, 组))] -> [SampledSubmission]"""
+        if not picked:
+            return []
+        Submission = self.Submission
+        db = self.SessionLocal()
+        try:
+            ids = [item[0] for _, item in picked]
+            rows = {
+                row.id: row for row in
+                db.query(Submission.id, Submission.data, Submission.submitted_at).filter(Submission.id.in_(ids)).all()
+            }
+        finally:
+            db.close()
+        return [
+            SampledSubmission(position, sub_id, rows[sub_id].data, rows[sub_id].submitted_at, stratum)
+            for position, (sub_id, stratum) in picked if sub_id in rows
+        ]
+
+
+def sample_submissions(SessionLocal, Submission, task_id, size=PROMPT_SAMPLE_SIZE, strategy=None, stratify=None,
+                       total=None, rng=None):
+    """抽取任务的提示词样例，返回 (总条数, [SampledSubmission])"""
+    return SubmissionSampler(SessionLocal, Submission, size, rng).sample(task_id, strategy, stratify, total)
+
+
+def sample_from_list(submissions, size=PROMPT_SAMPLE_SIZE):
+    """调用方已经传入提交列表时，按同样的首 / 中 / 尾位置挑选"""
+    return [
+        SampledSubmission(i, getattr(submissions[i], 'id', None), submissions[i].data,
+                          getattr(submissions[i], 'submitted_at', None), None)
+        for i in spread_positions(len(submissions), size)
+    ]
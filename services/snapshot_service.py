@@ -0,0 +1,543 @@
+"""提交数据列式快照 - 每个任务一份 Parquet 快照（uploads/snapshots/task{id}/）
+
+导出、统计每次都要把 Submission.data 的 JSON 文本逐条 json.loads。
+开启快照后（SNAPSHOT_ENABLED=true，需要 pip install pyarrow），提交数达到 SNAPSHOT_MIN_ROWS 的任务
+由后台线程把提交数据解析一次，按列写成 Parquet 段文件：
+- 段文件名 seg-{首个提交id}-{最后提交id}-{行数}.parquet，不需要额外的清单文件
+- 有新提交时只解析新增部分并追加一个段；段数超过 SNAPSHOT_MAX_SEGMENTS 时合并为一个段
+- 每次读取前用 (id 不超过快照水位线的提交条数) 与快照行数比对，不一致（有提交被删除）则重建
+- 读取方：导出（xlsx / csv）逐批读段文件；load_frame 按列读出 DataFrame（临时分析、scripts/build_snapshots.py --bench）
+- 字段统计（services.field_stats）不读快照：快照中缺失字段和 null 都是空值，列表 / 字典存为 JSON 文本，
+  mixed 列已转为文本，得不到与逐条统计一致的结果
+
+列类型：同一列全是 bool / int / float / str 时按原类型存储；int 与 float 混合存为 float64（number），
+另存一个隐藏的布尔列记录哪些值原本是整数，读出时还原；列表 / 字典存为 JSON 文本（与导出单元格一致）；
+其他混合类型（如数字和文本混填）转为文本并标记为 mixed，导出遇到 mixed 列时仍从数据库读取，保证导出内容不变。
+未安装 pyarrow 或未开启时，所有读取方法返回 None，调用方按原方式从数据库读取。
+"""
+import os
+import re
+import json
+import time
+import shutil
+import threading
+import logging
+from collections import namedtuple
+
+import pandas as pd
+from sqlalchemy import func, case
+
+from .export_service import parse_submission, iter_submissions, cell_value, EXPORT_YIELD_PER
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 可选依赖
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.getenv('SNAPSHOT_ENABLED', 'false').lower() == 'true'
+SNAPSHOT_MIN_ROWS = int(os.getenv('SNAPSHOT_MIN_ROWS', '1000'))                  # 提交数达到多少才建快照
+SNAPSHOT_SYNC_INTERVAL = float(os.getenv('SNAPSHOT_SYNC_INTERVAL', '30'))        # 后台追加新提交的间隔（秒）
+SNAPSHOT_MAX_SEGMENTS = int(os.getenv('SNAPSHOT_MAX_SEGMENTS', '8'))             # 段数超过后合并
+SNAPSHOT_SEGMENT_ROWS = 50000        # 单个段最多行数（追加时分段写出，内存与总行数无关）
+SNAPSHOT_LOCK_TTL = 600              # 跨进程更新锁的过期时间（秒）
+
+ID_COLUMN = '__qf_id'
+INT_FLAG_PREFIX = '__qf_int:'        # number 列的隐藏列：值原本是否为整数
+KINDS_METADATA_KEY = b'quickform.kinds'
+
+_SEGMENT_RE = re.compile(r'^seg-(\d+)-(\d+)-(\d+)\.parquet$')
+
+Segment = namedtuple('Segment', ['first_id', 'last_id', 'rows', 'path'])
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return 'json'
+
+
+def _column_array(values):
+    """把一列 Python 值转换为 Arrow 数组，返回 (数组, 列类型, number 列的整数标记数组或 None)"""
+    kinds = {_value_kind(v) for v in values if v is not None}
+    if not kinds:
+        return pa.nulls(len(values)), 'null', None
+    if kinds == {'int', 'float'}:
+        kinds = {'number'}
+    if len(kinds) == 1:
+        kind = next(iter(kinds))
+        if kind == 'json':
+            return pa.array([cell_value(v) for v in values], type=pa.string()), 'json', None
+        try:
+            array = pa.array(values, type=_ARROW_TYPES[kind]())
+            if kind == 'number':
+                flags = pa.array([None if v is None else isinstance(v, int) for v in values], type=pa.bool_())
+                return array, kind, flags
+            return array, kind, None
+        except (pa.ArrowInvalid, OverflowError):
+            pass  # 超出 int64 范围的整数
+    return pa.array([None if v is None else str(cell_value(v)) for v in values], type=pa.string()), 'mixed', None
+
+
+def _merged_kind(kinds):
+    """多个段中同一列的类型（不含 null）合并后的类型，规则与 _column_array 一致：任一段为 mixed 则为 mixed"""
+    if 'mixed' in kinds:
+        return 'mixed'
+    if len(kinds) > 1 and kinds <= {'int', 'float', 'number'}:
+        return 'number'
+    return next(iter(kinds)) if len(kinds) == 1 else 'mixed'
+
+
+_ARROW_TYPES = {
+    'bool': lambda: pa.bool_(),
+    'int': lambda: pa.int64(),
+    'float': lambda: pa.float64(),
+    'number': lambda: pa.float64(),
+    'str': lambda: pa.string(),
+}
+
+
+def _build_table(ids, rows):
+    """(提交id 列表, 解析后的字典列表) -> Arrow 表；列按首次出现顺序，列类型写入 schema 元数据"""
+    columns = {}
+    for row in rows:
+        for key in row:
+            if key not in columns and key != ID_COLUMN:
+                columns[key] = None
+    return _assemble_table(pa.array(ids, type=pa.int64()),
+                           ((name, _column_array([row.get(name) for row in rows])) for name in columns))
+
+
+def _assemble_table(id_array, columns):
+    """id 列 + [(列名, (数组, 列类型, 整数标记))] -> Arrow 表，列类型写入 schema 元数据"""
+    names = [ID_COLUMN]
+    arrays = [id_array]
+    kinds = {}
+    for name, (array, kind, flags) in columns:
+        names.append(name)
+        arrays.append(array)
+        kinds[name] = kind
+        if flags is not None:
+            names.append(INT_FLAG_PREFIX + name)
+            arrays.append(flags)
+    metadata = {KINDS_METADATA_KEY: json.dumps(kinds, ensure_ascii=False).encode('utf-8')}
+    return pa.Table.from_arrays(arrays, names=names, metadata=metadata)
+
+
+def _read_column(pf, name, kind):
+    """读取段文件中的一列，返回与原始解析结果类型一致的 Python 值列表"""
+    if kind != 'number':
+        return pf.read(columns=[name]).column(0).to_pylist()
+    table = pf.read(columns=[name, INT_FLAG_PREFIX + name])
+    return [
+        int(v) if flag else v
+        for v, flag in zip(table.column(0).to_pylist(), table.column(1).to_pylist())
+    ]
+
+
+def _segment_kinds(schema):
+    raw = (schema.metadata or {}).get(KINDS_METADATA_KEY)
+    return json.loads(raw.decode('utf-8')) if raw else {}
+
+
+def _list_segments(task_dir):
+    """按提交 id 排序的段列表；合并进行中可能同时看到新旧文件，去掉被其他段覆盖的段"""
+    if not os.path.isdir(task_dir):
+        return []
+    found = []
+    for name in os.listdir(task_dir):
+        match = _SEGMENT_RE.match(name)
+        if match:
+            found.append(Segment(int(match.group(1)), int(match.group(2)), int(match.group(3)),
+                                 os.path.join(task_dir, name)))
+    found.sort(key=lambda s: (s.first_id, -s.last_id))
+    segments = []
+    for seg in found:
+        if segments and seg.last_id <= segments[-1].last_id:
+            continue
+        segments.append(seg)
+    return segments
+
+
+class SnapshotReader:
+    """读取一个任务的快照（打开时固定段文件，读取过程中合并不影响已打开的文件）"""
+
+    def __init__(self, segments, max_id=None):
+        self.max_id = max_id
+        self.files = []
+        self.columns = []
+        self.kinds = {}
+        try:
+            for seg in segments:
+                if max_id is not None and seg.first_id > max_id:
+                    break
+                pf = pq.ParquetFile(seg.path)
+                self.files.append((seg, pf))
+                for name, kind in _segment_kinds(pf.schema_arrow).items():
+                    if name not in self.kinds:
+                        self.columns.append(name)
+                        self.kinds[name] = kind
+                    elif kind == 'mixed' or self.kinds[name] == 'null':
+                        self.kinds[name] = kind
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def lossless(self):
+        """快照中的值与逐条解析 JSON 的结果一致（没有被转为文本的混合类型列）"""
+        return 'mixed' not in self.kinds.values()
+
+    @property
+    def rows(self):
+        return sum(seg.rows for seg, _ in self.files)
+
+    def iter_rows(self, batch_size=EXPORT_YIELD_PER):
+        """逐行返回与 export_service.parse_submission 相同的字典（缺失的列为 None）"""
+        try:
+            for seg, pf in self.files:
+                number_columns = [
+                    (name, INT_FLAG_PREFIX + name)
+                    for name, kind in _segment_kinds(pf.schema_arrow).items() if kind == 'number'
+                ]
+                for batch in pf.iter_batches(batch_size=batch_size):
+                    for row in batch.to_pylist():
+                        sub_id = row.pop(ID_COLUMN)
+                        if self.max_id is not None and sub_id > self.max_id:
+                            return
+                        for name, flag_name in number_columns:
+                            if row.pop(flag_name):
+                                row[name] = int(row[name])
+                        yield row
+        finally:
+            self.close()
+
+    def close(self):
+        for _, pf in self.files:
+            try:
+                pf.close()
+            except Exception:
+                pass
+        self.files = []
+
+
+class SnapshotStore:
+    """列式快照的维护（后台追加、合并、删除后重建）与读取"""
+
+    def __init__(self, SessionLocal, Task, Submission, snapshot_dir, state_backend=None,
+                 enabled=SNAPSHOT_ENABLED, min_rows=SNAPSHOT_MIN_ROWS,
+                 sync_interval=SNAPSHOT_SYNC_INTERVAL, max_segments=SNAPSHOT_MAX_SEGMENTS):
+        self.SessionLocal = SessionLocal
+        self.Task = Task
+        self.Submission = Submission
+        self.snapshot_dir = snapshot_dir
+        self.state = state_backend
+        if enabled and pa is None:
+            logger.warning("SNAPSHOT_ENABLED=true 但未安装 pyarrow，列式快照不可用（pip install pyarrow）")
+        self.enabled = enabled and pa is not None
+        self.min_rows = min_rows
+        self.sync_interval = sync_interval
+        self.max_segments = max(1, max_segments)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._known_rows = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'syncs': 0, 'rows_appended': 0, 'rebuilds': 0, 'compactions': 0, 'reads': 0, 'fallbacks': 0}
+        if self.enabled and not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+
+    def task_dir(self, task_id):
+        return os.path.join(self.snapshot_dir, f"task{task_id}")
+
+    def segments(self, task_id):
+        return _list_segments(self.task_dir(task_id))
+
+    def _task_lock(self, task_id):
+        with self._locks_guard:
+            lock = self._locks.get(task_id)
+            if lock is None:
+                lock = self._locks[task_id] = threading.Lock()
+            return lock
+
+    def _count(self, key, amount=1):
+        with self._locks_guard:
+            self._stats[key] += amount
+
+    # ---------- 维护 ----------
+    def sync(self, task_id, build=True, min_rows=None):
+        """把新提交追加到快照；有提交被删除时重建。返回快照是否与数据库一致
+
+        build=False 时只更新已有快照（请求中调用，不在请求里从头建快照）
+        """
+        if not self.enabled:
+            return False
+        lock_key = f"snapshot:lock:{task_id}"
+        with self._task_lock(task_id):
+            # 其他 worker 正在更新同一快照时不等待，调用方改为从数据库读取
+            if self.state is not None and not self.state.add(lock_key, os.getpid(), ttl=SNAPSHOT_LOCK_TTL):
+                return False
+            try:
+                return self._sync_locked(task_id, build, self.min_rows if min_rows is None else min_rows)
+            except Exception as e:
+                logger.error(f"更新快照失败 - Task ID: {task_id}, 错误: {str(e)}", exc_info=True)
+                return False
+            finally:
+                if self.state is not None:
+                    self.state.delete(lock_key)
+
+    def _sync_locked(self, task_id, build, min_rows):
+        Submission = self.Submission
+        segments = self.segments(task_id)
+        if not segments and not build:
+            return False
+        last_id = segments[-1].last_id if segments else 0
+        snapshot_rows = sum(seg.rows for seg in segments)
+
+        db = self.SessionLocal()
+        try:
+            total, covered, max_id = (
+                db.query(
+                    func.count(Submission.id),
+                    func.sum(case((Submission.id <= last_id, 1), else_=0)),
+                    func.max(Submission.id),
+                )
+                .filter(Submission.task_id == task_id)
+                .one()
+            )
+        finally:
+            db.close()
+        total, covered, max_id = total or 0, int(covered or 0), max_id or 0
+
+        if total < min_rows:
+            if segments:
+                self.purge_task(task_id)
+            self._known_rows.pop(task_id, None)
+            return False
+
+        if covered != snapshot_rows:
+            # 已有快照范围内的提交被删除（或晚提交的事务插入了更小的 id），整体重建
+            logger.info(f"快照与数据库不一致，重建 - Task ID: {task_id}, 快照 {snapshot_rows} 条, 数据库 {covered} 条")
+            self.purge_task(task_id)
+            self._count('rebuilds')
+            if not build:
+                return False
+            segments, last_id = [], 0
+
+        if max_id > last_id:
+            appended = self._append(task_id, last_id)
+            self._count('rows_appended', appended)
+            segments = self.segments(task_id)
+
+        if len(segments) > self.max_segments:
+            self.compact(task_id, _locked=True)
+        self._known_rows[task_id] = total
+        self._count('syncs')
+        return True
+
+    def _append(self, task_id, after_id):
+        task_dir = self.task_dir(task_id)
+        if not os.path.exists(task_dir):
+            os.makedirs(task_dir)
+        ids, rows, appended = [], [], 0
+        for sub_id, raw, submitted_at in iter_submissions(self.SessionLocal, self.Submission, task_id, min_id=after_id):
+            ids.append(sub_id)
+            rows.append(parse_submission(raw, submitted_at))
+            if len(rows) >= SNAPSHOT_SEGMENT_ROWS:
+                self._write_segment(task_dir, _build_table(ids, rows), ids[0], ids[-1])
+                appended += len(rows)
+                ids, rows = [], []
+        if rows:
+            self._write_segment(task_dir, _build_table(ids, rows), ids[0], ids[-1])
+            appended += len(rows)
+        return appended
+
+    @staticmethod
+    def _write_segment(task_dir, table, first_id, last_id):
+        path = os.path.join(task_dir, f"seg-{first_id:012d}-{last_id:012d}-{table.num_rows}.parquet")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(table, tmp_path)
+        # 写完再改名，读取方不会看到半个文件
+        os.replace(tmp_path, path)
+        return path
+
+    def compact(self, task_id, _locked=False):
+        """把全部段合并为一个段（逐列合并，内存只与单列大小有关）"""
+        if not _locked:
+            with self._task_lock(task_id):
+                return self.compact(task_id, _locked=True)
+        segments = self.segments(task_id)
+        if len(segments) < 2:
+            return False
+        files = [pq.ParquetFile(seg.path) for seg in segments]
+        try:
+            columns, kinds_per_file = [], []
+            for pf in files:
+                kinds = _segment_kinds(pf.schema_arrow)
+                kinds_per_file.append(kinds)
+                for name in kinds:
+                    if name not in columns:
+                        columns.append(name)
+
+            id_array = pa.concat_arrays([pf.read(columns=[ID_COLUMN]).column(0).combine_chunks() for pf in files])
+            merged = []
+            for name in columns:
+                kinds = {k[name] for k in kinds_per_file if k.get(name, 'null') != 'null'}
+                if len(kinds) == 1 and kinds != {'number'}:
+                    # 各段类型相同：直接拼接 Arrow 数组
+                    kind = next(iter(kinds))
+                    arrow_type = _ARROW_TYPES[kind]() if kind in _ARROW_TYPES else pa.string()
+                    array = pa.concat_arrays([
+                        pf.read(columns=[name]).column(0).combine_chunks().cast(arrow_type)
+                        if name in k else pa.nulls(seg.rows, type=arrow_type)
+                        for pf, k, seg in zip(files, kinds_per_file, segments)
+                    ])
+                    merged.append((name, (array, kind, None)))
+                else:
+                    # 类型不同（或含 number 列）：按原始类型读出后重新推断；
+                    # mixed 段已是文本，不能重新推断（会变成 str），按类型合并规则确定为 mixed 后统一转为文本
+                    values = []
+                    for pf, k, seg in zip(files, kinds_per_file, segments):
+                        values.extend(_read_column(pf, name, k[name]) if name in k else [None] * seg.rows)
+                    if _merged_kind(kinds) == 'mixed':
+                        array = pa.array([None if v is None else str(cell_value(v)) for v in values], type=pa.string())
+                        merged.append((name, (array, 'mixed', None)))
+                    else:
+                        merged.append((name, _column_array(values)))
+            table = _assemble_table(id_array, merged)
+        finally:
+            for pf in files:
+                pf.close()
+
+        task_dir = self.task_dir(task_id)
+        merged_path = self._write_segment(task_dir, table, segments[0].first_id, segments[-1].last_id)
+        # 删除被合并的段（包括上次因被占用没删掉的旧段）
+        for name in os.listdir(task_dir):
+            path = os.path.join(task_dir, name)
+            if _SEGMENT_RE.match(name) and path != merged_path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Windows 下仍被读取方打开，下次合并时再删
+        self._count('compactions')
+        return True
+
+    def sync_all(self):
+        """后台线程调用：提交数有变化的任务追加快照，返回更新的任务数"""
+        Task = self.Task
+        db = self.SessionLocal()
+        try:
+            candidates = (
+                db.query(Task.id, Task.submission_count)
+                .filter(Task.submission_count >= self.min_rows)
+                .all()
+            )
+        finally:
+            db.close()
+        updated = 0
+        for task_id, count in candidates:
+            if self._stop.is_set():
+                break
+            if self._known_rows.get(task_id) != count and self.sync(task_id):
+                updated += 1
+        return updated
+
+    def purge_task(self, task_id):
+        """删除任务的快照（任务删除、清空提交数据时调用）"""
+        self._known_rows.pop(task_id, None)
+        shutil.rmtree(self.task_dir(task_id), ignore_errors=True)
+
+    # ---------- 读取 ----------
+    def reader(self, task_id, max_id=None, lossless=True):
+        """读取快照（先追加新提交）；没有快照、有其他进程正在更新或需要无损而快照有混合类型列时返回 None
+
+        max_id 不为空时只读取 id 不超过它的提交（后台导出按水位线生成固定内容）
+        """
+        if not self.enabled or not self.sync(task_id, build=False):
+            return None
+        try:
+            segments = self.segments(task_id)
+            if max_id is not None and (not segments or segments[-1].last_id < max_id):
+                return None
+            snapshot = SnapshotReader(segments, max_id)
+        except Exception as e:
+            logger.warning(f"打开快照失败，改为从数据库读取 - Task ID: {task_id}, 错误: {str(e)}")
+            self._count('fallbacks')
+            return None
+        if lossless and not snapshot.lossless:
+            snapshot.close()
+            self._count('fallbacks')
+            return None
+        self._count('reads')
+        return snapshot
+
+    def load_frame(self, task_id, columns=None):
+        """快照中的全部提交 -> DataFrame（索引为提交 id，按列读取，不逐条解析 JSON）；不可用时返回 None
+
+        按存储类型读出：number 列为浮点数，json / mixed 列为文本，缺失字段与 null 不区分
+        """
+        snapshot = self.reader(task_id, lossless=False)
+        if snapshot is None:
+            return None
+        try:
+            frames = []
+            for seg, pf in snapshot.files:
+                wanted = None
+                if columns is not None:
+                    wanted = [ID_COLUMN] + [c for c in columns if c in pf.schema_arrow.names]
+                frames.append(pf.read(columns=wanted).to_pandas())
+        finally:
+            snapshot.close()
+        frame = pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0]
+        frame = frame.drop(columns=[c for c in frame.columns if c.startswith(INT_FLAG_PREFIX)])
+        return frame.set_index(ID_COLUMN)
+
+    # ---------- 生命周期 ----------
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='snapshot-sync', daemon=True)
+        self._thread.start()
+        logger.info(f"列式快照已启用: {self.snapshot_dir}（提交数 ≥ {self.min_rows} 的任务，每 {self.sync_interval:.0f} 秒追加）")
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                started = time.monotonic()
+                updated = self.sync_all()
+                if updated:
+                    logger.info(f"已更新 {updated} 个任务的快照，用时 {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                logger.error(f"快照后台更新失败: {str(e)}", exc_info=True)
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False, 'pyarrow': pa is not None}
+        with self._locks_guard:
+            s = dict(self._stats)
+        tasks = segments = size = 0
+        if os.path.isdir(self.snapshot_dir):
+            for name in os.listdir(self.snapshot_dir):
+                task_segments = _list_segments(os.path.join(self.snapshot_dir, name))
+                if task_segments:
+                    tasks += 1
+                    segments += len(task_segments)
+                    size += sum(os.path.getsize(seg.path) for seg in task_segments)
+        s.update({'enabled': True, 'tasks': tasks, 'segments': segments, 'bytes': size})
+        return s
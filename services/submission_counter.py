@@ -0,0 +1,46 @@
+"""任务提交计数 - 维护 Task.submission_count / Task.last_submitted_at
+
+列表页直接读取计数字段，不再为了显示条数而加载整张 submission 表。
+计数与提交数据的增删在同一事务中更新；历史数据或异常情况可用
+refresh_submission_counts（scripts/repair_submission_counts.py）全量重算。
+"""
+import logging
+
+from sqlalchemy import update, select, func, case
+
+logger = logging.getLogger(__name__)
+
+
+def bump_submission_count(db, Task, task_id, delta=1, last_submitted_at=None):
+    """在当前事务中原子地调整某任务的提交计数（不提交事务）"""
+    values = {'submission_count': func.coalesce(Task.submission_count, 0) + delta}
+    if last_submitted_at is not None:
+        values['last_submitted_at'] = case(
+            (Task.last_submitted_at.is_(None), last_submitted_at),
+            (Task.last_submitted_at < last_submitted_at, last_submitted_at),
+            else_=Task.last_submitted_at
+        )
+    db.execute(update(Task).where(Task.id == task_id).values(**values))
+
+
+def refresh_submission_counts(db, Task, Submission, task_ids=None):
+    """按 submission 表重新计算计数和最后提交时间（不提交事务），返回更新的任务数"""
+    count_subq = (
+        select(func.count(Submission.id))
+        .where(Submission.task_id == Task.id)
+        .scalar_subquery()
+    )
+    last_subq = (
+        select(func.max(Submission.submitted_at))
+        .where(Submission.task_id == Task.id)
+        .scalar_subquery()
+    )
+    stmt = update(Task).values(submission_count=count_subq, last_submitted_at=last_subq)
+    if task_ids is not None:
+        task_ids = list(task_ids)
+        if not task_ids:
+            return 0
+        stmt = stmt.where(Task.id.in_(task_ids))
+    result = db.execute(stmt.execution_options(synchronize_session=False))
+    return result.rowcount or 0
+
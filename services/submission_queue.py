@@ -0,0 +1,217 @@
+"""提交写入队列 - 课堂集中提交时合并落库（write-behind / group commit）
+
+开启后 /api/<task_id> 的 POST 请求只做校验和序列化，然后放入进程内有界队列，
+由后台刷写线程每隔几毫秒或攒够 N 条后一次性批量插入并提交。
+客户端可选择：
+- durable：等待所在批次提交成功后再返回（默认）
+- fast：入队即返回
+"""
+import os
+import time
+import queue
+import atexit
+import threading
+import logging
+from datetime import datetime
+
+from .submission_counter import bump_submission_count
+
+logger = logging.getLogger(__name__)
+
+# 队列配置（环境变量）
+SUBMIT_QUEUE_ENABLED = os.getenv('SUBMIT_QUEUE_ENABLED', 'False').lower() == 'true'
+SUBMIT_QUEUE_MAX_SIZE = int(os.getenv('SUBMIT_QUEUE_MAX_SIZE', '5000'))        # 队列最大长度
+SUBMIT_QUEUE_BATCH_SIZE = int(os.getenv('SUBMIT_QUEUE_BATCH_SIZE', '200'))     # 每批最多插入条数
+SUBMIT_QUEUE_FLUSH_MS = int(os.getenv('SUBMIT_QUEUE_FLUSH_MS', '20'))          # 攒批最长等待（毫秒）
+SUBMIT_QUEUE_ACK = os.getenv('SUBMIT_QUEUE_ACK', 'durable').lower()            # 默认确认模式：durable / fast
+SUBMIT_QUEUE_ACK_TIMEOUT = float(os.getenv('SUBMIT_QUEUE_ACK_TIMEOUT', '5'))   # durable 模式最长等待（秒）
+
+ACK_DURABLE = 'durable'
+ACK_FAST = 'fast'
+
+
+class PendingSubmission:
+    """队列中的一条待写入提交"""
+    __slots__ = ('task_id', 'data', 'submitted_at', 'enqueued_at', 'done', 'error')
+
+    def __init__(self, task_id, data, submitted_at, wait):
+        self.task_id = task_id
+        self.data = data
+        self.submitted_at = submitted_at
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event() if wait else None
+        self.error = None
+
+    def finish(self, error=None):
+        self.error = error
+        if self.done is not None:
+            self.done.set()
+
+
+class SubmissionWriteQueue:
+    """有界提交队列 + 单线程批量刷写"""
+
+    def __init__(self, SessionLocal, Submission, Task=None, max_size=SUBMIT_QUEUE_MAX_SIZE,
+                 batch_size=SUBMIT_QUEUE_BATCH_SIZE, flush_interval_ms=SUBMIT_QUEUE_FLUSH_MS, on_written=None):
+        self.SessionLocal = SessionLocal
+        self.Submission = Submission
+        self.Task = Task
+        self.on_written = on_written  # 写入后回调 on_written(task_id)，例如登记字段统计待合并
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(1, flush_interval_ms) / 1000.0
+        self._queue = queue.Queue(maxsize=max(1, max_size))
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'rejected_full': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+            'max_queue_wait_ms': 0.0,
+        }
+
+    # ---------- 生命周期 ----------
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='submission-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"提交写入队列已启动: 容量={self._queue.maxsize}, 批大小={self.batch_size}, 刷写间隔={self.flush_interval * 1000:.0f}ms")
+
+    def stop(self, timeout=10):
+        """停止刷写线程，退出前把队列中剩余数据写完"""
+        if not self._thread:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+        # 线程退出后仍有残留（例如超时），在当前线程同步写完
+        leftover = self._drain(block=False)
+        while leftover:
+            self._flush(leftover)
+            leftover = self._drain(block=False)
+        logger.info("提交写入队列已停止")
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # ---------- 入队 ----------
+    def submit(self, task_id, data, wait=True):
+        """放入队列；队列已满时返回 None，由调用方回退到同步写入"""
+        item = PendingSubmission(task_id, data, datetime.now(), wait)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected_full'] += 1
+            return None
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+        return item
+
+    # ---------- 刷写 ----------
+    def _drain(self, block=True):
+        """取出一批：先阻塞等第一条，再在刷写间隔内尽量攒满一批"""
+        batch = []
+        try:
+            if block:
+                batch.append(self._queue.get(timeout=0.5))
+            else:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and block:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = self._drain(block=not self._stop.is_set())
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        written, failed = 0, 0
+        db = self.SessionLocal()
+        try:
+            self._write_batch(db, batch)
+            db.commit()
+            written = len(batch)
+            for item in batch:
+                item.finish()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"批量写入提交失败，改为逐条写入: {str(e)}")
+            # 某一条出错（例如任务已被删除）不应连累同批次其他数据
+            for item in batch:
+                try:
+                    self._write_batch(db, [item])
+                    db.commit()
+                    written += 1
+                    item.finish()
+                except Exception as row_error:
+                    db.rollback()
+                    failed += 1
+                    logger.error(f"写入提交失败 - task={item.task_id}: {str(row_error)}")
+                    item.finish(row_error)
+        finally:
+            db.close()
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        oldest_wait_ms = (started - min(item.enqueued_at for item in batch)) * 1000
+        with self._stats_lock:
+            s = self._stats
+            s['written'] += written
+            s['failed'] += failed
+            s['batches'] += 1
+            s['last_batch_size'] = len(batch)
+            s['last_flush_ms'] = elapsed_ms
+            s['max_flush_ms'] = max(s['max_flush_ms'], elapsed_ms)
+            s['total_flush_ms'] += elapsed_ms
+            s['max_queue_wait_ms'] = max(s['max_queue_wait_ms'], oldest_wait_ms)
+
+    def _write_batch(self, db, batch):
+        """在当前事务中插入一批提交（多行 INSERT），并同步更新各任务的提交计数"""
+        db.execute(
+            self.Submission.__table__.insert(),
+            [{'task_id': item.task_id, 'data': item.data, 'submitted_at': item.submitted_at} for item in batch]
+        )
+        if self.Task is None:
+            return
+        per_task = {}
+        for item in batch:
+            count, last_at = per_task.get(item.task_id, (0, item.submitted_at))
+            per_task[item.task_id] = (count + 1, max(last_at, item.submitted_at))
+        for task_id, (count, last_at) in per_task.items():
+            bump_submission_count(db, self.Task, task_id, count, last_at)
+            if self.on_written is not None:
+                self.on_written(task_id)
+
+    # ---------- 指标 ----------
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+        total_flush_ms = s.pop('total_flush_ms')
+        s['avg_flush_ms'] = round(total_flush_ms / s['batches'], 3) if s['batches'] else 0.0
+        s['queue_depth'] = self._queue.qsize()
+        s['queue_capacity'] = self._queue.maxsize
+        s['running'] = self.running
+        return s
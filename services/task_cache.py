@@ -0,0 +1,92 @@
+"""任务查找缓存 - /api/<task_id> 热路径使用
+
+公开 task_id -> 轻量任务记录（内部 id、task_id、标题、限流配置），只查询这几列，
+不加载 analysis_report、html_analysis 等大字段。
+进程内 TTL + LRU；任务被编辑/删除/修改公开范围时主动失效。
+多进程部署时其他进程的副本最多在 TTL 内过期。
+"""
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+TASK_CACHE_TTL = float(os.getenv('TASK_CACHE_TTL', '30'))             # 记录有效期（秒）
+TASK_CACHE_MAX_SIZE = int(os.getenv('TASK_CACHE_MAX_SIZE', '2048'))   # 最多缓存的任务数
+
+TaskRecord = namedtuple('TaskRecord', [
+    'id', 'task_id', 'title',
+    'rate_limit_window', 'rate_limit_threshold', 'rate_limit_blacklist_seconds'
+])
+
+
+class TaskLookupCache:
+    """按公开 task_id 缓存任务的轻量记录"""
+
+    def __init__(self, ttl=TASK_CACHE_TTL, max_size=TASK_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self._items = OrderedDict()  # task_id -> (expires_at, TaskRecord)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, db, Task, task_id):
+        """读取任务记录；未命中时只查询需要的列。任务不存在返回 None（不缓存）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(task_id)
+            if entry is not None:
+                if entry[0] > now:
+                    self._items.move_to_end(task_id)
+                    self._hits += 1
+                    return entry[1]
+                del self._items[task_id]
+            self._misses += 1
+
+        row = (
+            db.query(
+                Task.id, Task.task_id, Task.title,
+                Task.rate_limit_window, Task.rate_limit_threshold, Task.rate_limit_blacklist_seconds
+            )
+            .filter(Task.task_id == task_id)
+            .first()
+        )
+        if row is None:
+            return None
+        record = TaskRecord(*row)
+        with self._lock:
+            self._items[task_id] = (now + self.ttl, record)
+            self._items.move_to_end(task_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return record
+
+    def invalidate(self, task_id):
+        """任务被修改或删除后调用（参数为公开 task_id）"""
+        if not task_id:
+            return
+        with self._lock:
+            if self._items.pop(task_id, None) is not None:
+                self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += len(self._items)
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'size': len(self._items),
+                'capacity': self.max_size,
+                'ttl_seconds': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / total, 4) if total else 0.0,
+                'invalidations': self._invalidations,
+            }